@@ -16,6 +16,8 @@
 from .common import is_read_uniq_mapping
 from collections import Counter
 from collections import defaultdict
+from collections import OrderedDict
+import sys
 
 import pysam
 from tqdm.autonotebook import tqdm
@@ -23,7 +25,56 @@ from tqdm.autonotebook import tqdm
 tqdm.pandas()
 
 
-def split_bam(bam_path, protocol, prefix, read_lengths=None):
+def fetch_reads(bam, windows=None):
+    """Reads of a bam file, optionally restricted to windows.
+
+    Parameters
+    ----------
+    bam: pysam.AlignmentFile
+         opened bam file
+    windows: List[(str, int, int)]
+             sorted, non-overlapping (chrom, start, end) windows, 0-based
+             and half-open; the bam file must be indexed. If None, all
+             reads are returned, unmapped ones included
+
+    Returns
+    -------
+    reads: generator of pysam.AlignedSegment
+           each read once, even if it overlaps several windows
+    """
+    if windows is None:
+        yield from bam.fetch(until_eof=True)
+        return
+    if not bam.has_index():
+        sys.exit("Error: the BAM file must be indexed to be read by region")
+    previous = None
+    for chrom, start, end in windows:
+        if chrom not in bam.references:
+            continue
+        for read in bam.fetch(chrom, start, end):
+            # reads overlapping the previous window were already returned
+            if (
+                previous is not None
+                and previous[0] == chrom
+                and read.reference_start < previous[1]
+            ):
+                continue
+            yield read
+        previous = (chrom, end)
+
+
+def _count_reads(bam_path, windows=None):
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        if windows is None:
+            return bam.count(until_eof=True)
+        return sum(
+            bam.count(chrom, start, end)
+            for chrom, start, end in windows
+            if chrom in bam.references
+        )
+
+
+def split_bam(bam_path, protocol, prefix, read_lengths=None, windows=None):
     """Split bam by read length and strand
 
     Parameters
@@ -38,6 +89,9 @@ def split_bam(bam_path, protocol, prefix, read_lengths=None):
                   read lengths to use
                   If None, it will be automatically determined by assessing
                   the periodicity of metagene profile of this read length
+    windows: List[(str, int, int)]
+             if given, only reads overlapping these windows are used,
+             see fetch_reads
 
     Returns
     -------
@@ -48,86 +102,141 @@ def split_bam(bam_path, protocol, prefix, read_lengths=None):
     """
     alignments = defaultdict(lambda: defaultdict(Counter))
     read_length_counts = defaultdict(int)
-    total_count = qcfail = duplicate = secondary = unmapped = multi = valid = 0
+    stats = Counter()
     # print('reading bam file...')
     # First pass just counts the reads
     # this is required to display a progress bar
-    bam = pysam.AlignmentFile(bam_path, "rb")
-    total_reads = bam.count(until_eof=True)
-    bam.close()
+    total_reads = _count_reads(bam_path, windows)
     with tqdm(total=total_reads, unit="reads", leave=False) as pbar:
         bam = pysam.AlignmentFile(bam_path, "rb")
-        for read in bam.fetch(until_eof=True):
-            pbar.update()
-            # Track if the current read is usable
-            is_usable = True
-            total_count += 1
-
-            if read.is_qcfail:
-                qcfail += 1
-                is_usable = False
-            elif read.is_duplicate:
-                duplicate += 1
-                is_usable = False
-            elif read.is_secondary:
-                secondary += 1
-                is_usable = False
-            elif read.is_unmapped:
-                unmapped += 1
-                is_usable = False
-            elif not is_read_uniq_mapping(read):
-                multi += 1
-                is_usable = False
-
-            if is_usable:
-                map_strand = "-" if read.is_reverse else "+"
-                ref_positions = read.get_reference_positions()
-                strand = None
-                pos = None
-                chrom = read.reference_name
-                length = len(ref_positions)
-                if read_lengths is not None and length not in read_lengths:
-                    # Do nothing
-                    pass
-                else:
-                    if protocol == "forward":
-                        # Library preparation was forward-stranded:
-                        # Genes defined on + strand should have
-                        # reads mapping only on the positive strand
-                        if map_strand == "+":
-                            strand = "+"
-                            # Track the 5'end
-                            pos = ref_positions[0]
-                        else:
-                            strand = "-"
-                            # For negative strand of forward protocol read the
-                            # the 5'end of the read is the last element
-                            pos = ref_positions[-1]
-                    elif protocol == "reverse":
-                        # Library preparation was reverse-stranded
-                        # Mappings on the positive strand are
-                        # switched to negative strand with their positions
-                        # reversed and vice versa for mappings on the negative
-                        # strand.
-                        if map_strand == "+":
-                            strand = "-"
-                            # The 5' end is the last position
-                            pos = ref_positions[-1]
-                        else:
-                            strand = "+"
-                            # The 5'end is the first position
-                            pos = ref_positions[0]
-
-                    # convert bam coordinate to one-based
-                    alignments[length][strand][(chrom, pos + 1)] += 1
-                    read_length_counts[length] += 1
-                    valid += 1
+        split_reads(
+            fetch_reads(bam, windows),
+            protocol,
+            read_lengths,
+            alignments,
+            read_length_counts,
+            stats,
+            pbar,
+        )
     bam.close()
+    write_bam_summary(prefix, stats, read_length_counts)
+    return (alignments, read_length_counts)
+
+
+def split_reads(
+    reads, protocol, read_lengths, alignments, read_length_counts, stats, pbar=None
+):
+    """Add reads to the alignments split by read length and strand,
+    see split_bam
+
+    Parameters
+    ----------
+    reads: iterable of pysam.AlignedSegment
+    protocol: str
+          Experiment protocol [forward, reverse]
+    read_lengths: list[int]
+                  read lengths to use, all if None
+    alignments: dict(dict(Counter))
+                updated with the reads, by length, strand, (chrom, pos)
+    read_length_counts: dict
+                        updated with the number of reads of each length
+    stats: Counter
+           updated with the number of reads of each category of the summary
+    pbar: tqdm
+          progress bar updated for each read
+    """
+    for read in reads:
+        if pbar is not None:
+            pbar.update()
+        # Track if the current read is usable
+        is_usable = True
+        stats["total_reads"] += 1
+
+        if read.is_qcfail:
+            stats["qcfail"] += 1
+            is_usable = False
+        elif read.is_duplicate:
+            stats["duplicate"] += 1
+            is_usable = False
+        elif read.is_secondary:
+            stats["secondary"] += 1
+            is_usable = False
+        elif read.is_unmapped:
+            stats["unmapped"] += 1
+            is_usable = False
+        elif not is_read_uniq_mapping(read):
+            stats["multi"] += 1
+            is_usable = False
+
+        if is_usable:
+            map_strand = "-" if read.is_reverse else "+"
+            ref_positions = read.get_reference_positions()
+            strand = None
+            pos = None
+            chrom = read.reference_name
+            length = len(ref_positions)
+            if read_lengths is not None and length not in read_lengths:
+                # Do nothing
+                pass
+            else:
+                if protocol == "forward":
+                    # Library preparation was forward-stranded:
+                    # Genes defined on + strand should have
+                    # reads mapping only on the positive strand
+                    if map_strand == "+":
+                        strand = "+"
+                        # Track the 5'end
+                        pos = ref_positions[0]
+                    else:
+                        strand = "-"
+                        # For negative strand of forward protocol read the
+                        # the 5'end of the read is the last element
+                        pos = ref_positions[-1]
+                elif protocol == "reverse":
+                    # Library preparation was reverse-stranded
+                    # Mappings on the positive strand are
+                    # switched to negative strand with their positions
+                    # reversed and vice versa for mappings on the negative
+                    # strand.
+                    if map_strand == "+":
+                        strand = "-"
+                        # The 5' end is the last position
+                        pos = ref_positions[-1]
+                    else:
+                        strand = "+"
+                        # The 5'end is the first position
+                        pos = ref_positions[0]
+
+                # convert bam coordinate to one-based
+                alignments[length][strand][(chrom, pos + 1)] += 1
+                read_length_counts[length] += 1
+                stats["unique_mapped"] += 1
+
+
+def write_bam_summary(prefix, stats, read_length_counts):
+    """
+    Parameters
+    ----------
+    prefix: str
+            prefix for output files
+    stats: Counter
+           number of reads of each category, as counted by split_reads
+    read_length_counts: dict
+                        key is the length, value is the number of reads
+    """
     summary = (
         "summary:\n\ttotal_reads: {}\n\tunique_mapped: {}\n"
         "\tqcfail: {}\n\tduplicate: {}\n\tsecondary: {}\n"
         "\tunmapped:{}\n\tmulti:{}\n\nlength dist:\n"
-    ).format(total_count, valid, qcfail, duplicate, secondary, unmapped, multi)
+    ).format(
+        stats["total_reads"],
+        stats["unique_mapped"],
+        stats["qcfail"],
+        stats["duplicate"],
+        stats["secondary"],
+        stats["unmapped"],
+        stats["multi"],
+    )
 
     for length in sorted(read_length_counts):
         summary += "\t{}: {}\n".format(length, read_length_counts[length])
@@ -135,4 +244,19 @@ def split_bam(bam_path, protocol, prefix, read_lengths=None):
     with open("{}_bam_summary.txt".format(prefix), "w") as output:
         output.write(summary)
 
-    return (alignments, read_length_counts)
+
+def chrom_sizes(bam_path):
+    """Chromosome sizes from the bam header
+
+    Parameters
+    ----------
+    bam_path : str
+          Path to bam file
+
+    Returns
+    -------
+    sizes: OrderedDict
+           key is the chromosome, value is its length, in header order
+    """
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        return OrderedDict(zip(bam.references, bam.lengths))
@@ -0,0 +1,228 @@
+"""Binary cache of parsed annotation reused across prepare-orfs runs"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from .common import mkdir_p
+from .interval import Interval
+from .orf import ORF
+
+# bump whenever the layout of the cache file changes
+CACHE_VERSION = 1
+CACHE_MAGIC = b"RIBOTRICER_ANNOTATION_CACHE\n"
+
+
+def file_checksum(path, blocksize=1 << 20):
+    """Compute md5 checksum of a file.
+
+    Parameters
+    ----------
+    path: str
+          Path to file
+    blocksize: int
+               Number of bytes read at a time
+
+    Returns
+    -------
+    checksum: str
+              hex digest of the file content
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(blocksize), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _pack_ivs(intervals):
+    return tuple((iv.start, iv.end) for iv in intervals)
+
+
+def _unpack_ivs(chrom, strand, coordinates):
+    return [Interval(chrom, start, end, strand) for start, end in coordinates]
+
+
+class AnnotationCache(object):
+    """Parsed CDS and transcript models with spliced transcript sequences.
+
+    The transcript sequences are stored as a single concatenated byte string
+    along with their offsets, so that loading the cache does not require
+    the GTF or FASTA file.
+    """
+
+    def __init__(self, gtf_checksum, fasta_checksum):
+        """
+        Parameters
+        ----------
+        gtf_checksum: str
+                      checksum of the GTF file the models are parsed from
+        fasta_checksum: str
+                        checksum of the FASTA file the sequences are taken from
+        """
+        self.gtf_checksum = gtf_checksum
+        self.fasta_checksum = fasta_checksum
+        self.cds = []
+        self.transcripts = []
+        self.sequences = []
+
+    @staticmethod
+    def path(cache_dir, gtf_checksum, fasta_checksum):
+        """Location of the cache file for a pair of GTF and FASTA files"""
+        return os.path.join(
+            cache_dir, "{}_{}.annotation_cache".format(gtf_checksum, fasta_checksum)
+        )
+
+    def add_cds(self, orf):
+        """
+        Parameters
+        ----------
+        orf: ORF
+             annotated ORF parsed from CDS tracks
+        """
+        self.cds.append(
+            (
+                orf.tid,
+                orf.ttype,
+                orf.gid,
+                orf.gname,
+                orf.gtype,
+                orf.chrom,
+                orf.strand,
+                _pack_ivs(orf.intervals),
+                orf.seq,
+            )
+        )
+
+    def add_transcript(self, tid, ttype, gid, gname, gtype, chrom, strand, ivs, seq):
+        """
+        Parameters
+        ----------
+        tid, ttype, gid, gname, gtype, chrom, strand: str
+                                                      transcript attributes
+        ivs: List[Interval]
+             merged exon intervals of the transcript
+        seq: str
+             spliced transcript sequence, in transcript orientation
+        """
+        self.transcripts.append(
+            (tid, ttype, gid, gname, gtype, chrom, strand, _pack_ivs(ivs))
+        )
+        self.sequences.append(seq.encode())
+
+    def iter_cds(self):
+        """Yield annotated ORFs in the order they were added"""
+        for tid, ttype, gid, gname, gtype, chrom, strand, coordinates, seq in self.cds:
+            yield ORF(
+                "annotated",
+                tid,
+                ttype,
+                gid,
+                gname,
+                gtype,
+                chrom,
+                strand,
+                _unpack_ivs(chrom, strand, coordinates),
+                seq=seq,
+            )
+
+    def iter_transcripts(self):
+        """Yield (tid, ttype, gid, gname, gtype, chrom, strand, ivs, seq)"""
+        for (tid, ttype, gid, gname, gtype, chrom, strand, coordinates), seq in zip(
+            self.transcripts, self.sequences
+        ):
+            ivs = _unpack_ivs(chrom, strand, coordinates)
+            yield (tid, ttype, gid, gname, gtype, chrom, strand, ivs, seq.decode())
+
+    def save(self, path):
+        """Write the cache to disk.
+
+        Parameters
+        ----------
+        path: str
+              Path to the cache file
+        """
+        mkdir_p(os.path.dirname(os.path.abspath(path)))
+        lengths = np.array([len(seq) for seq in self.sequences], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        header = {
+            "version": CACHE_VERSION,
+            "gtf_checksum": self.gtf_checksum,
+            "fasta_checksum": self.fasta_checksum,
+            "cds": self.cds,
+            "transcripts": self.transcripts,
+            "offsets": offsets,
+        }
+        # write to a temporary file first so an interrupted run
+        # never leaves a truncated cache behind
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as fh:
+            fh.write(CACHE_MAGIC)
+            pickle.dump(header, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            fh.write(b"".join(self.sequences))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, gtf_checksum=None, fasta_checksum=None):
+        """Read a cache from disk.
+
+        Parameters
+        ----------
+        path: str
+              Path to the cache file
+        gtf_checksum: str
+                      if provided, the cache must have been built from
+                      a GTF file with this checksum
+        fasta_checksum: str
+                        if provided, the cache must have been built from
+                        a FASTA file with this checksum
+
+        Returns
+        -------
+        cache: AnnotationCache
+               None if the file is missing, stale or not a valid cache
+        """
+        if not os.path.isfile(path):
+            return None
+        with open(path, "rb") as fh:
+            if fh.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                return None
+            try:
+                header = pickle.load(fh)
+            except Exception:
+                return None
+            if header.get("version") != CACHE_VERSION:
+                return None
+            if gtf_checksum is not None and header["gtf_checksum"] != gtf_checksum:
+                return None
+            if (
+                fasta_checksum is not None
+                and header["fasta_checksum"] != fasta_checksum
+            ):
+                return None
+            blob = fh.read()
+        offsets = header["offsets"]
+        if len(blob) != offsets[-1]:
+            return None
+        cache = cls(header["gtf_checksum"], header["fasta_checksum"])
+        cache.cds = header["cds"]
+        cache.transcripts = header["transcripts"]
+        cache.sequences = [
+            blob[start:end] for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        return cache
@@ -0,0 +1,396 @@
+"""Checkpoints of the detect-orfs stages for resuming interrupted runs"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from collections import Counter
+from collections import defaultdict
+from collections import OrderedDict
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from .common import mkdir_p
+from .index import index_files
+
+# bump whenever the layout of the checkpoint files changes
+CHECKPOINT_VERSION = 1
+
+
+def checkpoint_dir(prefix):
+    return "{}_checkpoints".format(prefix)
+
+
+def file_fingerprint(path):
+    """Cheap fingerprint of an input file.
+
+    Checksumming a large bam file takes about as long as reading it, so the
+    path, size and modification time are used instead.
+
+    Parameters
+    ----------
+    path: str
+          Path to file
+
+    Returns
+    -------
+    fingerprint: list
+                 [absolute path, size, modification time in ns]
+    """
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+def index_fingerprint(ribotricer_index):
+    """Fingerprint of an index, including the shards of a sharded index"""
+    files = [ribotricer_index] + index_files(ribotricer_index)
+    return [file_fingerprint(path) for path in OrderedDict.fromkeys(files)]
+
+
+def stage_key(stage, parent, **params):
+    """Key identifying the output of a stage.
+
+    Parameters
+    ----------
+    stage: str
+           name of the stage
+    parent: str
+            key of the stage this one depends on, or None
+    params: dict
+            input fingerprints and parameters of the stage, json serializable
+
+    Returns
+    -------
+    key: str
+         hex digest of the stage, its parent and its parameters
+    """
+    payload = json.dumps(
+        [CHECKPOINT_VERSION, stage, parent, params], sort_keys=True
+    ).encode()
+    return hashlib.md5(payload).hexdigest()
+
+
+class CheckpointStore(object):
+    """Directory of stage checkpoints, one npz file per stage.
+
+    Each file stores the key of the stage along with json metadata and
+    the arrays of the stage output. A checkpoint is only used if its key
+    matches the key of the current run.
+    """
+
+    def __init__(self, directory, resume=False):
+        """
+        Parameters
+        ----------
+        directory: str
+                   directory holding the checkpoint files
+        resume: bool
+                whether existing checkpoints are loaded
+        """
+        self.directory = directory
+        self.resume = resume
+        mkdir_p(directory)
+
+    def path(self, stage):
+        return os.path.join(self.directory, "{}.npz".format(stage))
+
+    def load(self, stage, key):
+        """
+        Returns
+        -------
+        checkpoint: (dict, dict)
+                    (metadata, arrays) of the stage, None if there is no
+                    valid checkpoint
+        """
+        path = self.path(stage)
+        if not self.resume or not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                meta = json.loads(str(data["meta"]))
+                if meta.get("key") != key:
+                    return None
+                arrays = {name: data[name] for name in data.files if name != "meta"}
+        except (OSError, ValueError, KeyError):
+            # truncated or otherwise unreadable checkpoint
+            return None
+        return meta, arrays
+
+    def save(self, stage, key, meta, arrays):
+        """Write a checkpoint atomically, so that a crash while saving
+        leaves no partial file behind"""
+        meta = dict(meta, key=key)
+        path = self.path(stage)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "wb") as fh:
+            np.savez(fh, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, path)
+
+
+def counters_to_arrays(groups):
+    """Flatten Counters keyed by (chrom, pos) to arrays.
+
+    Parameters
+    ----------
+    groups: List[(label, Counter)]
+            label is json serializable
+
+    Returns
+    -------
+    meta: dict
+          labels and chromosome names
+    arrays: dict
+            chromosome codes, positions and counts of all groups, with the
+            offsets of each group
+    """
+    chrom_codes = {}
+    labels = []
+    chroms, positions, counts = [], [], []
+    offsets = [0]
+    for label, counter in groups:
+        n = len(counter)
+        labels.append(label)
+        chroms.append(
+            np.fromiter(
+                (
+                    chrom_codes.setdefault(chrom, len(chrom_codes))
+                    for chrom, _ in counter
+                ),
+                dtype=np.int32,
+                count=n,
+            )
+        )
+        positions.append(np.fromiter((pos for _, pos in counter), np.int64, n))
+        counts.append(np.fromiter(counter.values(), np.int64, n))
+        offsets.append(offsets[-1] + n)
+    meta = {"labels": labels, "chroms": list(chrom_codes)}
+    arrays = {
+        "chroms": np.concatenate(chroms) if chroms else np.zeros(0, np.int32),
+        "positions": np.concatenate(positions) if positions else np.zeros(0, np.int64),
+        "counts": np.concatenate(counts) if counts else np.zeros(0, np.int64),
+        "offsets": np.array(offsets, dtype=np.int64),
+    }
+    return meta, arrays
+
+
+def arrays_to_counters(meta, arrays):
+    """Inverse of counters_to_arrays, yields (label, Counter)"""
+    names = meta["chroms"]
+    offsets = arrays["offsets"].tolist()
+    for i, label in enumerate(meta["labels"]):
+        start, end = offsets[i], offsets[i + 1]
+        chroms = [names[code] for code in arrays["chroms"][start:end].tolist()]
+        keys = zip(chroms, arrays["positions"][start:end].tolist())
+        counter = Counter()
+        dict.update(counter, zip(keys, arrays["counts"][start:end].tolist()))
+        yield label, counter
+
+
+def save_alignments(
+    store, key, protocol, alignments, read_length_counts, stage="alignments"
+):
+    groups = [
+        ([length, strand], alignments[length][strand])
+        for length in alignments
+        for strand in alignments[length]
+    ]
+    meta, arrays = counters_to_arrays(groups)
+    meta["protocol"] = protocol
+    meta["read_length_counts"] = [
+        [length, count] for length, count in read_length_counts.items()
+    ]
+    store.save(stage, key, meta, arrays)
+
+
+def load_alignments(store, key, stage="alignments"):
+    """
+    Parameters
+    ----------
+    stage: str
+           name the alignments were saved under
+
+    Returns
+    -------
+    checkpoint: (str, dict(dict(Counter)), dict)
+                (protocol, alignments, read_length_counts) as saved after
+                split_bam, None if there is no valid checkpoint
+    """
+    checkpoint = store.load(stage, key)
+    if checkpoint is None:
+        return None
+    meta, arrays = checkpoint
+    alignments = defaultdict(lambda: defaultdict(Counter))
+    for (length, strand), counter in arrays_to_counters(meta, arrays):
+        alignments[length][strand] = counter
+    read_length_counts = defaultdict(int)
+    for length, count in meta["read_length_counts"]:
+        read_length_counts[length] = count
+    return meta["protocol"], alignments, read_length_counts
+
+
+def save_merged_alignments(store, key, merged_alignments):
+    meta, arrays = counters_to_arrays(list(merged_alignments.items()))
+    store.save("merged_alignments", key, meta, arrays)
+
+
+def load_merged_alignments(store, key):
+    """
+    Returns
+    -------
+    merged_alignments: dict(Counter)
+                       as saved after merge_read_lengths, None if there is
+                       no valid checkpoint
+    """
+    checkpoint = store.load("merged_alignments", key)
+    if checkpoint is None:
+        return None
+    merged_alignments = defaultdict(Counter)
+    for strand, counter in arrays_to_counters(*checkpoint):
+        merged_alignments[strand] = counter
+    return merged_alignments
+
+
+def save_metagenes(store, key, metagenes, read_length_counts, sampling):
+    scores = []
+    arrays = {}
+    for length, (start, stop, ps_5p, valid_5p, ps_3p, valid_3p) in metagenes.items():
+        scores.append(
+            [length, float(ps_5p), int(valid_5p), float(ps_3p), int(valid_3p)]
+        )
+        arrays["{}_start_index".format(length)] = start.index.values
+        arrays["{}_start".format(length)] = start.values
+        arrays["{}_stop_index".format(length)] = stop.index.values
+        arrays["{}_stop".format(length)] = stop.values
+    meta = {
+        "scores": scores,
+        "read_length_counts": [
+            [length, count] for length, count in read_length_counts.items()
+        ],
+        "sampling": sampling,
+    }
+    store.save("metagenes", key, meta, arrays)
+
+
+def load_metagenes(store, key):
+    """
+    Returns
+    -------
+    checkpoint: (dict, dict, str)
+                (metagenes, read_length_counts, sampling) as saved after
+                metagene_coverage, None if there is no valid checkpoint
+    """
+    checkpoint = store.load("metagenes", key)
+    if checkpoint is None:
+        return None
+    meta, arrays = checkpoint
+    metagenes = {}
+    for length, ps_5p, valid_5p, ps_3p, valid_3p in meta["scores"]:
+        start = pd.Series(
+            arrays["{}_start".format(length)],
+            index=arrays["{}_start_index".format(length)],
+        )
+        stop = pd.Series(
+            arrays["{}_stop".format(length)],
+            index=arrays["{}_stop_index".format(length)],
+        )
+        metagenes[length] = (start, stop, ps_5p, valid_5p, ps_3p, valid_3p)
+    read_length_counts = defaultdict(int)
+    for length, count in meta["read_length_counts"]:
+        read_length_counts[length] = count
+    return metagenes, read_length_counts, meta["sampling"]
+
+
+def save_psite_offsets(store, key, psite_offsets):
+    meta = {
+        "psite_offsets": [
+            [length, int(offset)] for length, offset in psite_offsets.items()
+        ]
+    }
+    store.save("psite_offsets", key, meta, {})
+
+
+def load_psite_offsets(store, key):
+    """
+    Returns
+    -------
+    psite_offsets: dict
+                   as saved after align_metagenes, None if there is no
+                   valid checkpoint
+    """
+    checkpoint = store.load("psite_offsets", key)
+    if checkpoint is None:
+        return None
+    return OrderedDict(
+        (length, offset) for length, offset in checkpoint[0]["psite_offsets"]
+    )
+
+
+def detect_orfs_stage_keys(
+    bam,
+    ribotricer_index,
+    protocol,
+    read_lengths,
+    psite_offsets,
+    phase_score_cutoff,
+    metagene_max_orfs,
+    metagene_min_cds_reads,
+    windows=None,
+):
+    """Keys of the checkpointed detect-orfs stages, see detect_orfs.
+
+    Each key covers the inputs and parameters of its stage and, through
+    the parent key, of all the stages before it.
+
+    Returns
+    -------
+    keys: dict
+          key is the stage name, value is the stage key
+    """
+    index = index_fingerprint(ribotricer_index)
+    keys = {}
+    keys["alignments"] = stage_key(
+        "alignments",
+        None,
+        bam=file_fingerprint(bam),
+        protocol=protocol,
+        read_lengths=read_lengths,
+        windows=windows,
+        # the protocol is inferred from the annotated ORFs if not given
+        index=index if protocol is None else None,
+    )
+    keys["metagenes"] = stage_key(
+        "metagenes",
+        keys["alignments"],
+        index=index,
+        metagene_max_orfs=metagene_max_orfs,
+        metagene_min_cds_reads=metagene_min_cds_reads,
+    )
+    keys["psite_offsets"] = stage_key(
+        "psite_offsets",
+        keys["metagenes"],
+        phase_score_cutoff=phase_score_cutoff,
+        remove_nonperiodic=read_lengths is None,
+    )
+    keys["merged_alignments"] = stage_key(
+        "merged_alignments",
+        keys["psite_offsets"],
+        psite_offsets=(
+            None
+            if psite_offsets is None
+            else [[length, offset] for length, offset in psite_offsets.items()]
+        ),
+    )
+    return keys
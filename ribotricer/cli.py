@@ -15,31 +15,56 @@
 # GNU General Public License for more details.
 
 import click
+import itertools
 import os
 import sys
 
 from . import __version__
 from .common import _clean_input
+from .index import is_dedup_index
+from .index import is_sharded_index
+from .index import parse_regions
+from .index import shard_index
 from .const import CUTOFF
 from .const import MINIMUM_VALID_CODONS
 from .const import MINIMUM_VALID_CODONS_RATIO
 from .const import MINIMUM_READS_PER_CODON
 from .const import MINIMUM_DENSITY_OVER_ORF
 
+from .count_matrix import count_matrix
+from .count_matrix import detected_sample_names
+from .count_matrix import MATRIX_FORMATS
 from .count_orfs import count_orfs
 from .count_orfs import count_orfs_codon
+from .count_orfs import count_orfs_streaming
 from .detect_orfs import detect_orfs
 from .learn_cutoff import determine_cutoff_bam
 from .learn_cutoff import determine_cutoff_tsv
+from .low_memory import detect_orfs_low_memory
 
 from .orf_seq import orf_seq
+from .orf_seq import ORF_SEQ_FORMATS
 from .prepare_orfs import prepare_orfs
+from .prepare_orfs import transcript_models_path
+from .results import merge_results
+from .rethreshold import rethreshold
+from .samples import detect_orfs_samples
+from .samples import parse_sample_sheet
+from .samples import sample_names
 
 from click_help_colors import HelpColorsGroup
 
 CONTEXT_SETTINGS = dict(help_option_names=["-h", "--help"])
 
 
+def _parse_regions(region, chromosomes):
+    """Parse --region and --chromosomes options, exiting on invalid input"""
+    try:
+        return parse_regions(region, chromosomes)
+    except ValueError as e:
+        sys.exit("Error: {}".format(e))
+
+
 @click.group(
     cls=HelpColorsGroup, help_headers_color="yellow", help_options_color="green"
 )
@@ -82,8 +107,49 @@ def cli():
     help="Choose the most upstream start codon if multiple in frame ones exist",
     is_flag=True,
 )
+@click.option(
+    "--threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of processes to use for parsing the GTF file",
+)
+@click.option(
+    "--cache_dir",
+    default=None,
+    help=(
+        "Directory for caching the parsed GTF and transcript sequences.\n"
+        "Later runs with the same GTF and FASTA files reuse the cache"
+    ),
+)
+@click.option(
+    "--update_from",
+    default=None,
+    help=(
+        "Path to an index previously generated by prepare-orfs.\n"
+        "Only transcripts changed in the GTF file are searched again"
+    ),
+)
+@click.option(
+    "--dedup",
+    help=(
+        "Also write a deduplicated index storing ORFs with identical "
+        "genomic coordinates once, for faster detect-orfs"
+    ),
+    is_flag=True,
+)
 def prepare_orfs_cmd(
-    gtf, fasta, prefix, min_orf_length, start_codons, stop_codons, longest
+    gtf,
+    fasta,
+    prefix,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    threads,
+    cache_dir,
+    update_from,
+    dedup,
 ):
     if not os.path.isfile(gtf):
         sys.exit("Error: GTF file not found")
@@ -94,6 +160,20 @@ def prepare_orfs_cmd(
     if min_orf_length <= 0:
         sys.exit("Error: min ORF length at least to be 1")
 
+    if threads <= 0:
+        sys.exit("Error: threads at least to be 1")
+
+    if update_from is not None:
+        if not os.path.isfile(update_from):
+            sys.exit("Error: ribotricer index file to update from not found")
+        models_file = transcript_models_path(update_from)
+        if models_file is None or not os.path.isfile(models_file):
+            sys.exit("Error: transcript models of the index to update from not found")
+        if cache_dir is not None:
+            sys.exit(
+                "Error: --update_from and --cache_dir cannot be specified together"
+            )
+
     start_codons = set([x.strip().upper() for x in start_codons.strip().split(",")])
     if not start_codons:
         sys.exit("Error: start codons cannot be empty")
@@ -106,7 +186,19 @@ def prepare_orfs_cmd(
     if not all([len(x) == 3 and set(x) <= {"A", "C", "G", "T"} for x in stop_codons]):
         sys.exit("Error: invalid codon, only A, C, G, T allowed")
 
-    prepare_orfs(gtf, fasta, prefix, min_orf_length, start_codons, stop_codons, longest)
+    prepare_orfs(
+        gtf,
+        fasta,
+        prefix,
+        min_orf_length,
+        start_codons,
+        stop_codons,
+        longest,
+        threads,
+        cache_dir,
+        update_from,
+        dedup,
+    )
 
 
 ###################### detect-orfs function #########################################
@@ -115,7 +207,21 @@ def prepare_orfs_cmd(
     context_settings=CONTEXT_SETTINGS,
     help="Detect translating ORFs from BAM file",
 )
-@click.option("--bam", help="Path to BAM file", required=True)
+@click.option(
+    "--bam",
+    help=(
+        "Path to BAM file, or comma separated paths to BAM files of several "
+        "samples sharing the index"
+    ),
+)
+@click.option(
+    "--sample_sheet",
+    default=None,
+    help=(
+        "Tab separated file with columns sample and bam, to be used instead "
+        "of --bam for several samples"
+    ),
+)
 @click.option(
     "--ribotricer_index",
     help=(
@@ -196,8 +302,115 @@ def prepare_orfs_cmd(
     help=("Whether output all ORFs including those " "non-translating ones"),
     is_flag=True,
 )
+@click.option(
+    "--region",
+    default=None,
+    help=(
+        "Comma separated regions as chrom:start-end (1-based, inclusive) "
+        "or chrom; only ORFs starting within them are used. "
+        "Requires --read_lengths and --psite_offsets"
+    ),
+)
+@click.option(
+    "--chromosomes",
+    default=None,
+    help=(
+        "Comma separated chromosomes; only ORFs on them are used. "
+        "Requires --read_lengths and --psite_offsets"
+    ),
+)
+@click.option(
+    "--metagene_max_orfs",
+    type=int,
+    default=None,
+    help=(
+        "Use only this many CDSs with the most reads for metagene profiles "
+        "and P-site offset inference"
+    ),
+)
+@click.option(
+    "--metagene_min_cds_reads",
+    type=int,
+    default=0,
+    show_default=True,
+    help="Minimum number of reads for a CDS to be used for metagene profiles",
+)
+@click.option(
+    "--coverage_format",
+    type=click.Choice(["wig", "bedgraph", "bigwig", "none"]),
+    default="wig",
+    show_default=True,
+    help="Format of the exported coverage after P-site shifting",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice(["tsv", "parquet", "npz"]),
+    default="tsv",
+    show_default=True,
+    help=(
+        "Format of the detected ORFs; parquet and npz store the profiles "
+        "as one concatenated array"
+    ),
+)
+@click.option(
+    "--compress_output",
+    help="Whether to gzip the detected ORFs (tsv output only)",
+    is_flag=True,
+)
+@click.option(
+    "--checkpoint",
+    help="Save the output of each expensive stage under {prefix}_checkpoints",
+    is_flag=True,
+)
+@click.option(
+    "--resume",
+    help=(
+        "Skip the stages whose checkpoint matches the inputs and parameters "
+        "(implies --checkpoint)"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of samples read in parallel",
+)
+@click.option(
+    "--phase_score_matrix",
+    help=(
+        "With several samples, also write the phase scores of all ORFs in "
+        "all samples to {prefix}_phase_scores.tsv"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "--low_memory",
+    help=(
+        "Hold the reads of one chromosome at a time, spilling them to "
+        "temporary files next to the outputs"
+    ),
+    is_flag=True,
+)
+@click.option(
+    "--features",
+    help=(
+        "ORF types to score separated with comma, such as annotated,uORF; "
+        "all types if not given"
+    ),
+)
+@click.option(
+    "--gene_counts",
+    help=(
+        "Also write the read counts of the genes of the reported ORFs to "
+        "{prefix}_gene_counts.tsv, as count-orfs would"
+    ),
+    is_flag=True,
+)
 def detect_orfs_cmd(
     bam,
+    sample_sheet,
     ribotricer_index,
     prefix,
     stranded,
@@ -209,9 +422,34 @@ def detect_orfs_cmd(
     min_valid_codons_ratio,
     min_read_density,
     report_all,
+    region,
+    chromosomes,
+    metagene_max_orfs,
+    metagene_min_cds_reads,
+    coverage_format,
+    output_format,
+    compress_output,
+    checkpoint,
+    resume,
+    threads,
+    phase_score_matrix,
+    low_memory,
+    features,
+    gene_counts,
 ):
-    if not os.path.isfile(bam):
+    if (bam is None) == (sample_sheet is None):
+        sys.exit("Error: exactly one of --bam and --sample_sheet is required")
+    try:
+        if sample_sheet is not None:
+            samples = parse_sample_sheet(sample_sheet)
+        else:
+            samples = sample_names([x.strip() for x in bam.split(",") if x.strip()])
+    except (OSError, ValueError) as e:
+        sys.exit("Error: {}".format(e))
+    if not all(os.path.isfile(path) for _, path in samples):
         sys.exit("Error: BAM file not found")
+    if threads <= 0:
+        sys.exit("Error: threads at least to be 1")
 
     if not os.path.isfile(ribotricer_index):
         sys.exit("Error: ribotricer index file not found")
@@ -238,10 +476,83 @@ def detect_orfs_cmd(
         if not all(x > y for (x, y) in zip(read_lengths, psite_offsets)):
             sys.exit("Error: P-site offset must be smaller than read length")
         psite_offsets = dict(list(zip(read_lengths, psite_offsets)))
+    if metagene_max_orfs is not None and metagene_max_orfs <= 0:
+        sys.exit("Error: metagene_max_orfs must be positive")
+    if metagene_min_cds_reads < 0:
+        sys.exit("Error: metagene_min_cds_reads must be >= 0")
+    if features is not None:
+        features = set(x.strip() for x in features.strip().split(",") if x.strip())
+        if not features:
+            sys.exit("Error: features cannot be empty")
     if stranded == "yes":
         stranded = "forward"
+    regions = _parse_regions(region, chromosomes)
+    if regions is not None and psite_offsets is None:
+        # offsets learned from the reads of a region would differ between jobs
+        sys.exit(
+            "Error: --region and --chromosomes require --read_lengths and "
+            "--psite_offsets"
+        )
+    if low_memory:
+        if sample_sheet is not None or len(samples) > 1:
+            sys.exit("Error: --low_memory only supports a single sample")
+        if checkpoint or resume:
+            sys.exit(
+                "Error: --low_memory cannot be combined with --checkpoint or --resume"
+            )
+        detect_orfs_low_memory(
+            samples[0][1],
+            ribotricer_index,
+            prefix,
+            stranded,
+            read_lengths,
+            psite_offsets,
+            phase_score_cutoff,
+            min_valid_codons,
+            min_reads_per_codon,
+            min_valid_codons_ratio,
+            min_read_density,
+            report_all,
+            regions,
+            metagene_max_orfs,
+            metagene_min_cds_reads,
+            coverage_format,
+            output_format,
+            compress_output,
+            features,
+            gene_counts,
+        )
+        return
+    if sample_sheet is not None or len(samples) > 1:
+        detect_orfs_samples(
+            samples,
+            ribotricer_index,
+            prefix,
+            stranded,
+            read_lengths,
+            psite_offsets,
+            phase_score_cutoff,
+            min_valid_codons,
+            min_reads_per_codon,
+            min_valid_codons_ratio,
+            min_read_density,
+            report_all,
+            regions,
+            metagene_max_orfs,
+            metagene_min_cds_reads,
+            coverage_format,
+            output_format,
+            compress_output,
+            checkpoint,
+            resume,
+            threads,
+            phase_score_matrix,
+            features,
+            gene_counts,
+        )
+        return
     detect_orfs(
-        bam,
+        samples[0][1],
         ribotricer_index,
         prefix,
         stranded,
@@ -253,7 +564,152 @@ def detect_orfs_cmd(
         min_valid_codons_ratio,
         min_read_density,
         report_all,
+        regions,
+        metagene_max_orfs,
+        metagene_min_cds_reads,
+        coverage_format,
+        output_format,
+        compress_output,
+        checkpoint,
+        resume,
+        features,
+        gene_counts,
+    )
+
+
+###################### rethreshold function #########################################
+@cli.command(
+    "rethreshold",
+    context_settings=CONTEXT_SETTINGS,
+    help="Recompute the status of detected ORFs for new cutoffs",
+)
+@click.option(
+    "--detected_orfs",
+    help=(
+        "Path to the detected orfs file generated using ribotricer detect-orfs "
+        "with --report_all, or to a scored table saved by rethreshold"
+    ),
+    required=True,
+)
+@click.option("--prefix", help="Prefix to output file", required=True)
+@click.option(
+    "--phase_score_cutoff",
+    default=str(CUTOFF),
+    show_default=True,
+    help="Comma separated phase score cutoffs",
+)
+@click.option(
+    "--min_valid_codons",
+    default=str(MINIMUM_VALID_CODONS),
+    show_default=True,
+    help="Comma separated minimum numbers of codons with non-zero reads",
+)
+@click.option(
+    "--min_reads_per_codon",
+    default=str(MINIMUM_READS_PER_CODON),
+    show_default=True,
+    help="Comma separated minimum numbers of reads per codon",
+)
+@click.option(
+    "--min_valid_codons_ratio",
+    default=str(MINIMUM_VALID_CODONS_RATIO),
+    show_default=True,
+    help="Comma separated minimum ratios of codons with non-zero reads",
+)
+@click.option(
+    "--min_read_density",
+    default=str(MINIMUM_DENSITY_OVER_ORF),
+    show_default=True,
+    help="Comma separated minimum read densities (total_reads/length)",
+)
+@click.option(
+    "--report_all",
+    help=("Whether output all ORFs including those " "non-translating ones"),
+    is_flag=True,
+)
+@click.option(
+    "--save_scored_table",
+    help=(
+        "Whether to save a table of the scores and profiles to "
+        "{prefix}_scored_table.npz, which can be passed as --detected_orfs to "
+        "later runs"
+    ),
+    is_flag=True,
+)
+def rethreshold_cmd(
+    detected_orfs,
+    prefix,
+    phase_score_cutoff,
+    min_valid_codons,
+    min_reads_per_codon,
+    min_valid_codons_ratio,
+    min_read_density,
+    report_all,
+    save_scored_table,
+):
+    if not os.path.isfile(detected_orfs):
+        sys.exit("Error: detected orfs file not found")
+
+    cutoffs = []
+    for name, value, dtype in [
+        ("phase_score_cutoff", phase_score_cutoff, float),
+        ("min_valid_codons", min_valid_codons, int),
+        ("min_reads_per_codon", min_reads_per_codon, int),
+        ("min_valid_codons_ratio", min_valid_codons_ratio, float),
+        ("min_read_density", min_read_density, float),
+    ]:
+        try:
+            cutoffs.append([dtype(x) for x in _clean_input(value)])
+        except ValueError:
+            sys.exit("Error: cannot convert {} into numbers".format(name))
+        if not cutoffs[-1]:
+            sys.exit("Error: {} is empty".format(name))
+    # every combination of the given cutoffs is evaluated
+    cutoff_sets = list(itertools.product(*cutoffs))
+    n_translating = rethreshold(
+        detected_orfs, prefix, cutoff_sets, report_all, save_scored_table
     )
+    for cutoff_set, n in zip(cutoff_sets, n_translating):
+        print("{}\t{}".format("\t".join(map(str, cutoff_set)), n))
+
+
+###################### merge-results function #######################################
+@cli.command(
+    "merge-results",
+    context_settings=CONTEXT_SETTINGS,
+    help="Merge detected ORFs of disjoint regions in the order of a full run",
+)
+@click.option(
+    "--detected_orfs",
+    help=(
+        "Comma separated paths to the detected orfs files generated using "
+        "ribotricer detect-orfs with --region or --chromosomes"
+    ),
+    required=True,
+)
+@click.option(
+    "--ribotricer_index",
+    help="Path to the index file used for detecting the ORFs",
+    required=True,
+)
+@click.option(
+    "--out",
+    help="Path to output file, in the format of the detected orfs",
+    required=True,
+)
+def merge_results_cmd(detected_orfs, ribotricer_index, out):
+    detected_orfs = _clean_input(detected_orfs)
+    if not detected_orfs:
+        sys.exit("Error: no detected orfs file given")
+    if not all(os.path.isfile(path) for path in detected_orfs):
+        sys.exit("Error: detected orfs file not found")
+    if not os.path.isfile(ribotricer_index):
+        sys.exit("Error: ribotricer index file not found")
+    try:
+        n_rows = merge_results(detected_orfs, ribotricer_index, out)
+    except ValueError as e:
+        sys.exit("Error: {}".format(e))
+    print("merged {} ORFs from {} files".format(n_rows, len(detected_orfs)))
 
 
 ###################### count-orfs function #########################################
@@ -285,7 +741,37 @@ def detect_orfs_cmd(
     help=("Whether output all ORFs including those " "non-translating ones"),
     is_flag=True,
 )
-def count_orfs_cmd(ribotricer_index, detected_orfs, features, out, report_all):
+@click.option(
+    "--region",
+    default=None,
+    help=(
+        "Comma separated regions as chrom:start-end (1-based, inclusive) "
+        "or chrom; only ORFs starting within them are used"
+    ),
+)
+@click.option(
+    "--chromosomes",
+    default=None,
+    help="Comma separated chromosomes; only ORFs on them are used",
+)
+@click.option(
+    "--streaming",
+    help=(
+        "Read the index and the detected orfs side by side, holding one gene "
+        "at a time; genes are written in index order instead of sorted"
+    ),
+    is_flag=True,
+)
+def count_orfs_cmd(
+    ribotricer_index,
+    detected_orfs,
+    features,
+    out,
+    report_all,
+    region,
+    chromosomes,
+    streaming,
+):
 
     if not os.path.isfile(ribotricer_index):
         sys.exit("Error: ribotricer index file not found")
@@ -295,7 +781,146 @@ def count_orfs_cmd(ribotricer_index, detected_orfs, features, out, report_all):
 
     features = set(x.strip() for x in features.strip().split(","))
 
-    count_orfs(ribotricer_index, detected_orfs, features, out, report_all)
+    if is_dedup_index(ribotricer_index):
+        sys.exit("Error: count-orfs requires the full (not deduplicated) index")
+
+    regions = _parse_regions(region, chromosomes)
+
+    if streaming:
+        if regions is not None:
+            sys.exit(
+                "Error: --streaming cannot be combined with --region or --chromosomes"
+            )
+        try:
+            count_orfs_streaming(
+                ribotricer_index, detected_orfs, features, out, report_all
+            )
+        except ValueError as e:
+            sys.exit("Error: {}".format(e))
+        return
+    count_orfs(ribotricer_index, detected_orfs, features, out, report_all, regions)
+
+
+###################### count-matrix function #########################################
+@cli.command(
+    "count-matrix",
+    context_settings=CONTEXT_SETTINGS,
+    help="Count reads at gene level in several samples into one matrix",
+)
+@click.option(
+    "--ribotricer_index",
+    help=(
+        "Path to the index file of ribotricer\n"
+        "This file should be generated using ribotricer prepare-orfs"
+    ),
+    required=True,
+)
+@click.option(
+    "--detected_orfs",
+    default=None,
+    help=(
+        "Comma separated detected orfs files of the samples, generated using "
+        "ribotricer detect-orfs; sample names are taken from the file names"
+    ),
+)
+@click.option(
+    "--sample_sheet",
+    default=None,
+    help=(
+        "Tab separated file with columns sample and detected_orfs, to be used "
+        "instead of --detected_orfs"
+    ),
+)
+@click.option("--features", help="ORF types separated with comma", required=True)
+@click.option("--prefix", help="Prefix to output file", required=True)
+@click.option(
+    "--report_all",
+    help=("Whether output all ORFs including those " "non-translating ones"),
+    is_flag=True,
+)
+@click.option(
+    "--region",
+    default=None,
+    help=(
+        "Comma separated regions as chrom:start-end (1-based, inclusive) "
+        "or chrom; only ORFs starting within them are used"
+    ),
+)
+@click.option(
+    "--chromosomes",
+    default=None,
+    help="Comma separated chromosomes; only ORFs on them are used",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of samples counted in parallel",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice(MATRIX_FORMATS),
+    default="tsv",
+    show_default=True,
+    help="Format of {prefix}_count_matrix",
+)
+@click.option(
+    "--sparse",
+    help="Write the non-zero counts only",
+    is_flag=True,
+)
+def count_matrix_cmd(
+    ribotricer_index,
+    detected_orfs,
+    sample_sheet,
+    features,
+    prefix,
+    report_all,
+    region,
+    chromosomes,
+    threads,
+    output_format,
+    sparse,
+):
+    if (detected_orfs is None) == (sample_sheet is None):
+        sys.exit("Error: exactly one of --detected_orfs and --sample_sheet is required")
+    try:
+        if sample_sheet is not None:
+            samples = parse_sample_sheet(sample_sheet, "detected_orfs")
+        else:
+            samples = detected_sample_names(
+                [x.strip() for x in detected_orfs.split(",") if x.strip()]
+            )
+    except (OSError, ValueError) as e:
+        sys.exit("Error: {}".format(e))
+    if not samples:
+        sys.exit("Error: no detected orfs file given")
+    if not all(os.path.isfile(path) for _, path in samples):
+        sys.exit("Error: detected orfs file not found")
+    if threads <= 0:
+        sys.exit("Error: threads at least to be 1")
+
+    if not os.path.isfile(ribotricer_index):
+        sys.exit("Error: ribotricer index file not found")
+
+    if is_dedup_index(ribotricer_index):
+        sys.exit("Error: count-matrix requires the full (not deduplicated) index")
+
+    features = set(x.strip() for x in features.strip().split(","))
+    regions = _parse_regions(region, chromosomes)
+
+    count_matrix(
+        ribotricer_index,
+        samples,
+        features,
+        prefix,
+        report_all,
+        regions,
+        threads,
+        output_format,
+        sparse,
+    )
 
 
 ###################### count-orfs-codon function #########################################
@@ -321,7 +946,14 @@ def count_orfs_cmd(ribotricer_index, detected_orfs, features, out, report_all):
     required=True,
 )
 @click.option("--features", help="ORF types separated with comma", required=True)
-@click.option("--ribotricer_index_fasta", help="Path to ORF seq file", required=True)
+@click.option(
+    "--ribotricer_index_fasta",
+    help=(
+        "Path to ORF seq file, generated using ribotricer orfs-seq as tsv "
+        "or as indexed fasta"
+    ),
+    required=True,
+)
 @click.option("--prefix", help="Prefix for output files", required=True)
 @click.option(
     "--report_all",
@@ -377,14 +1009,114 @@ def count_orfs_codon_cmd(
     "--protein", help="Output protein sequence instead of nucleotide", is_flag=True
 )
 @click.option("--saveto", help="Path to output file", required=True)
-def orf_seq_cmd(ribotricer_index, fasta, saveto, protein):
+@click.option(
+    "--region",
+    default=None,
+    help=(
+        "Comma separated regions as chrom:start-end (1-based, inclusive) "
+        "or chrom; only ORFs starting within them are used"
+    ),
+)
+@click.option(
+    "--chromosomes",
+    default=None,
+    help="Comma separated chromosomes; only ORFs on them are used",
+)
+@click.option(
+    "--threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Number of chromosomes processed in parallel",
+)
+@click.option(
+    "--output_format",
+    type=click.Choice(ORF_SEQ_FORMATS),
+    default="tsv",
+    show_default=True,
+    help="Format of the output; fasta is written with a .fai index",
+)
+@click.option(
+    "--compress_output",
+    help="bgzip compress the fasta output, with a .gzi index",
+    is_flag=True,
+)
+def orf_seq_cmd(
+    ribotricer_index,
+    fasta,
+    saveto,
+    protein,
+    region,
+    chromosomes,
+    threads,
+    output_format,
+    compress_output,
+):
     if not os.path.isfile(ribotricer_index):
         sys.exit("Error: ribotricer index file not found")
 
     if not os.path.isfile(fasta):
         sys.exit("Error: fasta file not found")
 
-    orf_seq(ribotricer_index, fasta, saveto, protein)
+    if is_dedup_index(ribotricer_index):
+        sys.exit("Error: orfs-seq requires the full (not deduplicated) index")
+
+    if threads <= 0:
+        sys.exit("Error: threads at least to be 1")
+
+    if compress_output and output_format != "fasta":
+        sys.exit("Error: --compress_output requires --output_format fasta")
+
+    regions = _parse_regions(region, chromosomes)
+
+    orf_seq(
+        ribotricer_index,
+        fasta,
+        saveto,
+        protein,
+        regions,
+        threads,
+        output_format,
+        compress_output,
+    )
+
+
+###################### shard-index function #########################################
+@cli.command(
+    "shard-index",
+    context_settings=CONTEXT_SETTINGS,
+    help="Split ribotricer's index into shards per chromosome or genomic block",
+)
+@click.option(
+    "--ribotricer_index",
+    help=(
+        "Path to the index file of ribotricer\n"
+        "This file should be generated using ribotricer prepare-orfs"
+    ),
+    required=True,
+)
+@click.option("--outdir", help="Directory to write shards to", required=True)
+@click.option(
+    "--block_size",
+    type=int,
+    default=None,
+    help=(
+        "Split chromosomes further into blocks of this many nts.\n"
+        "If not provided, one shard per chromosome is written"
+    ),
+)
+def shard_index_cmd(ribotricer_index, outdir, block_size):
+    if not os.path.isfile(ribotricer_index):
+        sys.exit("Error: ribotricer index file not found")
+
+    if is_dedup_index(ribotricer_index) or is_sharded_index(ribotricer_index):
+        sys.exit("Error: only the full index generated by prepare-orfs can be sharded")
+
+    if block_size is not None and block_size <= 0:
+        sys.exit("Error: block size at least to be 1")
+
+    manifest = shard_index(ribotricer_index, outdir, block_size)
+    print("Manifest of the sharded index: {}".format(manifest))
 
 
 ###################### learn-cutoff function #########################################
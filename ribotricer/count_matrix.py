@@ -0,0 +1,225 @@
+"""Gene by sample read count matrix of several detect-orfs outputs"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from multiprocessing import Pool
+import datetime
+import os
+
+import numpy as np
+
+from .count_orfs import gene_read_counts
+from .count_orfs import load_orf_index
+from .results import OUTPUT_FORMATS
+
+MATRIX_FORMATS = ["tsv", "npz"]
+DETECTED_SUFFIX = "_translating_ORFs"
+
+# (orf_index, features, report_all, regions) shared with the counting workers
+_counting = None
+
+
+def detected_sample_names(detected_orfs):
+    """Sample names derived from the detect-orfs output names.
+
+    Parameters
+    ----------
+    detected_orfs: List[str]
+                   Paths to detect-orfs outputs
+
+    Returns
+    -------
+    samples: List[(str, str)]
+             (sample, detected_orfs) for each output
+    """
+    names = []
+    for path in detected_orfs:
+        name = os.path.basename(path)
+        if name.endswith(".gz"):
+            name = name[: -len(".gz")]
+        for output_format in OUTPUT_FORMATS:
+            if name.endswith(".{}".format(output_format)):
+                name = name[: -len(output_format) - 1]
+                break
+        if name.endswith(DETECTED_SUFFIX):
+            name = name[: -len(DETECTED_SUFFIX)]
+        names.append(name)
+    if len(set(names)) != len(names):
+        raise ValueError("detected orfs file names are not unique, use a sample sheet")
+    return list(zip(names, detected_orfs))
+
+
+def matrix_path(prefix, output_format="tsv"):
+    return "{}_count_matrix.{}".format(prefix, output_format)
+
+
+def _init_worker(counting):
+    global _counting
+    _counting = counting
+
+
+def _count_sample(task):
+    """Read counts of each gene in the output of one sample"""
+    sample, detected_orfs = task
+    orf_index, features, report_all, regions = _counting
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "started counting sample {}".format(sample)
+        )
+    )
+    read_counts = gene_read_counts(
+        orf_index, detected_orfs, features, report_all, regions
+    )
+    return {gene: count for gene, (count, length) in read_counts.items()}
+
+
+def write_count_matrix(saveto, genes, samples, counts, output_format, sparse=False):
+    """
+    Parameters
+    ----------
+    saveto: str
+            Path to output file
+    genes: List[(str, str)]
+           (gene_id, gene_name) of each row
+    samples: List[str]
+             name of each column
+    counts: array
+            genes x samples read counts
+    output_format: str
+                   {'tsv', 'npz'}
+    sparse: bool
+            Whether to write the non-zero counts only: one
+            gene_id, sample, count line each in tsv, or the arrays of a
+            CSR matrix in npz, which scipy.sparse.load_npz can read
+    """
+    gene_ids = [gene_id for gene_id, _ in genes]
+    if output_format == "npz":
+        labels = {
+            "gene_id": np.array(gene_ids, dtype=str),
+            "gene_name": np.array([gene_name for _, gene_name in genes], dtype=str),
+            "samples": np.array(samples, dtype=str),
+        }
+        if not sparse:
+            np.savez_compressed(saveto, counts=counts, **labels)
+            return
+        rows, columns = np.nonzero(counts)
+        np.savez_compressed(
+            saveto,
+            format=np.array(b"csr"),
+            shape=np.array(counts.shape),
+            data=counts[rows, columns],
+            indices=columns,
+            indptr=np.searchsorted(rows, np.arange(len(genes) + 1)),
+            **labels
+        )
+        return
+    with open(saveto, "w") as output:
+        if sparse:
+            output.write("gene_id\tsample\tcount\n")
+            rows, columns = np.nonzero(counts)
+            for i, j, count in zip(
+                rows.tolist(), columns.tolist(), counts[rows, columns].tolist()
+            ):
+                output.write("{}\t{}\t{}\n".format(gene_ids[i], samples[j], count))
+            return
+        output.write("\t".join(["gene_id"] + samples) + "\n")
+        for gene_id, row in zip(gene_ids, counts.tolist()):
+            output.write("\t".join(map(str, [gene_id] + row)) + "\n")
+
+
+def count_matrix(
+    ribotricer_index,
+    samples,
+    features,
+    prefix,
+    report_all=False,
+    regions=None,
+    threads=1,
+    output_format="tsv",
+    sparse=False,
+):
+    """Count reads at gene level in several detect-orfs outputs.
+
+    The index is parsed once and shared with the worker processes, each
+    counting one sample as count-orfs would. Genes missing from a sample
+    have a count of 0.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file generated by ribotricer prepare_orfs
+                      or to the manifest of a sharded index
+    samples: List[(str, str)]
+             (sample, detected_orfs) for each sample
+    features: set
+              set of ORF types, such as {annotated}
+    prefix: str
+            prefix for output file
+    report_all: bool
+                if True, nontranslating ORFs are counted as well
+    regions: dict
+             if given, only ORFs starting within these regions are counted,
+             see index.parse_regions
+    threads: int
+             Number of samples counted in parallel
+    output_format: str
+                   {'tsv', 'npz'}
+    sparse: bool
+            Whether to write the non-zero counts only, see write_count_matrix
+
+    Returns
+    -------
+    saveto: str
+            Path to the count matrix
+    """
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ... started loading ribotricer index file"))
+    orf_index = load_orf_index(ribotricer_index, features, regions)
+    counting = (orf_index, features, report_all, regions)
+    if threads > 1:
+        with Pool(
+            min(threads, len(samples)), initializer=_init_worker, initargs=(counting,)
+        ) as pool:
+            sample_counts = pool.map(_count_sample, samples, chunksize=1)
+    else:
+        _init_worker(counting)
+        sample_counts = [_count_sample(task) for task in samples]
+        _init_worker(None)
+
+    genes = sorted(set(gene for counts in sample_counts for gene in counts))
+    rows = {gene: i for i, gene in enumerate(genes)}
+    counts = np.zeros((len(genes), len(samples)), dtype=np.int64)
+    for j, sample_count in enumerate(sample_counts):
+        for gene, count in sample_count.items():
+            counts[rows[gene], j] = count
+    saveto = matrix_path(prefix, output_format)
+    write_count_matrix(
+        saveto,
+        genes,
+        [sample for sample, _ in samples],
+        counts,
+        output_format,
+        sparse,
+    )
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "wrote the counts of {} genes in {} samples to {}".format(
+                len(genes), len(samples), saveto
+            ),
+        )
+    )
+    return saveto
@@ -14,19 +14,32 @@
 # GNU General Public License for more details.
 
 from collections import defaultdict
-from textwrap import wrap
+from .index import iter_index_lines
 from .orf import ORF
+from .orf_seq import CODONS
+from .orf_seq import IndexedOrfSeqs
+from .orf_seq import is_orf_fasta
+from .orf_seq import NUCLEOTIDE_CODES
+from .results import iter_detected_orfs
 
 import numpy as np
 import pandas as pd
 
 
-def count_orfs(ribotricer_index, detected_orfs, features, outfile, report_all=False):
+def count_orfs(
+    ribotricer_index,
+    detected_orfs,
+    features,
+    outfile,
+    report_all=False,
+    regions=None,
+):
     """
     Parameters
     ----------
     ribotricer_index: str
                       Path to the index file generated by ribotricer prepare_orfs
+                      or to the manifest of a sharded index
     detected_orfs: str
                    Path to the detected orfs file generated by ribotricer detect_orfs
     features: set
@@ -35,49 +48,370 @@ def count_orfs(ribotricer_index, detected_orfs, features, outfile, report_all=Fa
             prefix for output file
     report_all: bool
                 if True, all coverages will be exported
+    regions: dict
+             if given, only ORFs starting within these regions are counted,
+             see index.parse_regions
     """
-    orf_index = {}
-    read_counts = defaultdict(dict)
-    with open(ribotricer_index, "r") as fin:
-        # Skip header
-        fin.readline()
-        for line in fin:
-            orf = ORF.from_string(line)
-            if orf.category in features:
-                orf_index[orf.oid] = orf
-    with open(detected_orfs, "r") as fin:
-        # Skip header
-        fin.readline()
-        for line in fin:
-            fields = line.strip().split("\t")
-            oid, otype, status = fields[:3]
-            gene_id, gene_name, gene_type = fields[11:14]
-            chrom, strand, start_codon, profile = fields[14:]
-            if otype in features:
-                # do not output 'nontranslating' events unless report_all is set
-                if status != "nontranslating" or report_all:
-                    intervals = orf_index[oid].intervals
-                    coor = [x for iv in intervals for x in range(iv.start, iv.end + 1)]
-                    if strand == "-":
-                        coor = coor[::-1]
-                    profile_stripped = profile.strip()[1:-1].split(", ")
-                    profile = list()
-                    if profile_stripped[0]:
-                        profile = list(map(int, profile_stripped))
-                    for pos, cov in zip(coor, profile):
-                        if pos not in read_counts[gene_id, gene_name]:
-                            read_counts[gene_id, gene_name][pos] = cov
+    orf_index = load_orf_index(ribotricer_index, features, regions)
+    read_counts = gene_read_counts(
+        orf_index, detected_orfs, features, report_all, regions
+    )
 
     # Output count table
     with open(outfile, "w") as fout:
         fout.write("gene_id\tcount\tlength\n")
         for gene_id, gene_name in sorted(read_counts):
-            values = read_counts[gene_id, gene_name].values()
-            length = len(values)
-            total = sum(values)
+            total, length = read_counts[gene_id, gene_name]
             fout.write("{}\t{}\t{}\n".format(gene_id, total, length))
 
 
+def count_orfs_streaming(
+    ribotricer_index, detected_orfs, features, outfile, report_all=False
+):
+    """count_orfs holding the ORFs of one gene at a time.
+
+    The detected ORFs are in the order of the index, so both are read
+    side by side. A first pass over the index finds the last ORF of each
+    gene, as the ORFs of a gene are not adjacent in the index (annotated
+    ORFs come first); a gene is counted and written as soon as its last ORF
+    is passed. Genes are thus written in the order of their last ORF in the
+    index instead of being sorted, with the same counts and lengths as
+    count_orfs.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file generated by ribotricer prepare_orfs
+                      or to the manifest of a sharded index, the one used
+                      to detect the ORFs
+    detected_orfs: str
+                   Path to the detected orfs file generated by ribotricer detect_orfs
+    features: set
+              set of ORF types, such as {annotated}
+    outfile: str
+             Path to output file
+    report_all: bool
+                if True, all coverages will be exported
+    """
+    # gene whose last ORF is at each row of the index
+    last_rows = {}
+    for row, line in enumerate(iter_index_lines(ribotricer_index, features=features)):
+        fields = line.split("\t", 6)
+        last_rows[fields[4], fields[5]] = row
+    gene_ends = {row: gene for gene, row in last_rows.items()}
+    del last_rows
+
+    index_lines = enumerate(iter_index_lines(ribotricer_index, features=features))
+    # (intervals, strand, profile) of the counted ORFs of the open genes
+    gene_orfs = defaultdict(list)
+    with open(outfile, "w") as fout:
+        fout.write("gene_id\tcount\tlength\n")
+
+        def finish(row):
+            gene = gene_ends.get(row)
+            if gene in gene_orfs:
+                total, length = gene_profile_counts(gene_orfs.pop(gene))
+                fout.write("{}\t{}\t{}\n".format(gene[0], total, length))
+
+        for fields, profile in iter_detected_orfs(detected_orfs, arrays=True):
+            oid, otype, status = fields[:3]
+            gene_id, gene_name, gene_type = fields[11:14]
+            chrom, strand, start_codon = fields[14:]
+            if otype not in features:
+                continue
+            # skip the ORFs of the index missing from the detected ORFs
+            for row, line in index_lines:
+                if line.split("\t", 1)[0] == oid:
+                    break
+                finish(row)
+            else:
+                raise ValueError(
+                    "ORF {} not found in the index, or not in the order "
+                    "of the index".format(oid)
+                )
+            # do not output 'nontranslating' events unless report_all is set
+            if status != "nontranslating" or report_all:
+                intervals = ORF.from_string(line).intervals
+                gene_orfs[gene_id, gene_name].append((intervals, strand, profile))
+            finish(row)
+        for row, _ in index_lines:
+            finish(row)
+
+
+def load_orf_index(ribotricer_index, features, regions=None):
+    """
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file generated by ribotricer prepare_orfs
+                      or to the manifest of a sharded index
+    features: set
+              set of ORF types, such as {annotated}
+    regions: dict
+             if given, only ORFs starting within these regions are kept,
+             see index.parse_regions
+
+    Returns
+    -------
+    orf_index: dict
+               key is the ORF ID, value is the ORF, for ORFs of the features
+    """
+    orf_index = {}
+    for line in iter_index_lines(ribotricer_index, regions):
+        orf = ORF.from_string(line)
+        if orf.category in features:
+            orf_index[orf.oid] = orf
+    return orf_index
+
+
+def gene_read_counts(
+    orf_index, detected_orfs, features, report_all=False, regions=None
+):
+    """Read counts of each gene in one detect-orfs output.
+
+    Parameters
+    ----------
+    orf_index: dict
+               as returned by load_orf_index
+    detected_orfs: str
+                   Path to the detected orfs file generated by ribotricer detect_orfs
+    features: set
+              set of ORF types, such as {annotated}
+    report_all: bool
+                if True, nontranslating ORFs are counted as well
+    regions: dict
+             regions orf_index was restricted to, if any
+
+    Returns
+    -------
+    read_counts: dict
+                 key is (gene_id, gene_name), value is (count, length)
+    """
+    # (intervals, strand, profile) of the counted ORFs of each gene
+    gene_orfs = defaultdict(list)
+    for fields, profile in iter_detected_orfs(detected_orfs, arrays=True):
+        oid, otype, status = fields[:3]
+        gene_id, gene_name, gene_type = fields[11:14]
+        chrom, strand, start_codon = fields[14:]
+        if regions is not None and oid not in orf_index:
+            continue
+        if otype in features:
+            # do not output 'nontranslating' events unless report_all is set
+            if status != "nontranslating" or report_all:
+                gene_orfs[gene_id, gene_name].append(
+                    (orf_index[oid].intervals, strand, profile)
+                )
+    return {gene: gene_profile_counts(orfs) for gene, orfs in gene_orfs.items()}
+
+
+def gene_profile_counts(orfs):
+    """Read count and length of a gene over the union of its ORFs.
+
+    Each position is counted once, with the value of the first ORF
+    whose profile covers it.
+
+    Parameters
+    ----------
+    orfs: List[(List[Interval], str, array)]
+          intervals, strand and profile of each ORF of the gene
+
+    Returns
+    -------
+    total: int
+           reads summed over the covered positions
+    length: int
+            number of covered positions
+    """
+    starts, ends = union_intervals(
+        [(iv.start, iv.end) for intervals, _, _ in orfs for iv in intervals]
+    )
+    offsets = np.concatenate([[0], np.cumsum(ends - starts + 1)])
+    # value of each position of the union, -1 until an ORF covers it
+    values = np.full(offsets[-1], -1, dtype=np.int64)
+    for intervals, strand, profile in orfs:
+        length = sum(iv.end - iv.start + 1 for iv in intervals)
+        n = min(length, len(profile))
+        # profile in genomic order, the positions beyond its end left at -1
+        genomic = np.full(length, -1, dtype=np.int64)
+        if strand == "-":
+            genomic[length - n :] = profile[:n][::-1]
+        else:
+            genomic[:n] = profile[:n]
+        first = 0
+        for iv in intervals:
+            size = iv.end - iv.start + 1
+            block = np.searchsorted(starts, iv.start, side="right") - 1
+            dest = offsets[block] + iv.start - starts[block]
+            target = values[dest : dest + size]
+            source = genomic[first : first + size]
+            unset = target < 0
+            target[unset] = source[unset]
+            first += size
+    covered = values[values >= 0]
+    return int(covered.sum()), len(covered)
+
+
+def union_intervals(intervals):
+    """
+    Parameters
+    ----------
+    intervals: List[(int, int)]
+               (start, end) intervals, 1-based and inclusive
+
+    Returns
+    -------
+    starts: array
+            start of each interval of the union, sorted
+    ends: array
+          end of each interval of the union
+    """
+    intervals = np.array(sorted(intervals), dtype=np.int64).reshape(-1, 2)
+    starts, ends = intervals[:, 0], intervals[:, 1]
+    if len(starts) == 0:
+        return starts, ends
+    # an interval starts a new block unless it overlaps the previous ones
+    reach = np.maximum.accumulate(ends)
+    first = np.flatnonzero(np.concatenate([[True], starts[1:] > reach[:-1]]))
+    last = np.concatenate([first[1:] - 1, [len(starts) - 1]])
+    return starts[first], reach[last]
+
+
+class GeneCounts(object):
+    """Per gene read counts of the reported ORFs, as computed by count_orfs.
+
+    Each position covered by several ORFs of a gene is counted once, so the
+    count of a gene is the coverage summed over the union of the intervals
+    of its ORFs and its length is the size of that union.
+    """
+
+    def __init__(self):
+        # intervals of the ORFs added since the last count, by
+        # (gene_id, gene_name, chrom, strand)
+        self.intervals = defaultdict(list)
+        # key is (gene_id, gene_name), value is [count, length]
+        self.counts = defaultdict(lambda: [0, 0])
+
+    def add(self, orf):
+        """
+        Parameters
+        ----------
+        orf: ORF
+             instance of ORF reported by detect-orfs
+        """
+        key = (orf.gid, orf.gname, orf.chrom, orf.strand)
+        self.intervals[key].extend((iv.start, iv.end) for iv in orf.intervals)
+
+    def count(self, coverage):
+        """Count the reads of the ORFs added so far, which are then dropped.
+
+        Parameters
+        ----------
+        coverage: dict
+                  key is (chrom, strand), value is (positions, counts), both
+                  arrays sorted by position; must cover the chromosomes of
+                  the added ORFs. The ORFs of a gene on a chromosome must
+                  all be added before it is counted
+        """
+        cumsums = {}
+        for (gene_id, gene_name, chrom, strand), intervals in self.intervals.items():
+            starts, ends = union_intervals(intervals)
+            total = self.counts[gene_id, gene_name]
+            total[1] += int((ends - starts + 1).sum())
+            if (chrom, strand) not in coverage:
+                continue
+            if (chrom, strand) not in cumsums:
+                positions, counts = coverage[chrom, strand]
+                cumsums[chrom, strand] = (
+                    positions,
+                    np.concatenate([[0], np.cumsum(counts)]),
+                )
+            positions, cumsum = cumsums[chrom, strand]
+            first = np.searchsorted(positions, starts, side="left")
+            last = np.searchsorted(positions, ends, side="right")
+            total[0] += int((cumsum[last] - cumsum[first]).sum())
+        self.intervals.clear()
+
+    def write(self, outfile):
+        """
+        Parameters
+        ----------
+        outfile: str
+                 Path to output file, in the format of count_orfs
+        """
+        with open(outfile, "w") as fout:
+            fout.write("gene_id\tcount\tlength\n")
+            for gene_id, gene_name in sorted(self.counts):
+                total, length = self.counts[gene_id, gene_name]
+                fout.write("{}\t{}\t{}\n".format(gene_id, total, length))
+
+
+def codon_codes(seq, other_codons):
+    """Code of each codon of a sequence.
+
+    Parameters
+    ----------
+    seq: str
+         nucleotide sequence, the last codon possibly being partial
+    other_codons: dict
+                  code of the codons with characters other than ACGT and of
+                  partial codons, from 64 on; extended with the new ones
+
+    Returns
+    -------
+    codes: array
+           code of each codon, 0-63 for the codons listed in CODONS
+    """
+    n_full = len(seq) // 3
+    bases = NUCLEOTIDE_CODES[np.frombuffer(seq[: 3 * n_full].encode(), np.uint8)]
+    bases = bases.reshape(-1, 3)
+    codes = bases[:, 0] * 16 + bases[:, 1] * 4 + bases[:, 2]
+    invalid = (bases < 0).any(axis=1)
+    if len(seq) > 3 * n_full:
+        codes = np.append(codes, -1)
+        invalid = np.append(invalid, True)
+    for i in np.flatnonzero(invalid).tolist():
+        codon = seq[3 * i : 3 * i + 3]
+        if codon not in other_codons:
+            other_codons[codon] = len(CODONS) + len(other_codons)
+        codes[i] = other_codons[codon]
+    return codes
+
+
+def read_orf_seqs(ribotricer_index_fasta):
+    """
+    Parameters
+    ----------
+    ribotricer_index_fasta: str
+                            Path to the sequences generated by orf-seq, as
+                            tsv or FASTA
+
+    Returns
+    -------
+    seqs: dict
+          key is the ORF ID, value is the sequence; for a FASTA output,
+          an IndexedOrfSeqs reading each sequence when it is looked up
+    """
+    if is_orf_fasta(ribotricer_index_fasta):
+        return IndexedOrfSeqs(ribotricer_index_fasta)
+    seqs = {}
+    with open(ribotricer_index_fasta, "r") as fin:
+        # Skip header
+        fin.readline()
+        for line in fin:
+            oid, _, seq = line.rstrip("\n").partition("\t")
+            seqs[oid] = seq
+    return seqs
+
+
+def _rank(names):
+    """Rank of each name in sorted order"""
+    ranks = np.empty(len(names), dtype=np.int64)
+    ranks[np.argsort(np.array(names, dtype=object), kind="stable")] = np.arange(
+        len(names)
+    )
+    return ranks
+
+
 def count_orfs_codon(
     ribotricer_index,
     detected_orfs,
@@ -105,117 +439,143 @@ def count_orfs_codon(
                 if True, all coverages will be exported
     """
     orf_index = {}
-    fasta_df = pd.read_csv(ribotricer_index_fasta, sep="\t").set_index("ORF_ID")
-    read_counts = defaultdict(dict)
-    with open(ribotricer_index, "r") as fin:
-        # Skip header
-        fin.readline()
-        for line in fin:
-            orf = ORF.from_string(line)
-            if orf.category in features:
-                orf_index[orf.oid] = orf
-    with open(detected_orfs, "r") as fin:
-        # Skip header
-        fin.readline()
-        for line in fin:
-            fields = line.strip().split("\t")
-            oid, otype, status = fields[:3]
-            gene_id, gene_name, gene_type = fields[11:14]
-            chrom, strand, start_codon, profile = fields[14:]
-            if otype in features:
-                # do not output 'nontranslating' events unless report_all is set
-                if status != "nontranslating" or report_all:
-                    intervals = orf_index[oid].intervals
-                    coor = [x for iv in intervals for x in range(iv.start, iv.end + 1)]
-                    codon_coor = [
-                        x for iv in intervals for x in range(iv.start, iv.end + 1, 3)
-                    ]
-                    if strand == "-":
-                        coor = coor[::-1]
-                    profile_stripped = profile.strip()[1:-1].split(", ")
-                    profile = list()
-                    if profile_stripped[0]:
-                        profile = list(map(int, profile_stripped))
-                    # IMP: Skip profiles that are not 3n long to avoid errors
-                    # downstream with sequenceu
-                    if len(profile) % 3 != 0:
-                        continue
-
-                    codon_profile = np.add.reduceat(
-                        profile, range(0, len(profile), 3)
-                    ).tolist()
-                    assert sum(codon_profile) == sum(profile)
-                    codon_seq = str(fasta_df.loc[oid].sequence)
-                    if not len(codon_seq) % 3 == 0:
-                        print(oid, len(codon_seq))
-                    codon_seq_partitioned = wrap(codon_seq, 3)
-                    for pos, cov, codon_seq in zip(
-                        codon_coor, codon_profile, codon_seq_partitioned
-                    ):
-                        if pos not in read_counts[gene_id, codon_seq]:
-                            read_counts[gene_id, codon_seq][pos] = cov
-
-    # Output count table
-    with open("{}_genewise.tsv".format(prefix), "w") as fout:
-        fout.write(
-            "gene_id\tcodon\tvalues\tmean_codon_coverage\tmedian_codon_coverage\tvar_codon_coverage\tcodon_occurences\ttotal_codon_coverage\n"
-        )
-        for gene_id, codon_seq in sorted(read_counts):
-            values = list(read_counts[gene_id, codon_seq].values())
-            codon_occurences = len(values)
-            total_codon_coverage = sum(values)
-            mean_codon_coverage = np.mean(values)
-            median_codon_coverage = np.median(values)
-            var_codon_coverage = np.var(values)
-            fout.write(
-                "{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
-                    gene_id,
-                    codon_seq,
-                    values,
-                    mean_codon_coverage,
-                    median_codon_coverage,
-                    var_codon_coverage,
-                    codon_occurences,
-                    total_codon_coverage,
+    seqs = read_orf_seqs(ribotricer_index_fasta)
+    for line in iter_index_lines(ribotricer_index):
+        orf = ORF.from_string(line)
+        if orf.category in features:
+            orf_index[orf.oid] = orf
+    gene_ids = {}
+    other_codons = {}
+    # gene, codon, genomic position and reads of each codon of the counted ORFs
+    genes, codons, positions, values = [], [], [], []
+    for fields, profile in iter_detected_orfs(detected_orfs, arrays=True):
+        oid, otype, status = fields[:3]
+        gene_id, gene_name, gene_type = fields[11:14]
+        chrom, strand, start_codon = fields[14:]
+        if otype in features:
+            # do not output 'nontranslating' events unless report_all is set
+            if status != "nontranslating" or report_all:
+                # IMP: Skip profiles that are not 3n long to avoid errors
+                # downstream with sequenceu
+                if len(profile) % 3 != 0:
+                    continue
+                intervals = orf_index[oid].intervals
+                codon_coor = np.concatenate(
+                    [np.arange(iv.start, iv.end + 1, 3) for iv in intervals]
                 )
-            )
-    fout_df = pd.read_csv("{}_genewise.tsv".format(prefix), sep="\t")
-    fout_df["per_codon_enrichment(total/n_occur)"] = (
-        fout_df["total_codon_coverage"] / fout_df["codon_occurences"]
+                codon_profile = np.add.reduceat(profile, np.arange(0, len(profile), 3))
+                codon_seq = seqs[oid]
+                if not len(codon_seq) % 3 == 0:
+                    print(oid, len(codon_seq))
+                codes = codon_codes(codon_seq, other_codons)
+                n = min(len(codon_coor), len(codon_profile), len(codes))
+                if gene_id not in gene_ids:
+                    gene_ids[gene_id] = len(gene_ids)
+                genes.append(np.full(n, gene_ids[gene_id]))
+                codons.append(codes[:n])
+                positions.append(codon_coor[:n])
+                values.append(codon_profile[:n])
+
+    # rank the genes and codons by name, the order of the output
+    gene_names = list(gene_ids)
+    codon_names = CODONS + list(other_codons)
+    if genes:
+        genes = _rank(gene_names)[np.concatenate(genes)]
+        codons = _rank(codon_names)[np.concatenate(codons)]
+        positions = np.concatenate(positions)
+        values = np.concatenate(values)
+    else:
+        genes = codons = positions = values = np.zeros(0, dtype=np.int64)
+    # keep the first reads seen at each position of a (gene, codon), in the
+    # order they were seen
+    order = np.lexsort((np.arange(len(genes)), positions, codons, genes))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (
+        (np.diff(genes[order]) != 0)
+        | (np.diff(codons[order]) != 0)
+        | (np.diff(positions[order]) != 0)
     )
-    fout_df["-log10_relative_enrichment(per_codon/total_gene_coverage)"] = -np.log10(
-        fout_df["per_codon_enrichment(total/n_occur)"]
-        / fout_df.groupby("gene_id")["total_codon_coverage"].transform("sum")
+    kept = np.sort(order[first])
+    kept = kept[np.lexsort((codons[kept], genes[kept]))]
+    genes, codons, values = genes[kept], codons[kept], values[kept]
+
+    # one group per (gene, codon)
+    starts = np.flatnonzero(
+        np.concatenate([[True], (np.diff(genes) != 0) | (np.diff(codons) != 0)])
+    )[: len(genes)]
+    ends = np.append(starts[1:], len(genes))
+    codon_occurences = ends - starts
+    group = np.repeat(np.arange(len(starts)), codon_occurences)
+    total_codon_coverage = (
+        np.add.reduceat(values, starts) if len(starts) else np.zeros(0, np.int64)
     )
-    # Overwrite
-    fout_df.to_csv("{}_genewise.tsv".format(prefix), sep="\t", index=False, header=True)
-    # Remove infs
-    fout_df = fout_df.replace([np.inf, -np.inf], np.nan)
-    fout_df = fout_df.dropna()
-    fout_df["relative_enrichment"] = fout_df[
-        "per_codon_enrichment(total/n_occur)"
-    ] / fout_df.groupby("gene_id")["total_codon_coverage"].transform("sum")
-
-    relative_enrichment_median = pd.DataFrame(
-        fout_df.groupby("codon")["relative_enrichment"].median()
+    mean_codon_coverage = total_codon_coverage / codon_occurences
+    # n * sum(x^2) - sum(x)^2 is exact on integers, so that the variance is
+    # only rounded once
+    sum_squares = (
+        np.add.reduceat(values * values, starts) if len(starts) else np.zeros(0)
     )
-    relative_enrichment_median.columns = ["median_relative_enrichment"]
+    var_codon_coverage = (
+        codon_occurences * sum_squares - total_codon_coverage * total_codon_coverage
+    ) / (codon_occurences * codon_occurences)
+    sorted_values = values[np.lexsort((values, group))]
+    median_codon_coverage = (
+        sorted_values[starts + (codon_occurences - 1) // 2]
+        + sorted_values[starts + codon_occurences // 2]
+    ) / 2
+    values = values.tolist()
+    group_values = [
+        "[{}]".format(", ".join(map(str, values[start:end])))
+        for start, end in zip(starts.tolist(), ends.tolist())
+    ]
+    group_genes = genes[starts]
+    gene_coverage = np.bincount(
+        group_genes, weights=total_codon_coverage, minlength=len(gene_names)
+    )[group_genes]
+    per_codon_enrichment = mean_codon_coverage
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_enrichment = -np.log10(per_codon_enrichment / gene_coverage)
 
-    relative_enrichment_mean = pd.DataFrame(
-        fout_df.groupby("codon")["relative_enrichment"].mean()
+    sorted_gene_names = np.array(sorted(gene_names), dtype=object)
+    sorted_codon_names = np.array(sorted(codon_names), dtype=object)
+    group_codons = sorted_codon_names[codons[starts]]
+    genewise = pd.DataFrame(
+        {
+            "gene_id": sorted_gene_names[group_genes],
+            "codon": group_codons,
+            "values": group_values,
+            "mean_codon_coverage": mean_codon_coverage,
+            "median_codon_coverage": median_codon_coverage,
+            "var_codon_coverage": var_codon_coverage,
+            "codon_occurences": codon_occurences,
+            "total_codon_coverage": total_codon_coverage,
+            "per_codon_enrichment(total/n_occur)": per_codon_enrichment,
+            "-log10_relative_enrichment(per_codon/total_gene_coverage)": (
+                log_enrichment
+            ),
+        }
     )
-    relative_enrichment_mean.columns = ["mean_relative_enrichment"]
+    genewise.to_csv("{}_genewise.tsv".format(prefix), sep="\t", index=False)
 
-    relative_enrichment_var = pd.DataFrame(
-        fout_df.groupby("codon")["relative_enrichment"].var()
+    # Skip codons with no reads or in genes with no reads
+    finite = np.isfinite(log_enrichment)
+    relative_enrichment = pd.DataFrame(
+        {
+            "codon": group_codons[finite],
+            "relative_enrichment": (
+                per_codon_enrichment[finite] / gene_coverage[finite]
+            ),
+        }
     )
-    relative_enrichment_var.columns = ["var_relative_enrichment"]
-
-    relative_enrichment = relative_enrichment_mean.join(
-        relative_enrichment_median
-    ).join(relative_enrichment_var)
+    relative_enrichment = relative_enrichment.groupby("codon")[
+        "relative_enrichment"
+    ].agg(["mean", "median", "var"])
+    relative_enrichment.columns = [
+        "mean_relative_enrichment",
+        "median_relative_enrichment",
+        "var_relative_enrichment",
+    ]
     relative_enrichment.index.name = "codon"
-
     relative_enrichment = relative_enrichment.reset_index()
     relative_enrichment.to_csv(
         "{}_codonwise.tsv".format(prefix), sep="\t", index=False, header=True
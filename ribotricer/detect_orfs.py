@@ -19,6 +19,7 @@ from .plotting import plot_read_lengths
 from .orf import ORF
 from .metagene import align_metagenes
 from .metagene import metagene_coverage
+from .metagene import sample_metagene_cds
 from .infer_protocol import infer_protocol
 from .const import MINIMUM_DENSITY_OVER_ORF
 from .const import MINIMUM_READS_PER_CODON
@@ -28,11 +29,39 @@ from .const import CUTOFF
 from .common import parent_dir
 from .common import mkdir_p
 from .common import collapse_coverage_to_codon
+from .count_orfs import GeneCounts
+from .bam import chrom_sizes
 from .bam import split_bam
+from .checkpoint import checkpoint_dir
+from .checkpoint import CheckpointStore
+from .checkpoint import detect_orfs_stage_keys
+from .checkpoint import load_alignments
+from .checkpoint import load_merged_alignments
+from .checkpoint import load_metagenes
+from .checkpoint import load_psite_offsets
+from .checkpoint import save_alignments
+from .checkpoint import save_merged_alignments
+from .checkpoint import save_metagenes
+from .checkpoint import save_psite_offsets
+from .index import ANNOTATED
+from .index import count_index_lines
+from .index import fetch_windows
+from .index import footprint_categories
+from .index import in_regions
+from .index import is_dedup_index
+from .index import iter_index_lines
+from .index import only_annotated
+from .index import parse_footprint
+from .results import result_path
+from .results import result_writer
+from .results import ThreadedResultWriter
 from quicksect import Interval, IntervalTree
 from collections import Counter
 from collections import defaultdict
 import datetime
+import heapq
+import sys
+import time
 
 import numpy as np
 from tqdm.autonotebook import tqdm
@@ -44,17 +73,97 @@ tqdm.pandas()
 STRAND_TO_NUM = {"+": 1, "-": -1}
 
 
-def merge_read_lengths(alignments, psite_offsets):
+def alignment_arrays(counts):
+    """Convert the alignments of one length and strand to sorted arrays.
+
+    Parameters
+    ----------
+    counts: Counter
+            key is (chrom, pos), value is the number of reads
+
+    Returns
+    -------
+    arrays: dict
+            key is the chromosome, value is (positions, counts), both
+            arrays sorted by position
+    """
+    positions = defaultdict(list)
+    values = defaultdict(list)
+    for (chrom, pos), count in counts.items():
+        positions[chrom].append(pos)
+        values[chrom].append(count)
+    arrays = {}
+    for chrom in positions:
+        pos = np.array(positions[chrom], dtype=np.int64)
+        order = np.argsort(pos, kind="stable")
+        arrays[chrom] = (pos[order], np.array(values[chrom], dtype=np.int64)[order])
+    return arrays
+
+
+def coverage_arrays(merged_alignments):
+    """
+    Parameters
+    ----------
+    merged_alignments: dict(Counter)
+                       alignments by merging all lengths
+
+    Returns
+    -------
+    coverage: dict
+              key is (chrom, strand), value is (positions, counts), both
+              arrays sorted by position
+    """
+    return {
+        (chrom, strand): arrays
+        for strand in merged_alignments
+        for chrom, arrays in alignment_arrays(merged_alignments[strand]).items()
+    }
+
+
+def merge_sorted_arrays(arrays):
+    """Merge sorted (positions, counts) arrays, summing counts of equal positions
+
+    Parameters
+    ----------
+    arrays: List[(array, array)]
+            (positions, counts) pairs, each sorted by position
+
+    Returns
+    -------
+    positions: array
+               unique positions, sorted
+    counts: array
+            summed counts of each position
+    """
+    positions = np.concatenate([pos for pos, _ in arrays])
+    counts = np.concatenate([cnt for _, cnt in arrays])
+    # the input is made of sorted runs, which mergesort merges in linear time
+    order = np.argsort(positions, kind="mergesort")
+    positions = positions[order]
+    counts = counts[order]
+    if len(positions) == 0:
+        return positions, counts
+    starts = np.flatnonzero(np.concatenate([[True], positions[1:] != positions[:-1]]))
+    return positions[starts], np.add.reduceat(counts, starts)
+
+
+def merge_read_lengths(alignments, psite_offsets, free_lengths=False):
     """
     Merge read counts for different read lengths after
     applying appropriate offset(s).
 
+    The reads of each length are converted to sorted position arrays per
+    chromosome, shifted by the P-site offset and merged.
+
     Parameters
     ----------
     alignments: dict(dict(Counter))
                 bam split by length, strand
     psite_offsets: dict
                    key is the length, value is the offset
+    free_lengths: bool
+                  Whether to delete the alignments of each length once they
+                  are converted, so that peak memory stays bounded
     Returns
     -------
     merged_alignments: dict(dict)
@@ -63,15 +172,30 @@ def merge_read_lengths(alignments, psite_offsets):
     # print('merging different lengths...')
     merged_alignments = defaultdict(Counter)
 
-    for length, offset in list(psite_offsets.items()):
+    strands = []
+    for length in psite_offsets:
         for strand in alignments[length]:
-            for chrom, pos in alignments[length][strand]:
-                count = alignments[length][strand][(chrom, pos)]
-                if strand == "+":
-                    pos_shifted = pos + offset
-                else:
-                    pos_shifted = pos - offset
-                merged_alignments[strand][(chrom, pos_shifted)] += count
+            if strand not in strands:
+                strands.append(strand)
+
+    for strand in strands:
+        per_chrom = defaultdict(list)
+        for length, offset in list(psite_offsets.items()):
+            if strand not in alignments[length]:
+                continue
+            arrays = alignment_arrays(alignments[length][strand])
+            if free_lengths:
+                del alignments[length][strand]
+            shift = offset if strand == "+" else -offset
+            for chrom, (pos, cnt) in arrays.items():
+                per_chrom[chrom].append((pos + shift, cnt))
+        merged = Counter()
+        for chrom in list(per_chrom):
+            pos, cnt = merge_sorted_arrays(per_chrom.pop(chrom))
+            # filling the Counter directly avoids an intermediate dict
+            keys = zip([chrom] * len(pos), pos.tolist())
+            dict.update(merged, zip(keys, cnt.tolist()))
+        merged_alignments[strand] = merged
     return merged_alignments
 
 
@@ -84,6 +208,7 @@ def parse_ribotricer_index(ribotricer_index):
     ----------
     ribotricer_index: str
                    Path to the index file generated by ribotricer prepare_orfs
+                   or to the manifest of a sharded index
 
     Returns
     -------
@@ -103,31 +228,78 @@ def parse_ribotricer_index(ribotricer_index):
     # The annotated regions appear first in the index file
     # so need to read only upto a point where the regions
     # no longer have the annotated tag.
-    total_lines = 0
+    if is_dedup_index(ribotricer_index):
+        return _parse_dedup_index(ribotricer_index)
+
+    # the ORFs of a sharded index are read in the order of the original
+    # index, on which ties between metagene CDSs are broken
+    features = {ANNOTATED}
+    total_lines = count_index_lines(ribotricer_index, features=features)
+    for line in tqdm(
+        iter_index_lines(ribotricer_index, features=features),
+        total=total_lines,
+        unit="lines",
+        leave=False,
+    ):
+        orf = ORF.from_string(line)
+        if orf is not None:
+            refseq[orf.chrom].insert(
+                Interval(
+                    orf.intervals[0].start,
+                    orf.intervals[-1].end,
+                    STRAND_TO_NUM[orf.strand],
+                )
+            )
+            annotated.append(orf)
+    return (annotated, refseq)
+
+
+def _parse_dedup_index(ribotricer_index):
+    """Parse annotated ORFs from a deduplicated index, see
+    parse_ribotricer_index
+
+    Each annotated membership of a footprint is returned as a separate ORF,
+    in the order of the original index.
+    """
+    annotated = []
     with open(ribotricer_index, "r") as anno:
         # read header
         anno.readline()
-        while "annotated" in anno.readline():
-            total_lines += 1
-    with open(ribotricer_index, "r") as anno:
-        with tqdm(total=total_lines, unit="lines", leave=False) as pbar:
-            # read header
-            anno.readline()
-            line = anno.readline()
-            while "annotated" in line:
-                pbar.update()
-                orf = ORF.from_string(line)
-                if orf is not None and orf.category == "annotated":
-                    refseq[orf.chrom].insert(
-                        Interval(
-                            orf.intervals[0].start,
-                            orf.intervals[-1].end,
-                            STRAND_TO_NUM[orf.strand],
-                        )
-                    )
-                    annotated.append(orf)
-                line = anno.readline()
-    return (annotated, refseq)
+        for line in anno:
+            orf, memberships, rows = parse_footprint(line)
+            # footprints whose first membership is not annotated
+            # come after all annotated ones
+            if orf.category != "annotated":
+                break
+            for row, member in zip(rows, memberships):
+                if member.category == "annotated":
+                    annotated.append((row, member))
+    annotated = [orf for row, orf in sorted(annotated, key=lambda x: x[0])]
+    return (annotated, annotated_refseq(annotated))
+
+
+def annotated_refseq(annotated):
+    """
+    Parameters
+    ----------
+    annotated: List[ORF]
+               ORFs of CDS annotated
+
+    Returns
+    -------
+    refseq: defaultdict(IntervalTree)
+            chrom: (start, end, strand)
+    """
+    refseq = defaultdict(IntervalTree)
+    for orf in annotated:
+        refseq[orf.chrom].insert(
+            Interval(
+                orf.intervals[0].start,
+                orf.intervals[-1].end,
+                STRAND_TO_NUM[orf.strand],
+            )
+        )
+    return refseq
 
 
 def orf_coverage(orf, alignments, offset_5p=0, offset_3p=0):
@@ -196,6 +368,59 @@ def orf_coverage(orf, alignments, offset_5p=0, offset_3p=0):
     return coverage
 
 
+def score_coverage(
+    cov,
+    phase_score_cutoff=CUTOFF,
+    min_valid_codons=MINIMUM_VALID_CODONS,
+    min_reads_per_codon=MINIMUM_READS_PER_CODON,
+    min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
+    min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
+):
+    """
+    Parameters
+    ----------
+    cov: list
+         coverage of the ORF
+
+    Returns
+    -------
+    scores: tuple
+            (status, phase_score, read_count, length, valid_codons,
+            valid_codons_ratio, read_density)
+    """
+    count = sum(cov)
+    length = len(cov)
+    coh, valid_codons = phasescore(cov)
+    n_codons = max(1, length // 3)
+
+    # codon level coverage
+    codon_coverage = np.array(collapse_coverage_to_codon(cov))
+    valid_codons_ratio = valid_codons / n_codons
+    # total reads in the ORF divided by the length
+    orf_density = np.sum(codon_coverage) / n_codons
+    codon_coverage_exceeds_min = codon_coverage >= min_reads_per_codon
+    status = (
+        "translating"
+        if (
+            coh >= phase_score_cutoff
+            and valid_codons >= min_valid_codons
+            and np.all(codon_coverage_exceeds_min)
+            and valid_codons_ratio >= min_valid_codons_ratio
+            and orf_density >= min_density_over_orf
+        )
+        else "nontranslating"
+    )
+    return (
+        status,
+        coh,
+        count,
+        length,
+        valid_codons,
+        valid_codons_ratio,
+        orf_density,
+    )
+
+
 def export_orf_coverages(
     ribotricer_index,
     merged_alignments,
@@ -206,103 +431,294 @@ def export_orf_coverages(
     min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
     min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
     report_all=False,
+    regions=None,
+    output_format="tsv",
+    compress=False,
+    features=None,
+    gene_counts=False,
 ):
     """
     Parameters
     ----------
     ribotricer_index: str
                    Path to the index file generated by ribotricer prepare_orfs
+                   or to the manifest of a sharded index
     merged_alignments: dict(dict)
                        alignments by merging all lengths
     prefix: str
             prefix for output file
     report_all: bool
                 if True, all coverages will be exported
+    regions: dict
+             if given, only ORFs starting within these regions are exported,
+             see index.parse_regions
+    output_format: str
+                   {'tsv', 'parquet', 'npz'}
+    compress: bool
+              whether to gzip the tsv output
+    features: set
+              if given, only ORFs of these types are scored, the others
+              being skipped while reading the index
+    gene_counts: bool
+                 Whether to also write the read counts of the genes of the
+                 exported ORFs to {prefix}_gene_counts.tsv, see GeneCounts
     """
     # print('exporting coverages for all ORFs...')
-    columns = [
-        "ORF_ID",
-        "ORF_type",
-        "status",
-        "phase_score",
-        "read_count",
-        "length",
-        "valid_codons",
-        "valid_codons_ratio",
-        "read_density",
-        "transcript_id",
-        "transcript_type",
-        "gene_id",
-        "gene_name",
-        "gene_type",
-        "chrom",
-        "strand",
-        "start_codon",
-        "profile\n",
-    ]
-    to_write = "\t".join(columns)
-    formatter = "{}\t" * (len(columns) - 1) + "{}\n"
-    with open(ribotricer_index, "r") as anno:
-        total_lines = len(["" for line in anno])
+    thresholds = (
+        phase_score_cutoff,
+        min_valid_codons,
+        min_reads_per_codon,
+        min_valid_codons_ratio,
+        min_density_over_orf,
+    )
+    # results are formatted and written in a background thread
+    writer = ThreadedResultWriter(
+        result_writer(result_path(prefix, output_format, compress), output_format)
+    )
+    start = time.time()
+    counts = GeneCounts() if gene_counts else None
 
-    with open(ribotricer_index, "r") as anno, open(
-        "{}_translating_ORFs.tsv".format(prefix), "w"
-    ) as output:
-        output.write(to_write)
+    if is_dedup_index(ribotricer_index):
+        with open(ribotricer_index, "r") as anno:
+            _export_footprint_coverages(
+                anno,
+                merged_alignments,
+                writer,
+                thresholds,
+                report_all,
+                regions,
+                features,
+                counts,
+            )
+    else:
+        total_lines = count_index_lines(ribotricer_index, regions, features)
         with tqdm(total=total_lines, unit="ORFs") as pbar:
-            # Skip header
-            anno.readline()
-            for line in anno:
+            for line in iter_index_lines(ribotricer_index, regions, features):
                 pbar.update()
                 orf = ORF.from_string(line)
                 cov = orf_coverage(orf, merged_alignments)
-                count = sum(cov)
-                length = len(cov)
-                coh, valid_codons = phasescore(cov)
-                n_codons = max(1, length // 3)
-
-                # codon level coverage
-                codon_coverage = np.array(collapse_coverage_to_codon(cov))
-                valid_codons_ratio = valid_codons / n_codons
-                # total reads in the ORF divided by the length
-                orf_density = np.sum(codon_coverage) / n_codons
-                codon_coverage_exceeds_min = codon_coverage >= min_reads_per_codon
-                status = (
-                    "translating"
-                    if (
-                        coh >= phase_score_cutoff
-                        and valid_codons >= min_valid_codons
-                        and np.all(codon_coverage_exceeds_min)
-                        and valid_codons_ratio >= min_valid_codons_ratio
-                        and orf_density >= min_density_over_orf
-                    )
-                    else "nontranslating"
-                )
+                scores = score_coverage(cov, *thresholds)
                 # skip outputing nontranslating ones
-                if not report_all and status == "nontranslating":
+                if not report_all and scores[0] == "nontranslating":
                     pass
                 else:
-                    to_write = formatter.format(
-                        orf.oid,
-                        orf.category,
-                        status,
-                        coh,
-                        count,
-                        length,
-                        valid_codons,
-                        valid_codons_ratio,
-                        orf_density,
-                        orf.tid,
-                        orf.ttype,
-                        orf.gid,
-                        orf.gname,
-                        orf.gtype,
-                        orf.chrom,
-                        orf.strand,
-                        orf.start_codon,
-                        cov,
+                    writer.write(orf, scores, cov)
+                    if counts is not None:
+                        counts.add(orf)
+    scoring_time = time.time() - start
+    writer.close()
+    elapsed = time.time() - start
+    if counts is not None:
+        counts.count(coverage_arrays(merged_alignments))
+        counts.write("{}_gene_counts.tsv".format(prefix))
+
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            (
+                "wrote {} ORFs in {:.1f}s ({:.0f} ORFs/s); scoring {:.1f}s, "
+                "of which {:.1f}s waiting for the writer; writer busy {:.1f}s"
+            ).format(
+                writer.n_rows,
+                elapsed,
+                writer.n_rows / max(elapsed, 1e-9),
+                scoring_time,
+                writer.wait_time,
+                writer.write_time,
+            ),
+        )
+    )
+
+
+def _export_footprint_coverages(
+    anno,
+    merged_alignments,
+    writer,
+    thresholds,
+    report_all,
+    regions=None,
+    features=None,
+    counts=None,
+):
+    """Score each footprint of a deduplicated index once and write the
+    result for all its memberships in the order of the original index.
+
+    Footprints appear in the order of their first membership, so once a
+    footprint is read, every row before its first membership has already
+    been scored and can be written.
+    """
+    total_lines = len(["" for line in anno]) - 1
+    anno.seek(0)
+    pending = []
+    annotated_only = only_annotated(features)
+    with tqdm(total=total_lines, unit="footprints") as pbar:
+        # Skip header
+        anno.readline()
+        for line in anno:
+            pbar.update()
+            if features is not None:
+                categories = footprint_categories(line)
+                # footprints whose first membership is not annotated
+                # come after all annotated ones
+                if annotated_only and categories[0] != ANNOTATED:
+                    break
+                if not features.intersection(categories):
+                    continue
+            orf, memberships, rows = parse_footprint(line)
+            if not in_regions(orf.chrom, orf.intervals[0].start, regions):
+                continue
+            cov = orf_coverage(orf, merged_alignments)
+            scores = score_coverage(cov, *thresholds)
+            if not report_all and scores[0] == "nontranslating":
+                pass
+            else:
+                for row, member in zip(rows, memberships):
+                    if features is None or member.category in features:
+                        heapq.heappush(pending, (row, member, scores, cov))
+                        if counts is not None:
+                            counts.add(member)
+            while pending and pending[0][0] <= rows[0]:
+                writer.write(*heapq.heappop(pending)[1:])
+    while pending:
+        writer.write(*heapq.heappop(pending)[1:])
+
+
+def coverage_runs(positions, counts):
+    """Merge adjacent positions with equal counts into runs
+
+    Parameters
+    ----------
+    positions: array
+               sorted positions (1-based)
+    counts: array
+            counts of each position
+
+    Returns
+    -------
+    starts: array
+            0-based start of each run
+    ends: array
+          end of each run (exclusive, i.e. 1-based inclusive)
+    values: array
+            count of each run
+    """
+    if len(positions) == 0:
+        return positions, positions, counts
+    breaks = (positions[1:] != positions[:-1] + 1) | (counts[1:] != counts[:-1])
+    first = np.flatnonzero(np.concatenate([[True], breaks]))
+    last = np.concatenate([first[1:] - 1, [len(positions) - 1]])
+    return positions[first] - 1, positions[last], counts[first]
+
+
+def _strand_coverage(merged_alignments, strand, chrom_sizes=None):
+    """Yield (chrom, positions, counts) sorted by chromosome and position,
+    dropping positions outside the chromosomes if chrom_sizes is given"""
+    arrays = alignment_arrays(merged_alignments[strand])
+    chroms = sorted(arrays) if chrom_sizes is None else list(chrom_sizes)
+    for chrom in chroms:
+        if chrom not in arrays:
+            continue
+        positions, counts = arrays.pop(chrom)
+        if chrom_sizes is not None:
+            inside = (positions >= 1) & (positions <= chrom_sizes[chrom])
+            positions, counts = positions[inside], counts[inside]
+        yield chrom, positions, counts
+
+
+def _coverage_fname(prefix, strand, ext):
+    return "{}_{}.{}".format(prefix, "pos" if strand == "+" else "neg", ext)
+
+
+class CoverageWriter(object):
+    """Write the coverage of merged alignments to wig, bedGraph or bigWig
+    files, one file per strand.
+
+    The alignments can be written in several parts, e.g. one chromosome
+    at a time; the parts must then come in the order of the files, that
+    is sorted by chromosome for wig and in the order of chrom_sizes for
+    bedGraph and bigWig.
+    """
+
+    EXTENSIONS = {"wig": "wig", "bedgraph": "bedGraph", "bigwig": "bw"}
+
+    def __init__(self, prefix, coverage_format, chrom_sizes=None):
+        """
+        Parameters
+        ----------
+        prefix: str
+                prefix of output files
+        coverage_format: str
+                         {'wig', 'bedgraph', 'bigwig'}
+        chrom_sizes: dict
+                     key is the chromosome, value is its length, required
+                     for bedGraph and bigWig
+        """
+        if coverage_format == "bigwig":
+            try:
+                import pyBigWig
+            except ImportError:
+                sys.exit("Error: pyBigWig is required for exporting bigWig files")
+            self.pyBigWig = pyBigWig
+        self.prefix = prefix
+        self.coverage_format = coverage_format
+        self.chrom_sizes = chrom_sizes
+        self.outputs = {}
+
+    def _output(self, strand):
+        if strand not in self.outputs:
+            fname = _coverage_fname(
+                self.prefix, strand, self.EXTENSIONS[self.coverage_format]
+            )
+            if self.coverage_format == "bigwig":
+                output = self.pyBigWig.open(fname, "w")
+                output.addHeader(list(self.chrom_sizes.items()))
+            else:
+                output = open(fname, "w")
+            self.outputs[strand] = output
+        return self.outputs[strand]
+
+    def write(self, merged_alignments):
+        """
+        Parameters
+        ----------
+        merged_alignments: dict(dict)
+                           alignments by merging all lengths
+        """
+        for strand in merged_alignments:
+            output = self._output(strand)
+            if self.coverage_format == "wig":
+                for chrom, positions, counts in _strand_coverage(
+                    merged_alignments, strand
+                ):
+                    output.write("variableStep chrom={}\n".format(chrom))
+                    output.writelines(
+                        "{}\t{}\n".format(pos, count)
+                        for pos, count in zip(positions.tolist(), counts.tolist())
+                    )
+                continue
+            for chrom, positions, counts in _strand_coverage(
+                merged_alignments, strand, self.chrom_sizes
+            ):
+                starts, ends, values = coverage_runs(positions, counts)
+                if self.coverage_format == "bedgraph":
+                    output.writelines(
+                        "{}\t{}\t{}\t{}\n".format(chrom, start, end, value)
+                        for start, end, value in zip(
+                            starts.tolist(), ends.tolist(), values.tolist()
+                        )
                     )
-                    output.write(to_write)
+                elif len(starts) > 0:
+                    output.addEntries(
+                        [chrom] * len(starts),
+                        starts.tolist(),
+                        ends=ends.tolist(),
+                        values=values.astype(np.float64).tolist(),
+                    )
+
+    def close(self):
+        for output in self.outputs.values():
+            output.close()
 
 
 def export_wig(merged_alignments, prefix):
@@ -315,20 +731,308 @@ def export_wig(merged_alignments, prefix):
             prefix of output wig files
     """
     # print('exporting merged alignments to wig file...')
-    for strand in merged_alignments:
-        to_write = ""
-        cur_chrom = ""
-        for chrom, pos in sorted(merged_alignments[strand]):
-            if chrom != cur_chrom:
-                cur_chrom = chrom
-                to_write += "variableStep chrom={}\n".format(chrom)
-            to_write += "{}\t{}\n".format(pos, merged_alignments[strand][(chrom, pos)])
-        if strand == "+":
-            fname = "{}_pos.wig".format(prefix)
+    writer = CoverageWriter(prefix, "wig")
+    writer.write(merged_alignments)
+    writer.close()
+
+
+def export_bedgraph(merged_alignments, prefix, chrom_sizes):
+    """
+    Parameters
+    ----------
+    merged_alignments: dict(dict)
+                       alignments by merging all lengths
+    prefix: str
+            prefix of output bedGraph files
+    chrom_sizes: dict
+                 key is the chromosome, value is its length
+    """
+    writer = CoverageWriter(prefix, "bedgraph", chrom_sizes)
+    writer.write(merged_alignments)
+    writer.close()
+
+
+def export_bigwig(merged_alignments, prefix, chrom_sizes):
+    """
+    Parameters
+    ----------
+    merged_alignments: dict(dict)
+                       alignments by merging all lengths
+    prefix: str
+            prefix of output bigWig files
+    chrom_sizes: dict
+                 key is the chromosome, value is its length
+    """
+    writer = CoverageWriter(prefix, "bigwig", chrom_sizes)
+    writer.write(merged_alignments)
+    writer.close()
+
+
+CHECKPOINT_LOADERS = {
+    "alignments": load_alignments,
+    "metagenes": load_metagenes,
+    "psite_offsets": load_psite_offsets,
+    "merged_alignments": load_merged_alignments,
+}
+
+
+def _resume(store, keys, stage):
+    """Output of a stage from a valid checkpoint, None if it must be run"""
+    if store is None:
+        return None
+    saved = CHECKPOINT_LOADERS[stage](store, keys[stage])
+    if saved is not None:
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"),
+                "resumed {} from checkpoint".format(stage.replace("_", " ")),
+            )
+        )
+    return saved
+
+
+def ingest_bam(
+    bam,
+    ribotricer_index,
+    prefix,
+    protocol,
+    read_lengths,
+    psite_offsets,
+    phase_score_cutoff,
+    metagene_max_orfs=None,
+    metagene_min_cds_reads=0,
+    checkpoint=False,
+    resume=False,
+    annotated=None,
+    windows=None,
+):
+    """Read a bam file and merge its read lengths at the P-sites,
+    see detect_orfs for the parameters.
+
+    Parameters
+    ----------
+    annotated: List[ORF]
+               annotated ORFs of the index; if None, they are parsed
+               from the index when needed
+    windows: List[(str, int, int)]
+             if given, only reads in these windows are used, see
+             index.fetch_windows
+
+    Returns
+    -------
+    merged_alignments: dict(Counter)
+                       alignments by merging all lengths
+    """
+    # create directory
+    mkdir_p(parent_dir(prefix))
+
+    # checkpoints are keyed by the inputs and parameters of each stage
+    store = keys = None
+    if checkpoint or resume:
+        store = CheckpointStore(checkpoint_dir(prefix), resume)
+        keys = detect_orfs_stage_keys(
+            bam,
+            ribotricer_index,
+            protocol,
+            read_lengths,
+            psite_offsets,
+            phase_score_cutoff,
+            metagene_max_orfs,
+            metagene_min_cds_reads,
+            windows,
+        )
+
+    merged_alignments = _resume(store, keys, "merged_alignments")
+    if merged_alignments is None:
+        saved = _resume(store, keys, "alignments")
+        if saved is not None:
+            protocol, alignments, read_length_counts = saved
         else:
-            fname = "{}_neg.wig".format(prefix)
-        with open(fname, "w") as output:
-            output.write(to_write)
+            if annotated is None:
+                # parse the index file
+                now = datetime.datetime.now()
+                print(
+                    now.strftime(
+                        "%b %d %H:%M:%S ... started parsing ribotricer index file"
+                    )
+                )
+                annotated, refseq = parse_ribotricer_index(ribotricer_index)
+            else:
+                refseq = annotated_refseq(annotated)
+
+            # infer experimental protocol if not provided
+            if protocol is None:
+                now = datetime.datetime.now()
+                print(
+                    "{} ... {}".format(
+                        now.strftime("%b %d %H:%M:%S"),
+                        "started inferring experimental design",
+                    )
+                )
+                protocol = infer_protocol(bam, refseq, prefix)
+            del refseq
+
+            # split bam file into strand and read length
+            now = datetime.datetime.now()
+            print(now.strftime("%b %d %H:%M:%S ... started reading bam file"))
+            alignments, read_length_counts = split_bam(
+                bam, protocol, prefix, read_lengths, windows
+            )
+
+            # plot read length distribution
+            now = datetime.datetime.now()
+            print(
+                "{} ... {}".format(
+                    now.strftime("%b %d %H:%M:%S"),
+                    "started plotting read length distribution",
+                )
+            )
+            plot_read_lengths(read_length_counts, prefix)
+            if store is not None:
+                save_alignments(
+                    store, keys["alignments"], protocol, alignments, read_length_counts
+                )
+
+        inferred_offsets = None
+        if psite_offsets is None:
+            inferred_offsets = _resume(store, keys, "psite_offsets")
+        if inferred_offsets is None:
+            saved = _resume(store, keys, "metagenes")
+            if saved is not None:
+                metagenes, read_length_counts, sampling = saved
+            else:
+                if annotated is None:
+                    now = datetime.datetime.now()
+                    print(
+                        now.strftime(
+                            "%b %d %H:%M:%S ... started parsing ribotricer index file"
+                        )
+                    )
+                    annotated, _ = parse_ribotricer_index(ribotricer_index)
+
+                # select CDSs for metagene profiles
+                sampling = None
+                if metagene_max_orfs is not None or metagene_min_cds_reads > 0:
+                    now = datetime.datetime.now()
+                    print(
+                        "{} ... {}".format(
+                            now.strftime("%b %d %H:%M:%S"),
+                            "started ranking CDSs by coverage for metagene profiles",
+                        )
+                    )
+                    n_cds = len(annotated)
+                    annotated = sample_metagene_cds(
+                        annotated,
+                        alignments,
+                        list(read_length_counts),
+                        metagene_max_orfs,
+                        metagene_min_cds_reads,
+                    )
+                    sampling = (
+                        "metagene CDSs: {} of {} (metagene_max_orfs: {}, "
+                        "metagene_min_cds_reads: {})"
+                    ).format(
+                        len(annotated), n_cds, metagene_max_orfs, metagene_min_cds_reads
+                    )
+
+                # calculate metagene profiles
+                now = datetime.datetime.now()
+                print(
+                    "{} ... {}".format(
+                        now.strftime("%b %d %H:%M:%S"),
+                        "started calculating metagene profiles. "
+                        "This may take a long time...",
+                    )
+                )
+                metagenes = metagene_coverage(
+                    annotated, alignments, read_length_counts, prefix
+                )
+
+                # plot metagene profiles
+                now = datetime.datetime.now()
+                print(
+                    "\n{} ... {}".format(
+                        now.strftime("%b %d %H:%M:%S"),
+                        "started plotting metagene profiles",
+                    )
+                )
+                plot_metagene(metagenes, read_length_counts, prefix)
+                if store is not None:
+                    save_metagenes(
+                        store,
+                        keys["metagenes"],
+                        metagenes,
+                        read_length_counts,
+                        sampling,
+                    )
+
+            # align metagenes if psite_offsets not provided
+            if psite_offsets is None:
+                now = datetime.datetime.now()
+                print(
+                    "{} ... {}".format(
+                        now.strftime("%b %d %H:%M:%S"),
+                        "started inferring P-site offsets",
+                    )
+                )
+                inferred_offsets = align_metagenes(
+                    metagenes,
+                    read_length_counts,
+                    prefix,
+                    phase_score_cutoff,
+                    read_lengths is None,
+                    sampling,
+                )
+                if store is not None:
+                    save_psite_offsets(store, keys["psite_offsets"], inferred_offsets)
+        if psite_offsets is None:
+            psite_offsets = inferred_offsets
+
+        # merge read lengths based on P-sites offsets
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"),
+                "started shifting according to P-site offsets",
+            )
+        )
+        merged_alignments = merge_read_lengths(alignments, psite_offsets, True)
+        del alignments
+        if store is not None:
+            save_merged_alignments(store, keys["merged_alignments"], merged_alignments)
+
+    return merged_alignments
+
+
+def export_coverage(merged_alignments, prefix, coverage_format, bam):
+    """
+    Parameters
+    ----------
+    merged_alignments: dict(Counter)
+                       alignments by merging all lengths
+    prefix: str
+            prefix for output files
+    coverage_format: str
+                     {'wig', 'bedgraph', 'bigwig'}
+    bam: str
+         Path to the bam file, whose header gives the chromosome sizes
+    """
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started exporting {} file of alignments after shifting".format(
+                coverage_format
+            ),
+        )
+    )
+    if coverage_format == "wig":
+        export_wig(merged_alignments, prefix)
+    elif coverage_format == "bedgraph":
+        export_bedgraph(merged_alignments, prefix, chrom_sizes(bam))
+    else:
+        export_bigwig(merged_alignments, prefix, chrom_sizes(bam))
 
 
 def detect_orfs(
@@ -344,6 +1048,16 @@ def detect_orfs(
     min_valid_codons_ratio,
     min_density_over_orf,
     report_all,
+    regions=None,
+    metagene_max_orfs=None,
+    metagene_min_cds_reads=0,
+    coverage_format="wig",
+    output_format="tsv",
+    compress=False,
+    checkpoint=False,
+    resume=False,
+    features=None,
+    gene_counts=False,
 ):
     """
     Parameters
@@ -371,97 +1085,61 @@ def detect_orfs(
     report_all: bool
                 Whether to output all ORFs' scores regardless of translation
                 status
+    regions: dict
+             if given, only ORFs starting within these regions are scored
+             and only the reads around them are read from the bam file,
+             see index.parse_regions
+    metagene_max_orfs: int
+                       if given, only this many CDSs with the most reads are
+                       used for the metagene profiles
+    metagene_min_cds_reads: int
+                            minimum number of reads for a CDS to be used for
+                            the metagene profiles
+    coverage_format: str
+                     {'wig', 'bedgraph', 'bigwig', 'none'}
+                     format of the exported coverage after shifting
+    output_format: str
+                   {'tsv', 'parquet', 'npz'}
+                   format of the detect-orfs output
+    compress: bool
+              whether to gzip the tsv output
+    checkpoint: bool
+                Whether to save the output of each expensive stage under
+                {prefix}_checkpoints
+    resume: bool
+            Whether to skip the stages with a valid checkpoint, implies
+            checkpoint
+    features: set
+              if given, only ORFs of these types are scored, such as
+              {annotated}
+    gene_counts: bool
+                 Whether to write the read counts of the genes of the
+                 reported ORFs to {prefix}_gene_counts.tsv, as count-orfs
+                 would compute them from the output
     """
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ..... started ribotricer detect-orfs"))
 
-    # parse the index file
-    now = datetime.datetime.now()
-    print(now.strftime("%b %d %H:%M:%S ... started parsing ribotricer index file"))
-    annotated, refseq = parse_ribotricer_index(ribotricer_index)
-
-    # create directory
-    mkdir_p(parent_dir(prefix))
-
-    # infer experimental protocol if not provided
-    if protocol is None:
-        now = datetime.datetime.now()
-        print(
-            "{} ... {}".format(
-                now.strftime("%b %d %H:%M:%S"), "started inferring experimental design"
-            )
-        )
-        protocol = infer_protocol(bam, refseq, prefix)
-    del refseq
-
-    # split bam file into strand and read length
-    now = datetime.datetime.now()
-    print(now.strftime("%b %d %H:%M:%S ... started reading bam file"))
-    alignments, read_length_counts = split_bam(bam, protocol, prefix, read_lengths)
-
-    # plot read length distribution
-    now = datetime.datetime.now()
-    print(
-        "{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"), "started plotting read length distribution"
-        )
-    )
-    plot_read_lengths(read_length_counts, prefix)
-
-    # calculate metagene profiles
-    now = datetime.datetime.now()
-    print(
-        "{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"),
-            "started calculating metagene profiles. This may take a long time...",
-        )
-    )
-    metagenes = metagene_coverage(annotated, alignments, read_length_counts, prefix)
-
-    # plot metagene profiles
-    now = datetime.datetime.now()
-    print(
-        "\n{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"), "started plotting metagene profiles"
-        )
-    )
-    plot_metagene(metagenes, read_length_counts, prefix)
-
-    # align metagenes if psite_offsets not provided
-    if psite_offsets is None:
-        now = datetime.datetime.now()
-        print(
-            "{} ... {}".format(
-                now.strftime("%b %d %H:%M:%S"), "started inferring P-site offsets"
-            )
-        )
-        psite_offsets = align_metagenes(
-            metagenes,
-            read_length_counts,
-            prefix,
-            phase_score_cutoff,
-            read_lengths is None,
-        )
-
-    # merge read lengths based on P-sites offsets
-    now = datetime.datetime.now()
-    print(
-        "{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"),
-            "started shifting according to P-site offsets",
-        )
-    )
-    merged_alignments = merge_read_lengths(alignments, psite_offsets)
-
-    # export wig file
-    now = datetime.datetime.now()
-    print(
-        "{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"),
-            "started exporting wig file of alignments after shifting",
-        )
+    # only the reads around the ORFs of the regions are needed
+    windows = None
+    if regions is not None:
+        windows = fetch_windows(ribotricer_index, regions, features=features)
+    merged_alignments = ingest_bam(
+        bam,
+        ribotricer_index,
+        prefix,
+        protocol,
+        read_lengths,
+        psite_offsets,
+        phase_score_cutoff,
+        metagene_max_orfs,
+        metagene_min_cds_reads,
+        checkpoint,
+        resume,
+        windows=windows,
     )
-    export_wig(merged_alignments, prefix)
+    if coverage_format != "none":
+        export_coverage(merged_alignments, prefix, coverage_format, bam)
 
     # saving detecting results to disk
     now = datetime.datetime.now()
@@ -481,6 +1159,11 @@ def detect_orfs(
         min_valid_codons_ratio,
         min_density_over_orf,
         report_all,
+        regions,
+        output_format,
+        compress,
+        features,
+        gene_counts,
     )
     now = datetime.datetime.now()
     print(
@@ -14,6 +14,9 @@
 # GNU General Public License for more details.
 
 from collections import defaultdict
+from multiprocessing import Pool
+import os
+
 from tqdm.autonotebook import tqdm
 
 tqdm.pandas()
@@ -92,19 +95,112 @@ class GTFTrack(object):
         return str(self.__dict__)
 
 
+def _add_track(line, transcript, cds):
+    """Parse one GTF line and file its exon or CDS track.
+
+    Parameters
+    ----------
+    line: str
+          one line in gtf file
+    transcript: dict
+                key is transcript_id, value is list of exon tracks
+    cds: dict(dict)
+         key is gene_id, then transcript_id, value is list of CDS tracks
+    """
+    track = GTFTrack.from_string(line)
+    if track is None:
+        return
+    try:
+        gid = track.gene_id
+        tid = track.transcript_id
+    except AttributeError:
+        print(
+            "missing gene or transcript id {}:{}-{}".format(
+                track.chrom, track.start, track.end
+            )
+        )
+        return
+    if track.feature == "exon":
+        transcript[tid].append(track)
+    elif track.feature == "cds":
+        cds[gid].setdefault(tid, []).append(track)
+
+
+def _chunk_offsets(gtf_location, n_chunks):
+    """Split a GTF file into byte ranges aligned to line boundaries.
+
+    Parameters
+    ----------
+    gtf_location: str
+                  Path to gtf file
+    n_chunks: int
+              Desired number of chunks
+
+    Returns
+    -------
+    offsets: List[(int, int)]
+             list of (start, end) byte offsets, half-open
+    """
+    size = os.path.getsize(gtf_location)
+    boundaries = [0]
+    with open(gtf_location, "rb") as gtf:
+        for i in range(1, n_chunks):
+            gtf.seek(size * i // n_chunks)
+            # move to the start of the next full line
+            gtf.readline()
+            pos = gtf.tell()
+            if boundaries[-1] < pos < size:
+                boundaries.append(pos)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def _parse_gtf_chunk(args):
+    """Parse exon and CDS tracks from a byte range of a GTF file.
+
+    Parameters
+    ----------
+    args: (str, int, int)
+          path to gtf file, start and end byte offsets of the chunk
+
+    Returns
+    -------
+    transcript: dict
+                key is transcript_id, value is list of exon tracks
+    cds: dict(dict)
+         key is gene_id, then transcript_id, value is list of CDS tracks
+    """
+    gtf_location, start, end = args
+    transcript = defaultdict(list)
+    cds = defaultdict(dict)
+    with open(gtf_location, "rb") as gtf:
+        gtf.seek(start)
+        while gtf.tell() < end:
+            line = gtf.readline().decode()
+            if not line:
+                break
+            _add_track(line, transcript, cds)
+    return dict(transcript), dict(cds)
+
+
 class GTFReader(object):
     """Class for reading and parseing gtf file."""
 
-    def __init__(self, gtf_location):
+    def __init__(self, gtf_location, threads=1):
         """
         Parameters
         ---------
         gtf_location : string
                        Path to gtf file
+        threads : int
+                  Number of processes to parse the gtf file with
         """
         self.gtf_location = gtf_location
         self.transcript = defaultdict(list)
         self.cds = defaultdict(lambda: defaultdict(list))
+        if threads > 1:
+            self._parallel_read(threads)
+            return
         # print('reading GTF file...')
         with open(self.gtf_location, "r") as gtf:
             total_lines = len(["" for line in gtf])
@@ -112,19 +208,33 @@ class GTFReader(object):
             with tqdm(total=total_lines, unit="lines", leave=False) as pbar:
                 for line in gtf:
                     pbar.update()
-                    track = GTFTrack.from_string(line)
-                    if track is not None:
-                        try:
-                            gid = track.gene_id
-                            tid = track.transcript_id
-                        except AttributeError:
-                            print(
-                                "missing gene or transcript id {}:{}-{}".format(
-                                    track.chrom, track.start, track.end
-                                )
-                            )
-                        else:
-                            if track.feature == "exon":
-                                self.transcript[tid].append(track)
-                            elif track.feature == "cds":
-                                self.cds[gid][tid].append(track)
+                    _add_track(line, self.transcript, self.cds)
+
+    def _parallel_read(self, threads):
+        """Parse newline-aligned chunks of the gtf file in a process pool.
+
+        Chunks are merged back in file order, so both the order of the
+        transcripts/genes and the order of the tracks within each transcript
+        are the same as for a serial read.
+
+        Parameters
+        ----------
+        threads: int
+                 Number of processes to use
+        """
+        chunks = [
+            (self.gtf_location, start, end)
+            for start, end in _chunk_offsets(self.gtf_location, threads * 4)
+        ]
+        with Pool(threads) as pool:
+            for transcript, cds in tqdm(
+                pool.imap(_parse_gtf_chunk, chunks),
+                total=len(chunks),
+                unit="chunks",
+                leave=False,
+            ):
+                for tid, tracks in transcript.items():
+                    self.transcript[tid].extend(tracks)
+                for gid, transcripts in cds.items():
+                    for tid, tracks in transcripts.items():
+                        self.cds[gid][tid].extend(tracks)
@@ -0,0 +1,891 @@
+"""Alternative layouts of the ribotricer index"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from array import array
+from collections import namedtuple
+from collections import OrderedDict
+import copy
+import os
+import sys
+
+import numpy as np
+
+from .common import mkdir_p
+from .interval import Interval
+from .orf import ORF
+from tqdm.autonotebook import tqdm
+
+tqdm.pandas()
+
+# In the deduplicated index each line is one genomic footprint, i.e. a unique
+# (chrom, strand, coordinate). The membership columns hold one value per
+# ORF of the original index sharing the footprint, separated by ';'
+# (which cannot appear in GTF attribute values). 'row' is the 0-based
+# position of the ORF in the original index.
+DEDUP_INDEX_COLUMNS = [
+    "chrom",
+    "strand",
+    "coordinate",
+    "row",
+    "ORF_ID",
+    "ORF_type",
+    "transcript_id",
+    "transcript_type",
+    "gene_id",
+    "gene_name",
+    "gene_type",
+    "start_codon",
+]
+MEMBERSHIP_SEP = ";"
+# Annotated ORFs come first in the index and in each of its shards
+ANNOTATED = "annotated"
+
+
+def is_dedup_index(ribotricer_index):
+    """Check whether an index file uses the deduplicated layout
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file
+
+    Returns
+    -------
+    is_dedup: bool
+    """
+    with open(ribotricer_index, "r") as fin:
+        header = fin.readline().rstrip("\n").split("\t")
+    return header == DEDUP_INDEX_COLUMNS
+
+
+def dedup_index(ribotricer_index, saveto):
+    """Collapse ORFs with identical genomic footprints.
+
+    Footprints are written in the order they first appear in the index,
+    so the annotated ORFs still come first.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file generated by ribotricer prepare_orfs
+    saveto: str
+            Path to output file
+
+    Returns
+    -------
+    n_footprints: int
+                  number of unique footprints
+    """
+    footprints = OrderedDict()
+    with open(ribotricer_index, "r") as fin:
+        # Skip header
+        fin.readline()
+        for row, line in enumerate(fin):
+            fields = line.rstrip("\n").split("\t")
+            oid, category, tid, ttype, gid, gname, gtype = fields[:7]
+            chrom, strand, start_codon, coordinate = fields[7:]
+            key = (chrom, strand, coordinate)
+            if key not in footprints:
+                footprints[key] = []
+            footprints[key].append(
+                (str(row), oid, category, tid, ttype, gid, gname, gtype, start_codon)
+            )
+
+    with open(saveto, "w") as output:
+        output.write("\t".join(DEDUP_INDEX_COLUMNS) + "\n")
+        for (chrom, strand, coordinate), memberships in tqdm(
+            footprints.items(), unit="footprints", leave=False
+        ):
+            columns = [MEMBERSHIP_SEP.join(values) for values in zip(*memberships)]
+            output.write("\t".join([chrom, strand, coordinate] + columns) + "\n")
+    return len(footprints)
+
+
+def footprint_categories(line):
+    """ORF types of the memberships of a deduplicated index line"""
+    return line.split("\t", 6)[5].split(MEMBERSHIP_SEP)
+
+
+def only_annotated(features):
+    """Check whether the selected ORF types are all found before the first
+    non-annotated ORF of the index
+
+    Parameters
+    ----------
+    features: set
+              set of ORF types, such as {annotated}; None for all types
+
+    Returns
+    -------
+    annotated_only: bool
+    """
+    return features is not None and set(features) <= {ANNOTATED}
+
+
+def parse_footprint(line):
+    """
+    Parameters
+    ----------
+    line: str
+          line of the deduplicated index
+
+    Returns
+    -------
+    orf: ORF
+         ORF of the first membership, used for gathering coverage
+    memberships: List[ORF]
+                 one ORF per membership
+    rows: List[int]
+          row of each membership in the original index
+    """
+    fields = line.rstrip("\n").split("\t")
+    chrom, strand, coordinate = fields[:3]
+    columns = [field.split(MEMBERSHIP_SEP) for field in fields[3:]]
+    rows = []
+    memberships = []
+    orf = None
+    for row, oid, category, tid, ttype, gid, gname, gtype, start_codon in zip(
+        *columns
+    ):
+        if orf is None:
+            orf = ORF.from_string(
+                "\t".join(
+                    [
+                        oid,
+                        category,
+                        tid,
+                        ttype,
+                        gid,
+                        gname,
+                        gtype,
+                        chrom,
+                        strand,
+                        start_codon,
+                        coordinate,
+                    ]
+                )
+            )
+            member = orf
+        else:
+            # memberships share the intervals of the footprint
+            member = copy.copy(orf)
+            member.oid = oid
+            member.category = category
+            member.tid = tid
+            member.ttype = ttype
+            member.gid = gid
+            member.gname = gname
+            member.gtype = gtype
+            member.seq = start_codon
+        rows.append(int(row))
+        memberships.append(member)
+    return orf, memberships, rows
+
+
+# The sharded index is a directory of index files (each in the standard
+# layout) plus a manifest describing the ORFs found in every shard, and the
+# order of the original index as runs of consecutive ORFs of the same shard.
+SHARD_MANIFEST_COLUMNS = [
+    "shard",
+    "chrom",
+    "min_orf_start",
+    "max_orf_start",
+    "n_orfs",
+]
+SHARD_MANIFEST = "manifest.tsv"
+SHARD_ORDER_COLUMNS = ["shard", "n_orfs"]
+SHARD_ORDER = "order.tsv"
+# Number of lines buffered per shard before appending to its file
+SHARD_BUFFER_LINES = 10000
+# Reads are fetched this many nts around the ORFs of a region, which must
+# exceed the P-site offsets
+FETCH_MARGIN = 1000
+
+
+def is_sharded_index(ribotricer_index):
+    """Check whether an index file is the manifest of a sharded index
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file
+
+    Returns
+    -------
+    is_sharded: bool
+    """
+    with open(ribotricer_index, "r") as fin:
+        header = fin.readline().rstrip("\n").split("\t")
+    return header == SHARD_MANIFEST_COLUMNS
+
+
+def parse_regions(region=None, chromosomes=None):
+    """Parse region and chromosome filters given on the command line.
+
+    Parameters
+    ----------
+    region: str
+            Comma separated regions as chrom:start-end (1-based, closed)
+            or just chrom for a whole chromosome
+    chromosomes: str
+                 Comma separated chromosome names
+
+    Returns
+    -------
+    regions: dict
+             key is the chromosome, value is a list of (start, end) or None
+             for the whole chromosome; None if no filter is given
+    """
+    if region is None and chromosomes is None:
+        return None
+    regions = {}
+    if chromosomes is not None:
+        for chrom in chromosomes.split(","):
+            chrom = chrom.strip()
+            if chrom:
+                regions[chrom] = None
+    if region is not None:
+        for term in region.split(","):
+            term = term.strip()
+            if not term:
+                continue
+            chrom, sep, span = term.rpartition(":")
+            if not sep:
+                regions[term] = None
+                continue
+            try:
+                start, end = [int(x) for x in span.split("-")]
+            except ValueError:
+                raise ValueError("invalid region {}".format(term))
+            if start < 1 or end < start:
+                raise ValueError("invalid region {}".format(term))
+            if chrom in regions and regions[chrom] is None:
+                continue
+            regions.setdefault(chrom, []).append((start, end))
+    if not regions:
+        raise ValueError("no region or chromosome given")
+    return regions
+
+
+def in_regions(chrom, start, regions):
+    """Check whether a position lies in the given regions.
+
+    ORFs are assigned to a region by their leftmost genomic position, so that
+    regions tiling the genome partition the ORFs.
+
+    Parameters
+    ----------
+    chrom: str
+           chromosome
+    start: int
+           leftmost position of the ORF
+    regions: dict
+             as returned by parse_regions
+
+    Returns
+    -------
+    selected: bool
+    """
+    if regions is None:
+        return True
+    if chrom not in regions:
+        return False
+    spans = regions[chrom]
+    if spans is None:
+        return True
+    return any(s <= start <= e for s, e in spans)
+
+
+def merge_spans(spans, margin=0):
+    """Merge overlapping genomic spans after extending them.
+
+    Parameters
+    ----------
+    spans: iterable of (str, int, int)
+           (chrom, start, end), 1-based and inclusive
+    margin: int
+            number of nts added on both sides of each span
+
+    Returns
+    -------
+    windows: List[(str, int, int)]
+             (chrom, start, end) 0-based and half-open as used by
+             pysam.AlignmentFile.fetch, sorted and not overlapping
+    """
+    by_chrom = OrderedDict()
+    for chrom, start, end in spans:
+        by_chrom.setdefault(chrom, []).append(
+            (max(0, start - 1 - margin), end + margin)
+        )
+    windows = []
+    for chrom in sorted(by_chrom):
+        merged = []
+        for start, end in sorted(by_chrom[chrom]):
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        windows.extend((chrom, start, end) for start, end in merged)
+    return windows
+
+
+def fetch_windows(ribotricer_index, regions, margin=FETCH_MARGIN, features=None):
+    """Windows of the bam file to read for scoring the ORFs in regions.
+
+    The windows cover every ORF starting within the regions, including its
+    part outside of them, plus a margin for reads whose P-site lies in the
+    ORF but whose 5' end does not.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to an index file, a deduplicated index or a
+                      sharded index manifest
+    regions: dict
+             as returned by parse_regions
+    margin: int
+            number of nts added on both sides of each ORF
+    features: set
+              if given, only ORFs of these types are scored
+
+    Returns
+    -------
+    windows: List[(str, int, int)]
+             see merge_spans
+    """
+    spans = []
+    if is_dedup_index(ribotricer_index):
+        with open(ribotricer_index, "r") as anno:
+            # Skip header
+            anno.readline()
+            for line in anno:
+                if features is not None:
+                    categories = footprint_categories(line)
+                    if only_annotated(features) and categories[0] != ANNOTATED:
+                        break
+                    if not features.intersection(categories):
+                        continue
+                chrom, _, coordinate = line.split("\t", 3)[:3]
+                start, end = _coordinate_span(coordinate)
+                if in_regions(chrom, start, regions):
+                    spans.append((chrom, start, end))
+    else:
+        for line in iter_index_lines(ribotricer_index, regions, features):
+            fields = line.rstrip("\n").split("\t")
+            spans.append((fields[7],) + _coordinate_span(fields[10]))
+    return merge_spans(spans, margin)
+
+
+def _coordinate_span(coordinate):
+    """Leftmost and rightmost positions of an index coordinate"""
+    positions = [int(x) for group in coordinate.split(",") for x in group.split("-")]
+    return min(positions), max(positions)
+
+
+def index_orf_ids(ribotricer_index):
+    """ORF IDs in the order of the index, as written by detect-orfs.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to an index file, a deduplicated index or a
+                      sharded index manifest
+
+    Returns
+    -------
+    oids: List[str]
+    """
+    if is_dedup_index(ribotricer_index):
+        members = []
+        with open(ribotricer_index, "r") as anno:
+            # Skip header
+            anno.readline()
+            for line in anno:
+                fields = line.rstrip("\n").split("\t")
+                rows = [int(row) for row in fields[3].split(MEMBERSHIP_SEP)]
+                members.extend(zip(rows, fields[4].split(MEMBERSHIP_SEP)))
+        members.sort(key=lambda x: x[0])
+        return [oid for _, oid in members]
+    return [ORF.from_string(line).oid for line in iter_index_lines(ribotricer_index)]
+
+
+def _line_start(fields):
+    """Leftmost position of the ORF of an index line"""
+    return int(fields[10].split("-", 1)[0])
+
+
+def index_files(ribotricer_index, regions=None):
+    """Index files to be read for the given regions.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to an index file or a sharded index manifest
+    regions: dict
+             as returned by parse_regions
+
+    Returns
+    -------
+    files: List[str]
+           paths to index files in the standard layout
+    """
+    if not is_sharded_index(ribotricer_index):
+        return [ribotricer_index]
+    shard_dir = os.path.dirname(os.path.abspath(ribotricer_index))
+    files = []
+    with open(ribotricer_index, "r") as fin:
+        # Skip header
+        fin.readline()
+        for line in fin:
+            fields = line.rstrip("\n").split("\t")
+            shard, chrom, min_start, max_start = fields[:4]
+            if regions is not None:
+                if chrom not in regions:
+                    continue
+                spans = regions[chrom]
+                if spans is not None and not any(
+                    s <= int(max_start) and int(min_start) <= e for s, e in spans
+                ):
+                    continue
+            files.append(os.path.join(shard_dir, shard))
+    return files
+
+
+def _index_file_lines(ribotricer_index, regions=None):
+    """Yield lines of the index files to be read for the given regions.
+
+    The shards of a sharded index are interleaved following its order
+    file, so that lines come in the order of the original index. Each run
+    of lines reopens its shard at the offset where the previous run of the
+    shard stopped.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to an index file or a sharded index manifest
+    regions: dict
+             as returned by parse_regions
+
+    Returns
+    -------
+    lines: generator of str
+    """
+    if not is_sharded_index(ribotricer_index):
+        with open(ribotricer_index, "r") as fin:
+            # Skip header
+            fin.readline()
+            for line in fin:
+                yield line
+        return
+    shard_dir = os.path.dirname(os.path.abspath(ribotricer_index))
+    # offset of the next line of each shard, past its header
+    offsets = {
+        os.path.basename(index_file): None
+        for index_file in index_files(ribotricer_index, regions)
+    }
+    with open(os.path.join(shard_dir, SHARD_ORDER), "r") as order:
+        # Skip header
+        order.readline()
+        for line in order:
+            shard, n_orfs = line.rstrip("\n").split("\t")
+            if shard not in offsets:
+                continue
+            # only one shard is open at a time
+            with open(os.path.join(shard_dir, shard), "rb") as fin:
+                if offsets[shard] is None:
+                    # Skip header
+                    fin.readline()
+                else:
+                    fin.seek(offsets[shard])
+                for _ in range(int(n_orfs)):
+                    yield fin.readline().decode()
+                offsets[shard] = fin.tell()
+
+
+def iter_index_lines(ribotricer_index, regions=None, features=None):
+    """Yield lines of a (possibly sharded) index, header excluded.
+
+    Lines of a sharded index are yielded in the order of the original index.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to an index file or a sharded index manifest
+    regions: dict
+             as returned by parse_regions; only ORFs starting within the
+             regions are yielded
+    features: set
+              if given, only ORFs of these types are yielded; if they are
+              all annotated, each file is only read up to its first
+              non-annotated ORF
+
+    Returns
+    -------
+    lines: generator of str
+    """
+    annotated_only = only_annotated(features)
+    for line in _index_file_lines(ribotricer_index, regions):
+        if features is not None:
+            category = line.split("\t", 2)[1]
+            if category not in features:
+                if annotated_only and category != ANNOTATED:
+                    return
+                continue
+        if regions is not None:
+            fields = line.split("\t")
+            if not in_regions(fields[7], _line_start(fields), regions):
+                continue
+        yield line
+
+
+def count_index_lines(ribotricer_index, regions=None, features=None):
+    """Number of ORFs in a (possibly sharded) index, see iter_index_lines"""
+    if regions is None and features is None and is_sharded_index(ribotricer_index):
+        total = 0
+        with open(ribotricer_index, "r") as fin:
+            # Skip header
+            fin.readline()
+            for line in fin:
+                total += int(line.rstrip("\n").split("\t")[4])
+        return total
+    return sum(1 for line in iter_index_lines(ribotricer_index, regions, features))
+
+
+def shard_index(ribotricer_index, outdir, block_size=None):
+    """Split an index into one shard per chromosome or per genomic block.
+
+    The order of the ORFs within every shard is the same as in the index,
+    so annotated ORFs still come first in each shard. The order of the
+    index itself is recorded in the order file of the shards.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file generated by ribotricer prepare_orfs
+    outdir: str
+            Directory to write the shards and the manifest to
+    block_size: int
+                If given, chromosomes are further split into blocks of this
+                many nts, ORFs being assigned by their leftmost position
+
+    Returns
+    -------
+    manifest: str
+              Path to the manifest of the sharded index
+    """
+    mkdir_p(outdir)
+    shards = OrderedDict()
+    buffers = {}
+    # runs of consecutive ORFs of the same shard: [shard, n_orfs]
+    runs = []
+    with open(ribotricer_index, "r") as fin:
+        header = fin.readline()
+        for line in tqdm(fin, unit="ORFs", leave=False):
+            fields = line.split("\t")
+            chrom = fields[7]
+            start = _line_start(fields)
+            key = (chrom, start // block_size if block_size else 0)
+            if key not in shards:
+                shard = "shard_{:05d}.tsv".format(len(shards))
+                shards[key] = [shard, start, start, 0]
+                buffers[key] = [header]
+                # truncate any previous shard with the same name
+                open(os.path.join(outdir, shard), "w").close()
+            stats = shards[key]
+            if runs and runs[-1][0] == stats[0]:
+                runs[-1][1] += 1
+            else:
+                runs.append([stats[0], 1])
+            stats[1] = min(stats[1], start)
+            stats[2] = max(stats[2], start)
+            stats[3] += 1
+            buffers[key].append(line)
+            if len(buffers[key]) >= SHARD_BUFFER_LINES:
+                with open(os.path.join(outdir, stats[0]), "a") as output:
+                    output.write("".join(buffers[key]))
+                buffers[key] = []
+    for key, lines in buffers.items():
+        with open(os.path.join(outdir, shards[key][0]), "a") as output:
+            output.write("".join(lines))
+
+    with open(os.path.join(outdir, SHARD_ORDER), "w") as output:
+        output.write("\t".join(SHARD_ORDER_COLUMNS) + "\n")
+        for shard, n_orfs in runs:
+            output.write("{}\t{}\n".format(shard, n_orfs))
+
+    manifest = os.path.join(outdir, SHARD_MANIFEST)
+    with open(manifest, "w") as output:
+        output.write("\t".join(SHARD_MANIFEST_COLUMNS) + "\n")
+        for (chrom, block), (shard, min_start, max_start, n_orfs) in shards.items():
+            output.write(
+                "{}\t{}\t{}\t{}\t{}\n".format(
+                    shard, chrom, min_start, max_start, n_orfs
+                )
+            )
+    return manifest
+
+
+# Columns of an index row needed for writing detect-orfs results, see
+# results.format_result
+IndexRow = namedtuple(
+    "IndexRow",
+    [
+        "oid",
+        "category",
+        "tid",
+        "ttype",
+        "gid",
+        "gname",
+        "gtype",
+        "chrom",
+        "strand",
+        "start_codon",
+    ],
+)
+STRANDS = ["+", "-"]
+
+
+class CompactIndex(object):
+    """ORFs of an index held in memory as arrays.
+
+    The intervals of all ORFs are stored as concatenated arrays of starts
+    and ends, chromosomes and strands as small integer codes and the other
+    columns as lists of shared strings, which takes a fraction of the
+    memory of ORF objects. ORFs are kept in the order of the original index.
+    """
+
+    TEXT_COLUMNS = ["oid", "category", "tid", "ttype", "gid", "gname", "gtype"]
+
+    def __init__(self):
+        self.chroms = []
+        self.chrom_codes = {}
+        self.columns = {column: [] for column in self.TEXT_COLUMNS}
+        self.start_codons = []
+        self.chrom = array("i")
+        self.strand = array("b")
+        self.starts = array("q")
+        self.ends = array("q")
+        # intervals of the i-th ORF are starts/ends[offsets[i]:offsets[i + 1]]
+        self.offsets = array("q", [0])
+
+    def __len__(self):
+        return len(self.start_codons)
+
+    def append(self, orf):
+        """
+        Parameters
+        ----------
+        orf: ORF
+             instance of ORF, whose oid is kept as is
+        """
+        for column in self.TEXT_COLUMNS:
+            value = getattr(orf, column)
+            self.columns[column].append(value if column == "oid" else sys.intern(value))
+        self.start_codons.append(orf.start_codon)
+        if orf.chrom not in self.chrom_codes:
+            self.chrom_codes[orf.chrom] = len(self.chroms)
+            self.chroms.append(orf.chrom)
+        self.chrom.append(self.chrom_codes[orf.chrom])
+        self.strand.append(STRANDS.index(orf.strand))
+        for iv in orf.intervals:
+            self.starts.append(iv.start)
+            self.ends.append(iv.end)
+        self.offsets.append(len(self.starts))
+
+    def _freeze(self):
+        self.chrom = np.frombuffer(self.chrom, dtype=np.int32)
+        self.strand = np.frombuffer(self.strand, dtype=np.int8)
+        self.starts = np.frombuffer(self.starts, dtype=np.int64)
+        self.ends = np.frombuffer(self.ends, dtype=np.int64)
+        self.offsets = np.frombuffer(self.offsets, dtype=np.int64)
+
+    @classmethod
+    def load(cls, ribotricer_index):
+        """
+        Parameters
+        ----------
+        ribotricer_index: str
+                          Path to an index file, a deduplicated index or a
+                          sharded index manifest
+
+        Returns
+        -------
+        index: CompactIndex
+        """
+        index = cls()
+        if is_dedup_index(ribotricer_index):
+            members = []
+            with open(ribotricer_index, "r") as anno:
+                # Skip header
+                anno.readline()
+                for line in tqdm(anno, unit="footprints", leave=False):
+                    _, memberships, rows = parse_footprint(line)
+                    members.extend(zip(rows, memberships))
+            members.sort(key=lambda x: x[0])
+            for _, orf in members:
+                index.append(orf)
+        else:
+            for line in tqdm(
+                iter_index_lines(ribotricer_index), unit="ORFs", leave=False
+            ):
+                orf = ORF.from_string(line)
+                if orf is not None:
+                    index.append(orf)
+        index._freeze()
+        return index
+
+    def row(self, i):
+        """
+        Returns
+        -------
+        row: IndexRow
+             columns of the i-th ORF used in detect-orfs output
+        """
+        return IndexRow(
+            *[self.columns[column][i] for column in self.TEXT_COLUMNS],
+            self.chroms[self.chrom[i]],
+            STRANDS[self.strand[i]],
+            self.start_codons[i],
+        )
+
+    def orf(self, i):
+        """
+        Returns
+        -------
+        orf: ORF
+             the i-th ORF
+        """
+        chrom = self.chroms[self.chrom[i]]
+        strand = STRANDS[self.strand[i]]
+        first, last = self.offsets[i], self.offsets[i + 1]
+        intervals = [
+            Interval(chrom, start, end, strand)
+            for start, end in zip(
+                self.starts[first:last].tolist(), self.ends[first:last].tolist()
+            )
+        ]
+        orf = ORF(
+            *[self.columns[column][i] for column in self.TEXT_COLUMNS[1:]],
+            chrom,
+            strand,
+            intervals,
+            seq=self.start_codons[i] or "",
+        )
+        orf.oid = self.columns["oid"][i]
+        return orf
+
+    def annotated(self):
+        """
+        Returns
+        -------
+        annotated: List[ORF]
+                   ORFs of CDS annotated, in the order of the index
+        """
+        return [
+            self.orf(i)
+            for i, category in enumerate(self.columns["category"])
+            if category == "annotated"
+        ]
+
+    def select(self, regions=None, features=None):
+        """
+        Parameters
+        ----------
+        regions: dict
+                 as returned by parse_regions
+        features: set
+                  if given, only ORFs of these types are selected
+
+        Returns
+        -------
+        rows: array
+              indices of the ORFs starting within the regions
+        """
+        rows = np.arange(len(self))
+        if features is not None:
+            rows = np.array(
+                [
+                    i
+                    for i, category in enumerate(self.columns["category"])
+                    if category in features
+                ],
+                dtype=np.int64,
+            )
+        if regions is None:
+            return rows
+        first = self.starts[self.offsets[rows]].tolist()
+        return np.array(
+            [
+                i
+                for i, code, start in zip(
+                    rows.tolist(), self.chrom[rows].tolist(), first
+                )
+                if in_regions(self.chroms[code], start, regions)
+            ],
+            dtype=np.int64,
+        )
+
+    def fetch_windows(self, regions, margin=FETCH_MARGIN, features=None):
+        """Windows of the bam file to read for scoring the ORFs in regions,
+        see index.fetch_windows"""
+        rows = self.select(regions, features)
+        first = self.offsets[rows]
+        last = self.offsets[rows + 1] - 1
+        return merge_spans(
+            zip(
+                [self.chroms[code] for code in self.chrom[rows].tolist()],
+                self.starts[first].tolist(),
+                self.ends[last].tolist(),
+            ),
+            margin,
+        )
+
+    def genome_positions(self, rows):
+        """Genomic positions covered by a batch of ORFs, 5' to 3'.
+
+        Parameters
+        ----------
+        rows: array
+              indices of the ORFs
+
+        Returns
+        -------
+        positions: array
+                   concatenated positions of the ORFs, reversed for ORFs on
+                   the negative strand as in orf_coverage
+        offsets: array
+                 positions of the j-th ORF are positions[offsets[j]:offsets[j + 1]]
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        n_intervals = self.offsets[rows + 1] - self.offsets[rows]
+        first_interval = np.repeat(self.offsets[rows], n_intervals)
+        interval_offsets = np.concatenate([[0], np.cumsum(n_intervals)])
+        intervals = first_interval + (
+            np.arange(interval_offsets[-1])
+            - np.repeat(interval_offsets[:-1], n_intervals)
+        )
+        lengths = self.ends[intervals] - self.starts[intervals] + 1
+        length_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        positions = np.repeat(self.starts[intervals], lengths) + (
+            np.arange(length_offsets[-1]) - np.repeat(length_offsets[:-1], lengths)
+        )
+        offsets = length_offsets[interval_offsets]
+        # reverse the positions of each ORF on the negative strand
+        orf_lengths = np.diff(offsets)
+        owner = np.repeat(np.arange(len(rows)), orf_lengths)
+        order = np.arange(len(positions))
+        reverse = self.strand[rows][owner] == 1
+        order[reverse] = (offsets[owner] + offsets[owner + 1] - 1 - order)[reverse]
+        return positions[order], offsets
@@ -25,6 +25,7 @@ from .const import MINIMUM_READS_PER_CODON
 from .const import MINIMUM_DENSITY_OVER_ORF
 
 from .detect_orfs import detect_orfs
+from .results import read_detected_table
 
 
 def determine_cutoff_tsv(
@@ -48,19 +49,15 @@ def determine_cutoff_tsv(
     """
     ribo_df = pd.DataFrame()
     for tsv in ribo_tsvs:
-        df = pd.read_csv(
-            tsv,
-            sep="\t",
-            usecols=["ORF_ID", "ORF_type", "phase_score", "transcript_type"],
+        df = read_detected_table(
+            tsv, usecols=["ORF_ID", "ORF_type", "phase_score", "transcript_type"]
         )
         ribo_df = pd.concat([ribo_df, df])
 
     rna_df = pd.DataFrame()
     for tsv in rna_tsvs:
-        df = pd.read_csv(
-            tsv,
-            sep="\t",
-            usecols=["ORF_ID", "ORF_type", "phase_score", "transcript_type"],
+        df = read_detected_table(
+            tsv, usecols=["ORF_ID", "ORF_type", "phase_score", "transcript_type"]
         )
         rna_df = pd.concat([rna_df, df])
 
@@ -0,0 +1,695 @@
+"""Detect translating ORFs one chromosome at a time"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from collections import Counter
+from collections import defaultdict
+from collections import OrderedDict
+import datetime
+import heapq
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pysam
+from tqdm.autonotebook import tqdm
+
+from .bam import _count_reads
+from .bam import chrom_sizes
+from .bam import fetch_reads
+from .bam import split_reads
+from .bam import write_bam_summary
+from .checkpoint import CheckpointStore
+from .checkpoint import load_alignments
+from .checkpoint import save_alignments
+from .common import mkdir_p
+from .common import parent_dir
+from .const import CUTOFF
+from .const import MINIMUM_DENSITY_OVER_ORF
+from .const import MINIMUM_READS_PER_CODON
+from .const import MINIMUM_VALID_CODONS
+from .const import MINIMUM_VALID_CODONS_RATIO
+from .count_orfs import GeneCounts
+from .detect_orfs import annotated_refseq
+from .detect_orfs import coverage_arrays
+from .detect_orfs import CoverageWriter
+from .detect_orfs import merge_read_lengths
+from .detect_orfs import orf_coverage
+from .detect_orfs import score_coverage
+from .index import _coordinate_span
+from .index import _line_start
+from .index import ANNOTATED
+from .index import FETCH_MARGIN
+from .index import footprint_categories
+from .index import in_regions
+from .index import IndexRow
+from .index import is_dedup_index
+from .index import iter_index_lines
+from .index import merge_spans
+from .index import only_annotated
+from .index import parse_footprint
+from .index import SHARD_BUFFER_LINES
+from .infer_protocol import infer_protocol
+from .metagene import align_metagenes
+from .metagene import cds_read_counts
+from .metagene import metagene_sums
+from .metagene import profiles_from_sums
+from .metagene import rank_metagene_cds
+from .metagene import remove_rare_lengths
+from .metagene import score_metagene_profiles
+from .orf import ORF
+from .plotting import plot_metagene
+from .plotting import plot_read_lengths
+from .results import _open_text
+from .results import _parse_profile
+from .results import format_result
+from .results import OUTPUT_COLUMNS
+from .results import result_path
+from .results import result_writer
+
+# Maximum number of sorted chromosome results merged at once
+MERGE_FAN_IN = 256
+
+
+def split_index_by_chrom(ribotricer_index, regions, outdir, features=None):
+    """Split the ORFs of an index into one file per chromosome.
+
+    Each line of the files is the row of the ORF in the index followed by
+    its index line; for a deduplicated index the footprint lines are kept
+    as they are, since they hold the rows of their memberships.
+
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to an index file, a deduplicated index or a
+                      sharded index manifest
+    regions: dict
+             if given, only ORFs starting within these regions are kept,
+             see index.parse_regions
+    outdir: str
+            Directory to write the files to
+    features: set
+              if given, only ORFs of these types are kept
+
+    Returns
+    -------
+    files: OrderedDict
+           key is the chromosome, value is the path of its file
+    annotated: List[ORF]
+               ORFs of CDS annotated, in the order of the index
+    spans: List[(str, int, int)]
+           (chrom, start, end) of the kept ORFs if regions are given
+    """
+    dedup = is_dedup_index(ribotricer_index)
+    # the annotated ORFs are always read for the metagene profiles
+    if features is not None:
+        features = set(features)
+        index_features = features | {ANNOTATED}
+    else:
+        index_features = None
+    files = OrderedDict()
+    buffers = {}
+    annotated = []
+    spans = []
+
+    def _append(chrom, line):
+        if chrom not in files:
+            files[chrom] = os.path.join(outdir, "index_{:05d}.tsv".format(len(files)))
+            buffers[chrom] = []
+            open(files[chrom], "w").close()
+        buffers[chrom].append(line)
+        if len(buffers[chrom]) >= SHARD_BUFFER_LINES:
+            with open(files[chrom], "a") as output:
+                output.write("".join(buffers[chrom]))
+            buffers[chrom] = []
+
+    if dedup:
+        in_annotated = True
+        with open(ribotricer_index, "r") as anno:
+            # Skip header
+            anno.readline()
+            for line in tqdm(anno, unit="footprints", leave=False):
+                # footprints whose first membership is not annotated
+                # come after all annotated ones
+                categories = footprint_categories(line)
+                if in_annotated:
+                    in_annotated = categories[0] == ANNOTATED
+                    if in_annotated:
+                        _, memberships, rows = parse_footprint(line)
+                        annotated.extend(
+                            (row, member)
+                            for row, member in zip(rows, memberships)
+                            if member.category == ANNOTATED
+                        )
+                if features is not None and not features.intersection(categories):
+                    if only_annotated(index_features) and not in_annotated:
+                        break
+                    continue
+                chrom, _, coordinate = line.split("\t", 3)[:3]
+                start, end = _coordinate_span(coordinate)
+                if not in_regions(chrom, start, regions):
+                    continue
+                if regions is not None:
+                    spans.append((chrom, start, end))
+                _append(chrom, line)
+        annotated = [orf for _, orf in sorted(annotated, key=lambda x: x[0])]
+    else:
+        # rows are only used for sorting, so skipped lines do not matter
+        for row, line in enumerate(
+            tqdm(
+                iter_index_lines(ribotricer_index, features=index_features),
+                unit="ORFs",
+                leave=False,
+            )
+        ):
+            fields = line.split("\t")
+            if fields[1] == ANNOTATED:
+                orf = ORF.from_string(line)
+                if orf is not None:
+                    annotated.append(orf)
+            if features is not None and fields[1] not in features:
+                continue
+            chrom = fields[7]
+            if not in_regions(chrom, _line_start(fields), regions):
+                continue
+            if regions is not None:
+                spans.append((chrom,) + _coordinate_span(fields[10]))
+            _append(chrom, "{}\t{}".format(row, line))
+    for chrom, lines in buffers.items():
+        with open(files[chrom], "a") as output:
+            output.write("".join(lines))
+    return files, annotated, spans
+
+
+def score_chrom_orfs(
+    index_file,
+    dedup,
+    merged_alignments,
+    thresholds,
+    report_all,
+    saveto,
+    features=None,
+    counts=None,
+):
+    """Score the ORFs of one chromosome.
+
+    Parameters
+    ----------
+    index_file: str
+                Path to the ORFs of the chromosome, see split_index_by_chrom
+    dedup: bool
+           Whether the ORFs come from a deduplicated index
+    merged_alignments: dict(Counter)
+                       alignments of the chromosome by merging all lengths
+    thresholds: tuple
+                cutoffs passed to score_coverage
+    report_all: bool
+                Whether to keep all ORFs regardless of translation status
+    saveto: str
+            Path to output file; each line is the row of the ORF in the
+            index followed by its detect-orfs output line, sorted by row
+    features: set
+              if given, only the memberships of these types are written
+              for a deduplicated index
+    counts: GeneCounts
+            if given, the read counts of the genes of the written ORFs are
+            added to it
+
+    Returns
+    -------
+    n_rows: int
+            number of written ORFs
+    """
+    records = []
+    with open(index_file, "r") as fin:
+        for line in tqdm(fin, unit="ORFs", leave=False):
+            if dedup:
+                orf, memberships, rows = parse_footprint(line)
+            else:
+                row, line = line.split("\t", 1)
+                orf = ORF.from_string(line)
+                memberships, rows = [orf], [int(row)]
+            cov = orf_coverage(orf, merged_alignments)
+            scores = score_coverage(cov, *thresholds)
+            if not report_all and scores[0] == "nontranslating":
+                continue
+            for row, member in zip(rows, memberships):
+                if features is not None and member.category not in features:
+                    continue
+                records.append((row, format_result(member, scores, cov)))
+                if counts is not None:
+                    counts.add(member)
+    if counts is not None:
+        counts.count(coverage_arrays(merged_alignments))
+    records.sort(key=lambda x: x[0])
+    with open(saveto, "w") as output:
+        output.writelines("{}\t{}".format(row, line) for row, line in records)
+    return len(records)
+
+
+def _record_row(line):
+    return int(line.split("\t", 1)[0])
+
+
+def _merge_record_files(paths, saveto):
+    files = [open(path, "r") for path in paths]
+    try:
+        with open(saveto, "w") as output:
+            output.writelines(heapq.merge(*files, key=_record_row))
+    finally:
+        for fh in files:
+            fh.close()
+
+
+def _parse_result(line):
+    """Inverse of results.format_result"""
+    fields = line.rstrip("\n").split("\t")
+    row = IndexRow(*(fields[:2] + fields[9:17]))
+    scores = (
+        fields[2],
+        float(fields[3]),
+        int(fields[4]),
+        int(fields[5]),
+        int(fields[6]),
+        float(fields[7]),
+        float(fields[8]),
+    )
+    return row, scores, _parse_profile(fields[17])
+
+
+def merge_chrom_results(paths, saveto, output_format, tmpdir):
+    """Merge the sorted results of all chromosomes into index order.
+
+    Parameters
+    ----------
+    paths: List[str]
+           outputs of score_chrom_orfs
+    saveto: str
+            Path to the detect-orfs output
+    output_format: str
+                   {'tsv', 'parquet', 'npz'}
+    tmpdir: str
+            Directory for intermediate merges, when there are more than
+            MERGE_FAN_IN files
+
+    Returns
+    -------
+    n_rows: int
+            number of merged ORFs
+    """
+    paths = list(paths)
+    n_rounds = 0
+    while len(paths) > MERGE_FAN_IN:
+        merged = []
+        for first in range(0, len(paths), MERGE_FAN_IN):
+            path = os.path.join(
+                tmpdir, "merged_{}_{:05d}.tsv".format(n_rounds, len(merged))
+            )
+            _merge_record_files(paths[first : first + MERGE_FAN_IN], path)
+            merged.append(path)
+        paths = merged
+        n_rounds += 1
+
+    n_rows = 0
+    files = [open(path, "r") for path in paths]
+    try:
+        records = heapq.merge(*files, key=_record_row)
+        if output_format == "tsv":
+            with _open_text(saveto, "w") as output:
+                output.write("\t".join(OUTPUT_COLUMNS))
+                for record in records:
+                    output.write(record.split("\t", 1)[1])
+                    n_rows += 1
+        else:
+            writer = result_writer(saveto, output_format)
+            for record in records:
+                writer.write(*_parse_result(record.split("\t", 1)[1]))
+                n_rows += 1
+            writer.close()
+    finally:
+        for fh in files:
+            fh.close()
+    return n_rows
+
+
+def detect_orfs_low_memory(
+    bam,
+    ribotricer_index,
+    prefix,
+    protocol,
+    read_lengths,
+    psite_offsets,
+    phase_score_cutoff=CUTOFF,
+    min_valid_codons=MINIMUM_VALID_CODONS,
+    min_reads_per_codon=MINIMUM_READS_PER_CODON,
+    min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
+    min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
+    report_all=False,
+    regions=None,
+    metagene_max_orfs=None,
+    metagene_min_cds_reads=0,
+    coverage_format="wig",
+    output_format="tsv",
+    compress=False,
+    features=None,
+    gene_counts=False,
+):
+    """Detect translating ORFs holding the reads of one chromosome at a time.
+
+    A first pass reads the bam file chromosome by chromosome, adding the
+    reads on the CDSs to the metagene profiles and saving the alignments
+    of each chromosome to a temporary file. Once the P-site offsets are
+    known, a second pass shifts the alignments of each chromosome, exports
+    their coverage and scores the ORFs on it. The scored ORFs of all
+    chromosomes are finally merged into the order of the index.
+
+    The outputs are the same as those of detect_orfs, see detect_orfs for
+    the parameters. Peak memory depends on the largest chromosome rather
+    than on the whole genome.
+    """
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ..... started ribotricer detect-orfs"))
+
+    # create directory
+    mkdir_p(parent_dir(prefix))
+    tmpdir = tempfile.mkdtemp(
+        prefix="ribotricer_low_memory_", dir=parent_dir(prefix) or "."
+    )
+    try:
+        _detect_orfs_low_memory(
+            tmpdir,
+            bam,
+            ribotricer_index,
+            prefix,
+            protocol,
+            read_lengths,
+            psite_offsets,
+            (
+                phase_score_cutoff,
+                min_valid_codons,
+                min_reads_per_codon,
+                min_valid_codons_ratio,
+                min_density_over_orf,
+            ),
+            report_all,
+            regions,
+            metagene_max_orfs,
+            metagene_min_cds_reads,
+            coverage_format,
+            output_format,
+            compress,
+            features,
+            gene_counts,
+        )
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "finished ribotricer detect-orfs"
+        )
+    )
+
+
+def _detect_orfs_low_memory(
+    tmpdir,
+    bam,
+    ribotricer_index,
+    prefix,
+    protocol,
+    read_lengths,
+    psite_offsets,
+    thresholds,
+    report_all,
+    regions,
+    metagene_max_orfs,
+    metagene_min_cds_reads,
+    coverage_format,
+    output_format,
+    compress,
+    features,
+    gene_counts,
+):
+    """See detect_orfs_low_memory, tmpdir holding the temporary files"""
+    phase_score_cutoff = thresholds[0]
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started splitting ribotricer index file by chromosome",
+        )
+    )
+    dedup = is_dedup_index(ribotricer_index)
+    index_by_chrom, annotated, spans = split_index_by_chrom(
+        ribotricer_index, regions, tmpdir, features
+    )
+    sizes = chrom_sizes(bam)
+    # only the reads around the ORFs of the regions are needed
+    if regions is not None:
+        windows = defaultdict(list)
+        for window in merge_spans(spans, FETCH_MARGIN):
+            windows[window[0]].append(window)
+    else:
+        windows = {chrom: [(chrom, 0, size)] for chrom, size in sizes.items()}
+    del spans
+
+    # infer experimental protocol if not provided
+    if protocol is None:
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"), "started inferring experimental design"
+            )
+        )
+        protocol = infer_protocol(bam, annotated_refseq(annotated), prefix)
+
+    # CDSs of each chromosome, as indices into annotated
+    cds_by_chrom = defaultdict(list)
+    for i, orf in enumerate(annotated):
+        cds_by_chrom[orf.chrom].append(i)
+    sampling = None
+    sample_cds = metagene_max_orfs is not None or metagene_min_cds_reads > 0
+    if sample_cds:
+        cds_counts = np.zeros(len(annotated), dtype=np.int64)
+
+    # first pass: split the reads of each chromosome and save them
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started reading bam file one chromosome at a time",
+        )
+    )
+    store = CheckpointStore(tmpdir, resume=True)
+    spilled = OrderedDict()
+    read_length_counts = defaultdict(int)
+    stats = Counter()
+    chroms = [chrom for chrom in sizes if chrom in windows]
+    total_reads = _count_reads(
+        bam, None if regions is None else [w for c in chroms for w in windows[c]]
+    )
+    with pysam.AlignmentFile(bam, "rb") as fin, tqdm(
+        total=total_reads, unit="reads", leave=False
+    ) as pbar:
+        for chrom in chroms:
+            alignments = defaultdict(lambda: defaultdict(Counter))
+            split_reads(
+                fetch_reads(fin, windows[chrom]),
+                protocol,
+                read_lengths,
+                alignments,
+                read_length_counts,
+                stats,
+                pbar,
+            )
+            if not alignments:
+                continue
+            if sample_cds:
+                rows = cds_by_chrom[chrom]
+                cds_counts[rows] = cds_read_counts(
+                    [annotated[i] for i in rows], alignments, list(alignments)
+                )
+            spilled[chrom] = "alignments_{:05d}".format(len(spilled))
+            save_alignments(
+                store, chrom, protocol, alignments, {}, stage=spilled[chrom]
+            )
+            del alignments
+        if regions is None:
+            # reads without coordinates are only counted for the summary
+            split_reads(
+                fin.fetch("*"),
+                protocol,
+                read_lengths,
+                defaultdict(lambda: defaultdict(Counter)),
+                read_length_counts,
+                stats,
+                pbar,
+            )
+    write_bam_summary(prefix, stats, read_length_counts)
+
+    # plot read length distribution
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "started plotting read length distribution"
+        )
+    )
+    plot_read_lengths(read_length_counts, prefix)
+
+    # select CDSs for metagene profiles
+    selected = np.arange(len(annotated))
+    if sample_cds:
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"),
+                "started ranking CDSs by coverage for metagene profiles",
+            )
+        )
+        selected = rank_metagene_cds(
+            cds_counts, metagene_max_orfs, metagene_min_cds_reads
+        )
+        sampling = (
+            "metagene CDSs: {} of {} (metagene_max_orfs: {}, "
+            "metagene_min_cds_reads: {})"
+        ).format(
+            len(selected), len(annotated), metagene_max_orfs, metagene_min_cds_reads
+        )
+    metagene_cds = defaultdict(list)
+    for i in selected.tolist():
+        metagene_cds[annotated[i].chrom].append(annotated[i])
+    del annotated, cds_by_chrom
+
+    # calculate metagene profiles
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started calculating metagene profiles, one chromosome at a time",
+        )
+    )
+    remove_rare_lengths(read_length_counts)
+    lengths = list(read_length_counts)
+    sums = None
+    for chrom, stage in spilled.items():
+        if not metagene_cds[chrom]:
+            continue
+        _, alignments, _ = load_alignments(store, chrom, stage)
+        sums = metagene_sums(metagene_cds[chrom], alignments, lengths, sums=sums)
+        del alignments
+    if sums is None:
+        sums = metagene_sums([], {}, lengths)
+    del metagene_cds
+    metagenes = score_metagene_profiles(profiles_from_sums(sums, lengths), prefix)
+
+    # plot metagene profiles
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "started plotting metagene profiles"
+        )
+    )
+    plot_metagene(metagenes, read_length_counts, prefix)
+
+    # align metagenes if psite_offsets not provided
+    if psite_offsets is None:
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"), "started inferring P-site offsets"
+            )
+        )
+        psite_offsets = align_metagenes(
+            metagenes,
+            read_length_counts,
+            prefix,
+            phase_score_cutoff,
+            read_lengths is None,
+            sampling,
+        )
+    del metagenes
+
+    # second pass: shift, export and score one chromosome at a time, in
+    # the order of the coverage files
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started calculating phase scores for each ORF, one chromosome at a time",
+        )
+    )
+    chroms = list(spilled) + [c for c in index_by_chrom if c not in spilled]
+    if coverage_format == "wig":
+        chroms.sort()
+    else:
+        order = {chrom: i for i, chrom in enumerate(sizes)}
+        chroms.sort(key=lambda chrom: order.get(chrom, len(order)))
+    counts = GeneCounts() if gene_counts else None
+    coverage_writer = None
+    if coverage_format != "none":
+        coverage_writer = CoverageWriter(prefix, coverage_format, sizes)
+    results = []
+    for n, chrom in enumerate(chroms):
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"),
+                "processing chromosome {} ({} of {})".format(chrom, n + 1, len(chroms)),
+            )
+        )
+        merged_alignments = defaultdict(Counter)
+        if chrom in spilled:
+            _, alignments, _ = load_alignments(store, chrom, spilled[chrom])
+            merged_alignments = merge_read_lengths(alignments, psite_offsets, True)
+            del alignments
+            os.remove(store.path(spilled[chrom]))
+        if coverage_writer is not None:
+            coverage_writer.write(merged_alignments)
+        if chrom in index_by_chrom:
+            saveto = os.path.join(tmpdir, "results_{:05d}.tsv".format(len(results)))
+            score_chrom_orfs(
+                index_by_chrom[chrom],
+                dedup,
+                merged_alignments,
+                thresholds,
+                report_all,
+                saveto,
+                features,
+                counts,
+            )
+            results.append(saveto)
+        del merged_alignments
+    if coverage_writer is not None:
+        coverage_writer.close()
+
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started merging the ORFs of all chromosomes in index order",
+        )
+    )
+    n_rows = merge_chrom_results(
+        results, result_path(prefix, output_format, compress), output_format, tmpdir
+    )
+    if counts is not None:
+        counts.write("{}_gene_counts.tsv".format(prefix))
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "wrote {} ORFs".format(n_rows)
+        )
+    )
@@ -17,7 +17,7 @@ from .statistics import phasescore
 from .interval import Interval
 from .const import CUTOFF, TYPICAL_OFFSET
 import sys
-from collections import Counter, OrderedDict
+from collections import OrderedDict, defaultdict
 
 import numpy as np
 import pandas as pd
@@ -53,18 +53,12 @@ def next_genome_pos(ivs, max_positions, leader, trailer, reverse=False):
                     yield pos
 
 
-def orf_coverage_length(
-    orf, alignments, length, max_positions, offset_5p=20, offset_3p=0
-):
+def orf_genome_positions(orf, max_positions, offset_5p=20, offset_3p=0):
     """
     Parameters
     ----------
     orf: ORF
          instance of ORF
-    alignments: dict(dict(Counter))
-                alignments summarized from bam
-    length: int
-            the target length
     max_positions: int
                    the number of nts to include
     offset_5p: int
@@ -74,43 +68,261 @@ def orf_coverage_length(
 
     Returns
     -------
-    from_start: Series
-                coverage for ORF for specific length aligned at start codon
-    from_stop: Series
-               coverage for ORF for specific length aligned at stop codon
+    positions: List[int]
+               genomic positions from offset_5p nts upstream of the start
+               codon, in the transcript orientation
     """
-    coverage = []
-    chrom = orf.chrom
-    strand = orf.strand
-    if strand == "-":
+    if orf.strand == "-":
         offset_5p, offset_3p = offset_3p, offset_5p
+    return list(
+        next_genome_pos(
+            orf.intervals, max_positions, offset_5p, offset_3p, orf.strand == "-"
+        )
+    )
 
-    for pos in next_genome_pos(
-        orf.intervals, max_positions, offset_5p, offset_3p, strand == "-"
-    ):
-        try:
-            coverage.append(alignments[length][strand][(chrom, pos)])
-        except KeyError:
-            coverage.append(0)
 
-    if strand == "-":
-        from_start = pd.Series(
-            np.array(coverage), index=np.arange(-offset_3p, len(coverage) - offset_3p)
+def orf_coverage_matrix(orf, alignments, lengths, positions):
+    """
+    Parameters
+    ----------
+    orf: ORF
+         instance of ORF
+    alignments: dict(dict(Counter))
+                alignments summarized from bam
+    lengths: List[int]
+             the target lengths
+    positions: List[int]
+               genomic positions as returned by orf_genome_positions
+
+    Returns
+    -------
+    coverage: array
+              (lengths x positions) coverage of the ORF, one row per length
+    """
+    keys = [(orf.chrom, pos) for pos in positions]
+    coverage = np.zeros((len(lengths), len(keys)), dtype=np.int64)
+    for i, length in enumerate(lengths):
+        counts = alignments[length][orf.strand]
+        coverage[i] = [counts.get(key, 0) for key in keys]
+    return coverage
+
+
+def cds_read_counts(cds, alignments, read_lengths):
+    """Count the reads whose 5' end falls within each CDS.
+
+    Positions of all read lengths are collected into sorted arrays per
+    strand and chromosome, so each CDS interval is summed with two
+    binary searches on the cumulative counts.
+
+    Parameters
+    ----------
+    cds: List[ORF]
+         list of cds
+    alignments: dict(dict(Counter))
+                alignments summarized from bam
+    read_lengths: List[int]
+                  the read lengths to count
+
+    Returns
+    -------
+    counts: array
+            number of reads of each CDS, in the order of cds
+    """
+    positions = defaultdict(list)
+    weights = defaultdict(list)
+    for length in read_lengths:
+        for strand in alignments[length]:
+            for (chrom, pos), count in alignments[length][strand].items():
+                positions[(strand, chrom)].append(pos)
+                weights[(strand, chrom)].append(count)
+    store = {}
+    for key in positions:
+        pos = np.array(positions[key], dtype=np.int64)
+        order = np.argsort(pos, kind="stable")
+        cumsum = np.concatenate(
+            [[0], np.cumsum(np.array(weights[key], dtype=np.int64)[order])]
         )
-        from_stop = pd.Series(
-            np.array(coverage),
-            index=np.arange(offset_5p - len(coverage) + 1, offset_5p + 1),
+        store[key] = (pos[order], cumsum)
+    del positions, weights
+
+    counts = np.zeros(len(cds), dtype=np.int64)
+    for i, orf in enumerate(cds):
+        key = (orf.strand, orf.chrom)
+        if key not in store:
+            continue
+        pos, cumsum = store[key]
+        for iv in orf.intervals:
+            first = np.searchsorted(pos, iv.start, side="left")
+            last = np.searchsorted(pos, iv.end, side="right")
+            counts[i] += cumsum[last] - cumsum[first]
+    return counts
+
+
+def sample_metagene_cds(cds, alignments, read_lengths, max_orfs=None, min_reads=0):
+    """Select the best covered CDSs for metagene profiles.
+
+    Parameters
+    ----------
+    cds: List[ORF]
+         list of cds
+    alignments: dict(dict(Counter))
+                alignments summarized from bam
+    read_lengths: List[int]
+                  the read lengths to count
+    max_orfs: int
+              maximum number of CDSs to keep, all if None
+    min_reads: int
+               minimum number of reads for a CDS to be kept
+
+    Returns
+    -------
+    selected: List[ORF]
+              the CDSs with the most reads, in their original order
+    """
+    counts = cds_read_counts(cds, alignments, read_lengths)
+    return [cds[i] for i in rank_metagene_cds(counts, max_orfs, min_reads)]
+
+
+def rank_metagene_cds(counts, max_orfs=None, min_reads=0):
+    """
+    Parameters
+    ----------
+    counts: array
+            number of reads of each CDS, as returned by cds_read_counts
+    max_orfs: int
+              maximum number of CDSs to keep, all if None
+    min_reads: int
+               minimum number of reads for a CDS to be kept
+
+    Returns
+    -------
+    selected: array
+              indices of the CDSs with the most reads, sorted
+    """
+    # ties are broken by the order in the index
+    ranked = np.argsort(-counts, kind="stable")
+    ranked = ranked[counts[ranked] >= min_reads]
+    if max_orfs is not None:
+        ranked = ranked[:max_orfs]
+    return np.sort(ranked)
+
+
+def metagene_profiles(
+    cds, alignments, lengths, max_positions=600, offset_5p=20, offset_3p=0
+):
+    """Compute metagene profiles of several read lengths at once.
+
+    The genomic positions of each CDS are generated once and the coverage
+    of all read lengths is gathered into a single matrix.
+
+    Parameters
+    ----------
+    cds: List[ORF]
+         list of cds
+    alignments: dict(dict(Counter))
+                alignments summarized from bam
+    lengths: List[int]
+             the read lengths to compute the profiles for
+    max_positions: int
+                   the number of nts to include
+    offset_5p: int
+               the number of nts to include from the 5'prime
+    offset_3p: int
+               the number of nts to include from the 3'prime
+
+    Returns
+    -------
+    profiles: OrderedDict
+              key is the length, value is (from_start, from_stop), the mean
+              normalized coverage aligned at the start and stop codons
+    """
+    lengths = list(lengths)
+    sums = metagene_sums(cds, alignments, lengths, max_positions, offset_5p, offset_3p)
+    return profiles_from_sums(sums, lengths, offset_5p, offset_3p)
+
+
+def metagene_sums(
+    cds, alignments, lengths, max_positions=600, offset_5p=20, offset_3p=0, sums=None
+):
+    """Sum the normalized coverage of CDSs, see metagene_profiles.
+
+    The sums can be accumulated over several calls, e.g. one chromosome
+    at a time, before being turned into profiles by profiles_from_sums.
+
+    Parameters
+    ----------
+    sums: tuple
+          sums returned by a previous call with the same lengths, updated
+          in place; new sums are allocated if None
+
+    Returns
+    -------
+    sums: tuple
+          (sum_start, count_start, sum_stop, count_stop), arrays of
+          (lengths x max_positions)
+    """
+    lengths = list(lengths)
+    if sums is None:
+        # The profiles aligned at the start codon all begin offset_5p nts
+        # upstream and those aligned at the stop codon all end offset_3p nts
+        # downstream, so both fit in arrays of max_positions
+        sums = (
+            np.zeros((len(lengths), max_positions)),
+            np.zeros((len(lengths), max_positions), dtype=np.int64),
+            np.zeros((len(lengths), max_positions)),
+            np.zeros((len(lengths), max_positions), dtype=np.int64),
         )
-    else:
+    sum_start, count_start, sum_stop, count_stop = sums
+
+    for orf in tqdm(cds, unit="ORFs", leave=False):
+        positions = orf_genome_positions(orf, max_positions, offset_5p, offset_3p)
+        n_positions = len(positions)
+        if n_positions == 0 or not lengths:
+            continue
+        coverage = orf_coverage_matrix(orf, alignments, lengths, positions)
+        cov_mean = coverage.sum(axis=1, dtype=np.float64) / n_positions
+        covered = cov_mean > 0
+        if not covered.any():
+            continue
+        normalized = coverage[covered] / cov_mean[covered, np.newaxis]
+        sum_start[covered, :n_positions] += normalized
+        count_start[covered, :n_positions] += 1
+        sum_stop[covered, max_positions - n_positions :] += normalized
+        count_stop[covered, max_positions - n_positions :] += 1
+    return sums
+
+
+def profiles_from_sums(sums, lengths, offset_5p=20, offset_3p=0):
+    """
+    Parameters
+    ----------
+    sums: tuple
+          as returned by metagene_sums
+    lengths: List[int]
+             the read lengths of the sums
+
+    Returns
+    -------
+    profiles: OrderedDict
+              see metagene_profiles
+    """
+    sum_start, count_start, sum_stop, count_stop = sums
+    max_positions = sum_start.shape[1]
+    profiles = OrderedDict()
+    for i, length in enumerate(lengths):
+        n_start = np.count_nonzero(count_start[i])
         from_start = pd.Series(
-            np.array(coverage), index=np.arange(-offset_5p, len(coverage) - offset_5p)
+            sum_start[i, :n_start] / count_start[i, :n_start],
+            index=np.arange(-offset_5p, n_start - offset_5p),
         )
+        n_stop = np.count_nonzero(count_stop[i])
+        first = max_positions - n_stop
         from_stop = pd.Series(
-            np.array(coverage),
-            index=np.arange(offset_3p - len(coverage) + 1, offset_3p + 1),
+            sum_stop[i, first:] / count_stop[i, first:],
+            index=np.arange(offset_3p - n_stop + 1, offset_3p + 1),
         )
-
-    return (from_start, from_stop)
+        profiles[length] = (from_start, from_stop)
+    return profiles
 
 
 def metagene_coverage(
@@ -150,49 +362,52 @@ def metagene_coverage(
                pval)
     """
     # print('calculating metagene profiles...')
-    metagenes = {}
+    remove_rare_lengths(read_lengths, meta_min_reads)
+
+    profiles = metagene_profiles(
+        cds, alignments, read_lengths, max_positions, offset_5p, offset_3p
+    )
+    return score_metagene_profiles(profiles, prefix, offset_5p, offset_3p)
 
+
+def remove_rare_lengths(read_lengths, meta_min_reads=100000):
+    """Remove the read lengths with too few reads for a metagene profile
+
+    Parameters
+    ----------
+    read_lengths: dict
+                  key is the length, value is the number reads, updated
+                  in place
+    meta_min_reads: int
+                    minimum number of reads for a read length to be considered
+    """
     # remove read length whose read number is small
     for length, reads in list(read_lengths.items()):
         if reads < meta_min_reads:
             del read_lengths[length]
 
-    for length in tqdm(read_lengths, unit="read-length", leave=False):
 
-        metagene_coverage_start = pd.Series()
-        position_counter_start = Counter()
-        metagene_coverage_stop = pd.Series()
-        position_counter_stop = Counter()
+def score_metagene_profiles(profiles, prefix, offset_5p=20, offset_3p=0):
+    """Phase scores of metagene profiles, written to the profile files
 
-        for orf in tqdm(cds, position=1, unit="ORFs", leave=False):
-            from_start, from_stop = orf_coverage_length(
-                orf, alignments, length, max_positions, offset_5p, offset_3p
-            )
-            cov_mean = from_start.mean()
-            if cov_mean > 0:
-                from_start = from_start / cov_mean
-                from_start = from_start.fillna(0)
-                metagene_coverage_start = metagene_coverage_start.add(
-                    from_start, fill_value=0
-                )
-                position_counter_start += Counter(from_start.index.tolist())
-
-                from_stop = from_stop / cov_mean
-                from_stop = from_stop.fillna(0)
-                metagene_coverage_stop = metagene_coverage_stop.add(
-                    from_stop, fill_value=0
-                )
-                position_counter_stop += Counter(from_stop.index.tolist())
-
-        if len(position_counter_start) != len(metagene_coverage_start) or len(
-            position_counter_stop
-        ) != len(metagene_coverage_stop):
-            raise RuntimeError("Metagene coverage and counter mismatch")
-        position_counter_start = pd.Series(position_counter_start)
-        metagene_coverage_start = metagene_coverage_start.div(position_counter_start)
-        position_counter_stop = pd.Series(position_counter_stop)
-        metagene_coverage_stop = metagene_coverage_stop.div(position_counter_stop)
+    Parameters
+    ----------
+    profiles: OrderedDict
+              as returned by metagene_profiles
+    prefix: str
+            prefix for the output file
+    offset_5p: int
+               the number of nts included from the 5'prime
+    offset_3p: int
+               the number of nts included from the 3'prime
 
+    Returns
+    -------
+    metagenes: dict
+               see metagene_coverage
+    """
+    metagenes = {}
+    for length, (metagene_coverage_start, metagene_coverage_stop) in profiles.items():
         phasescore_5p, valid_5p = phasescore(metagene_coverage_start.tolist())
         phasescore_3p, valid_3p = phasescore(metagene_coverage_stop.tolist())
         metagenes[length] = (
@@ -231,7 +446,12 @@ def metagene_coverage(
 
 
 def align_metagenes(
-    metagenes, read_lengths, prefix, phase_score_cutoff=CUTOFF, remove_nonperiodic=False
+    metagenes,
+    read_lengths,
+    prefix,
+    phase_score_cutoff=CUTOFF,
+    remove_nonperiodic=False,
+    sampling=None,
 ):
     """align metagene coverages to determine the lag of the psites, the
     non-periodic read length will be discarded in this step
@@ -246,6 +466,9 @@ def align_metagenes(
             prefix for output files
     remove_nonperiodic: bool
                         Whether remove non-periodic read lengths
+    sampling: str
+              description of the CDSs used for the metagene profiles,
+              recorded in the output if given
 
     Returns
     -------
@@ -285,6 +508,8 @@ def align_metagenes(
         lag = np.argmax(xcorr) - len(xcorr) // 2
         psite_offsets[length] = lag + TYPICAL_OFFSET
         to_write += "\tlag of {}: {}\n".format(length, lag)
+    if sampling is not None:
+        to_write += "{}\n".format(sampling)
     with open("{}_psite_offsets.txt".format(prefix), "w") as output:
         output.write(to_write)
     return psite_offsets
@@ -13,132 +13,191 @@
 # MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
 # GNU General Public License for more details.
 
+from collections import OrderedDict
+from itertools import product
+from multiprocessing import Pool
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import warnings
+
+from .common import parent_dir
 from .fasta import FastaReader
-from .interval import Interval
-import pandas as pd
+from .index import iter_index_lines
+import numpy as np
+import pysam
 import sys
 from tqdm.autonotebook import tqdm
 
-tqdm.pandas()
-
-
-def translate_nt_to_aa(seq):
-    codon_table = {
-        "ATA": "I",
-        "ATC": "I",
-        "ATT": "I",
-        "ATG": "M",
-        "ACA": "T",
-        "ACC": "T",
-        "ACG": "T",
-        "ACT": "T",
-        "AAC": "N",
-        "AAT": "N",
-        "AAA": "K",
-        "AAG": "K",
-        "AGC": "S",
-        "AGT": "S",
-        "AGA": "R",
-        "AGG": "R",
-        "CTA": "L",
-        "CTC": "L",
-        "CTG": "L",
-        "CTT": "L",
-        "CCA": "P",
-        "CCC": "P",
-        "CCG": "P",
-        "CCT": "P",
-        "CAC": "H",
-        "CAT": "H",
-        "CAA": "Q",
-        "CAG": "Q",
-        "CGA": "R",
-        "CGC": "R",
-        "CGG": "R",
-        "CGT": "R",
-        "GTA": "V",
-        "GTC": "V",
-        "GTG": "V",
-        "GTT": "V",
-        "GCA": "A",
-        "GCC": "A",
-        "GCG": "A",
-        "GCT": "A",
-        "GAC": "D",
-        "GAT": "D",
-        "GAA": "E",
-        "GAG": "E",
-        "GGA": "G",
-        "GGC": "G",
-        "GGG": "G",
-        "GGT": "G",
-        "TCA": "S",
-        "TCC": "S",
-        "TCG": "S",
-        "TCT": "S",
-        "TTC": "F",
-        "TTT": "F",
-        "TTA": "L",
-        "TTG": "L",
-        "TAC": "Y",
-        "TAT": "Y",
-        "TAA": "_",
-        "TAG": "_",
-        "TGC": "C",
-        "TGT": "C",
-        "TGA": "_",
-        "TGG": "W",
-    }
-    protein = ""
-    if len(seq) % 3 == 0:
-        for i in range(0, len(seq), 3):
-            codon = seq[i : i + 3]
-            if "N" in codon:
-                protein += "X"
-            elif codon not in codon_table:
-                sys.stderr.write(
-                    "Found unknown codon {}. Substituing with X..\n".format(codon)
-                )
-            else:
-                protein += codon_table[codon]
-    return protein
+CODON_TABLE = {
+    "ATA": "I",
+    "ATC": "I",
+    "ATT": "I",
+    "ATG": "M",
+    "ACA": "T",
+    "ACC": "T",
+    "ACG": "T",
+    "ACT": "T",
+    "AAC": "N",
+    "AAT": "N",
+    "AAA": "K",
+    "AAG": "K",
+    "AGC": "S",
+    "AGT": "S",
+    "AGA": "R",
+    "AGG": "R",
+    "CTA": "L",
+    "CTC": "L",
+    "CTG": "L",
+    "CTT": "L",
+    "CCA": "P",
+    "CCC": "P",
+    "CCG": "P",
+    "CCT": "P",
+    "CAC": "H",
+    "CAT": "H",
+    "CAA": "Q",
+    "CAG": "Q",
+    "CGA": "R",
+    "CGC": "R",
+    "CGG": "R",
+    "CGT": "R",
+    "GTA": "V",
+    "GTC": "V",
+    "GTG": "V",
+    "GTT": "V",
+    "GCA": "A",
+    "GCC": "A",
+    "GCG": "A",
+    "GCT": "A",
+    "GAC": "D",
+    "GAT": "D",
+    "GAA": "E",
+    "GAG": "E",
+    "GGA": "G",
+    "GGC": "G",
+    "GGG": "G",
+    "GGT": "G",
+    "TCA": "S",
+    "TCC": "S",
+    "TCG": "S",
+    "TCT": "S",
+    "TTC": "F",
+    "TTT": "F",
+    "TTA": "L",
+    "TTG": "L",
+    "TAC": "Y",
+    "TAT": "Y",
+    "TAA": "_",
+    "TAG": "_",
+    "TGC": "C",
+    "TGT": "C",
+    "TGA": "_",
+    "TGG": "W",
+}
+# code of each nucleotide, -1 for any other character
+NUCLEOTIDE_CODES = np.full(256, -1, dtype=np.int64)
+NUCLEOTIDE_CODES[np.frombuffer(b"ACGT", dtype=np.uint8)] = np.arange(4)
+# codon of each code below 64, the code being 16 * first + 4 * second + third
+CODONS = ["".join(codon) for codon in product("ACGT", repeat=3)]
+# amino acid of each codon code
+AMINO_ACIDS = np.frombuffer(
+    "".join(CODON_TABLE[codon] for codon in CODONS).encode(), dtype=np.uint8
+)
+COMPLEMENT = str.maketrans("ACGT", "TGCA")
+ORF_SEQ_FORMATS = ["tsv", "fasta"]
+# first bytes of gzip, and so bgzip, compressed files
+GZIP_MAGIC = b"\x1f\x8b"
 
 
-def orf_seq(ribotricer_index, genome_fasta, saveto, translate=False):
-    """Generate sequence for ribotricer annotation.
+def translate_codes(seq):
+    """Translate a nucleotide sequence over the codes of all its codons at once.
 
     Parameters
-    -----------
+    ----------
+    seq: str
+         nucleotide sequence, in upper case
 
-    ribotricer_index: string
-                           Path to ribotricer generate annotation
-    genome_Fasta: string
-                  Path to genome fasta
+    Returns
+    -------
+    protein: str
+             amino acid of each codon, X for codons with N; other unknown
+             codons are skipped; empty if the length is not a multiple of 3
+    """
+    if len(seq) % 3 != 0:
+        return ""
+    letters = np.frombuffer(seq.encode(), dtype=np.uint8).reshape(-1, 3)
+    bases = NUCLEOTIDE_CODES[letters]
+    protein = AMINO_ACIDS[
+        np.maximum(bases[:, 0] * 16 + bases[:, 1] * 4 + bases[:, 2], 0)
+    ]
+    invalid = (bases < 0).any(axis=1)
+    if invalid.any():
+        has_n = (letters == ord("N")).any(axis=1)
+        protein = protein.copy()
+        protein[has_n] = ord("X")
+        for i in np.flatnonzero(invalid & ~has_n).tolist():
+            sys.stderr.write(
+                "Found unknown codon {}. Substituing with X..\n".format(
+                    seq[3 * i : 3 * i + 3]
+                )
+            )
+        protein = protein[~invalid | has_n]
+    return protein.tobytes().decode()
 
-    saveto: string
-            Path to output
+
+def _chrom_seqs(task):
+    """Write the sequences of the ORFs of one chromosome, fetched at once.
+
+    Parameters
+    ----------
+    task: (str, str, List[(str, str, str)], bool, str)
+          genome fasta, chromosome, (ORF_ID, coordinate, strand) of each
+          ORF, whether to translate and path to write ORF_ID and sequence
+          lines to, in the order of the ORFs
+
+    Returns
+    -------
+    n_orfs: int
+            number of sequences written
     """
+    genome_fasta, chrom, orfs, translate, saveto = task
     fasta = FastaReader(genome_fasta)
-    annotation_df = pd.read_csv(ribotricer_index, sep="\t")
+    chrom_lengths = fasta.chromosomes
     with open(saveto, "w") as fh:
-        fh.write("ORF_ID\tsequence\n")
-        for idx, row in tqdm(annotation_df.iterrows(), total=annotation_df.shape[0]):
-            chrom = str(row.chrom)
-            orf_id = row.ORF_ID
-            coordinates = row.coordinate.split(",")
-            strand = row.strand
-            intervals = []
-            seq = ""
-            for coordinate in coordinates:
+        if chrom not in chrom_lengths:
+            warnings.warn(
+                "Chromosome {} does not appear in the fasta".format(chrom), UserWarning
+            )
+            for orf_id, _, _ in orfs:
+                fh.write("{}\t\n".format(orf_id))
+            return len(orfs)
+        chrom_length = chrom_lengths[chrom]
+        chrom_seq = fasta.fasta[chrom][:]
+        for orf_id, coordinates, strand in orfs:
+            parts = []
+            for coordinate in coordinates.split(","):
                 start, stop = coordinate.split("-")
                 start = int(start)
                 stop = int(stop)
-                interval = Interval(chrom, start, stop, strand)
-                intervals.append(interval)
-
-            seq = ("").join(fasta.query(intervals))
+                if start > chrom_length:
+                    raise Exception(
+                        "Chromsome start point exceeds chromosome length: {}>{}".format(
+                            start, chrom_length
+                        )
+                    )
+                elif stop > chrom_length:
+                    raise Exception(
+                        "Chromsome end point exceeds chromosome length: {}>{}".format(
+                            stop, chrom_length
+                        )
+                    )
+                parts.append(chrom_seq[start - 1 : stop])
+            seq = "".join(parts)
             if strand == "-":
-                seq = fasta.reverse_complement(seq)
+                seq = seq.translate(COMPLEMENT)[::-1]
             if translate:
                 if len(seq) % 3 != 0:
                     sys.stderr.write(
@@ -147,5 +206,218 @@ def orf_seq(ribotricer_index, genome_fasta, saveto, translate=False):
                         )
                     )
                     seq = seq[0 : (len(seq) // 3) * 3]
-                seq = translate_nt_to_aa(seq)
+                seq = translate_codes(seq)
             fh.write("{}\t{}\n".format(orf_id, seq))
+    return len(orfs)
+
+
+def _merge_chrom_seqs(paths, runs):
+    """Read back the sequences written by _chrom_seqs in index order.
+
+    Parameters
+    ----------
+    paths: List[str]
+           file written by _chrom_seqs for each chromosome
+    runs: List[[int, int]]
+          (chromosome, number of ORFs) of each run of consecutive ORFs of
+          the index on the same chromosome
+
+    Returns
+    -------
+    records: generator of (str, str)
+             ORF_ID and sequence of each ORF
+    """
+    offsets = [0] * len(paths)
+    for chrom, n_orfs in runs:
+        with open(paths[chrom], "rb") as fin:
+            fin.seek(offsets[chrom])
+            for _ in range(n_orfs):
+                orf_id, seq = fin.readline().decode().rstrip("\n").split("\t")
+                yield orf_id, seq
+            offsets[chrom] = fin.tell()
+
+
+def orf_seq(
+    ribotricer_index,
+    genome_fasta,
+    saveto,
+    translate=False,
+    regions=None,
+    threads=1,
+    output_format="tsv",
+    compress=False,
+):
+    """Generate sequence for ribotricer annotation.
+
+    The ORFs are grouped by chromosome; each chromosome is fetched once
+    and the ORFs are sliced from it. The sequences of each chromosome are
+    written to a temporary file next to the output, and these are merged
+    in index order, so the sequences are never all held in memory.
+
+    Parameters
+    -----------
+
+    ribotricer_index: string
+                           Path to ribotricer generate annotation
+    genome_Fasta: string
+                  Path to genome fasta
+
+    saveto: string
+            Path to output
+    regions: dict
+             if given, only ORFs starting within these regions are output,
+             see index.parse_regions
+    threads: int
+             Number of chromosomes processed in parallel
+    output_format: str
+                   {'tsv', 'fasta'}; fasta is written along with a .fai
+                   index, see write_orf_fasta
+    compress: bool
+              Whether to bgzip compress the fasta output
+    """
+    chroms = OrderedDict()
+    chrom_orfs = []
+    runs = []
+    n_orfs = 0
+    for line in iter_index_lines(ribotricer_index, regions):
+        fields = line.rstrip("\n").split("\t")
+        if fields[7] not in chroms:
+            chroms[fields[7]] = len(chroms)
+            chrom_orfs.append([])
+        chrom = chroms[fields[7]]
+        chrom_orfs[chrom].append((fields[0], fields[10], fields[8]))
+        if runs and runs[-1][0] == chrom:
+            runs[-1][1] += 1
+        else:
+            runs.append([chrom, 1])
+        n_orfs += 1
+
+    # sequences are written per chromosome to temporary files, then merged
+    tmpdir = tempfile.mkdtemp(
+        prefix="ribotricer_orfs_seq_", dir=parent_dir(saveto) or "."
+    )
+    try:
+        paths = [
+            os.path.join(tmpdir, "chrom_{:05d}.tsv".format(chrom))
+            for chrom in range(len(chroms))
+        ]
+        tasks = [
+            (genome_fasta, chrom, orfs, translate, path)
+            for chrom, orfs, path in zip(chroms, chrom_orfs, paths)
+        ]
+        with tqdm(total=n_orfs, unit="ORFs") as pbar:
+            if threads > 1 and len(tasks) > 1:
+                with Pool(min(threads, len(tasks))) as pool:
+                    for chrom_n_orfs in pool.imap_unordered(_chrom_seqs, tasks):
+                        pbar.update(chrom_n_orfs)
+            else:
+                for task in tasks:
+                    pbar.update(_chrom_seqs(task))
+        records = _merge_chrom_seqs(paths, runs)
+        if output_format == "fasta":
+            write_orf_fasta(saveto, records, compress)
+            return
+        with open(saveto, "w") as fh:
+            fh.write("ORF_ID\tsequence\n")
+            for orf_id, seq in records:
+                fh.write("{}\t{}\n".format(orf_id, seq))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def write_orf_fasta(saveto, records, compress=False):
+    """Write ORF sequences as FASTA, one line per sequence, with a .fai index.
+
+    The indexes are written here rather than by samtools faidx, which drops
+    empty sequences, and fails on a compressed file ending with one.
+
+    Parameters
+    ----------
+    saveto: str
+            Path to output
+    records: iterable of (str, str)
+             ORF_ID and sequence of each ORF
+    compress: bool
+              Whether to bgzip compress the output, a .gzi index being
+              written as well, see write_gzi
+    """
+    fasta_path = saveto + ".tmp" if compress else saveto
+    offset = 0
+    with open(fasta_path, "w") as fh, open(saveto + ".fai", "w") as fai:
+        for orf_id, seq in records:
+            header = ">{}\n".format(orf_id)
+            fh.write(header)
+            fh.write(seq + "\n")
+            offset += len(header)
+            fai.write(
+                "{}\t{}\t{}\t{}\t{}\n".format(
+                    orf_id, len(seq), offset, len(seq), len(seq) + 1
+                )
+            )
+            offset += len(seq) + 1
+    if compress:
+        pysam.tabix_compress(fasta_path, saveto, force=True)
+        os.remove(fasta_path)
+        write_gzi(saveto)
+
+
+def write_gzi(path):
+    """Write the .gzi index of a bgzip compressed file.
+
+    The index lists the compressed and uncompressed offsets at which each
+    block but the first starts, the empty end-of-file block excluded. The
+    sizes of a block are read from its header and footer, without
+    decompressing it.
+
+    Parameters
+    ----------
+    path: str
+          Path to the bgzip compressed file
+    """
+    blocks = []
+    compressed = uncompressed = 0
+    with open(path, "rb") as fin:
+        while True:
+            header = fin.read(18)
+            if len(header) < 18:
+                break
+            # BSIZE, the total block size minus 1, ends the 18-byte header
+            block_size = struct.unpack("<H", header[16:18])[0] + 1
+            fin.seek(compressed + block_size - 4)
+            # ISIZE, the uncompressed size, ends the block
+            data_size = struct.unpack("<I", fin.read(4))[0]
+            if data_size > 0 and compressed > 0:
+                blocks.append((compressed, uncompressed))
+            compressed += block_size
+            uncompressed += data_size
+    with open(path + ".gzi", "wb") as fh:
+        fh.write(struct.pack("<Q", len(blocks)))
+        for block in blocks:
+            fh.write(struct.pack("<QQ", *block))
+
+
+def is_orf_fasta(path):
+    """Check whether an orfs-seq output is FASTA, possibly bgzip compressed
+    whatever its name"""
+    with open(path, "rb") as fin:
+        compressed = fin.read(2) == GZIP_MAGIC
+    opener = gzip.open if compressed else open
+    with opener(path, "rt") as fin:
+        return fin.read(1) == ">"
+
+
+class IndexedOrfSeqs(object):
+    """Sequences of an orfs-seq FASTA output, read by ORF ID through its
+    .fai index only when queried"""
+
+    def __init__(self, path):
+        """
+        Parameters
+        ----------
+        path: str
+              Path to a FASTA output of orfs-seq
+        """
+        self.fasta = pysam.FastaFile(path)
+
+    def __getitem__(self, orf_id):
+        return self.fasta.fetch(reference=orf_id)
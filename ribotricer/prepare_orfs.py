@@ -17,9 +17,12 @@ from collections import defaultdict
 import datetime
 import re
 
+from .cache import AnnotationCache
+from .cache import file_checksum
 from .common import merge_intervals
 from .fasta import FastaReader
 from .gtf import GTFReader
+from .index import dedup_index
 from .interval import Interval
 from .orf import ORF
 
@@ -165,18 +168,48 @@ def search_orfs(fasta, intervals, min_orf_length, start_codons, stop_codons, lon
     if not intervals:
         return []
 
-    orfs = []
     if not isinstance(fasta, FastaReader):
         fasta = FastaReader(fasta)
     intervals = merge_intervals(intervals)
     sequences = fasta.query(intervals)
     merged_seq = "".join(sequences)
-    reverse = False
-    strand = intervals[0].strand
-    if strand == "-":
+    if intervals[0].strand == "-":
         merged_seq = fasta.reverse_complement(merged_seq)
-        reverse = True
+    return search_orfs_in_seq(
+        merged_seq, intervals, min_orf_length, start_codons, stop_codons, longest
+    )
+
+
+def search_orfs_in_seq(
+    merged_seq, intervals, min_orf_length, start_codons, stop_codons, longest
+):
+    """
+    Parameters
+    ----------
+    merged_seq: str
+                spliced sequence of the intervals, in transcript orientation
+    intervals: List[Interval]
+               sorted and merged list of intervals
+    min_orf_length: int
+                    minimum length (nts) of ORF to include
+    start_codons: set
+                  set of start codons
+    stop_codons: set
+                 set of stop codons
+    longest: bool
+             whether to choose the most upstream start codon when multiple in
+             frame ones exist
 
+    Returns
+    -------
+    orfs: list
+          list of (List[Interval], seq, leader, trailer), see search_orfs
+    """
+    if not intervals:
+        return []
+
+    orfs = []
+    reverse = intervals[0].strand == "-"
     start_stop_idx = []
     if "ATG" in start_codons:
         start_stop_idx += [(m.start(0), "ATG") for m in re.finditer("ATG", merged_seq)]
@@ -214,6 +247,130 @@ def search_orfs(fasta, intervals, min_orf_length, start_codons, stop_codons, lon
     return orfs
 
 
+def iter_annotated_orfs(gtf, fasta):
+    """
+    Parameters
+    ----------
+    gtf: GTFReader
+         instance of GTFReader
+    fasta: FastaReader
+           instance of FastaReader
+
+    Returns
+    -------
+    orfs: generator of ORF
+          annotated ORF for each CDS in the GTF file
+    """
+    for gid in tqdm(gtf.cds, unit="lines", leave=False):
+        for tid in gtf.cds[gid]:
+            tracks = gtf.cds[gid][tid]
+            seq = fetch_seq(fasta, tracks)
+            orf = ORF.from_tracks(tracks, "annotated", seq=seq[:3])
+            if orf:
+                yield orf
+
+
+def transcript_model(tid, tracks):
+    """
+    Parameters
+    ----------
+    tid: str
+         transcript id
+    tracks: List[GTFTrack]
+            exon tracks of the transcript
+
+    Returns
+    -------
+    model: tuple
+           (tid, ttype, gid, gname, gtype, chrom, strand, ivs)
+           where ivs are the merged exon intervals
+    """
+    return (
+        tid,
+        tracks[0].transcript_type,
+        tracks[0].gene_id,
+        tracks[0].gene_name,
+        tracks[0].gene_type,
+        tracks[0].chrom,
+        tracks[0].strand,
+        tracks_to_ivs(tracks),
+    )
+
+
+def transcript_seq(fasta, ivs):
+    """
+    Parameters
+    ----------
+    fasta: FastaReader
+           instance of FastaReader
+    ivs: List[Interval]
+         merged exon intervals of the transcript
+
+    Returns
+    -------
+    seq: str
+         spliced sequence in transcript orientation
+    """
+    if not ivs:
+        return ""
+    seq = "".join(fasta.query(ivs))
+    if ivs[0].strand == "-":
+        seq = fasta.reverse_complement(seq)
+    return seq
+
+
+def iter_transcripts(gtf, fasta):
+    """
+    Parameters
+    ----------
+    gtf: GTFReader
+         instance of GTFReader
+    fasta: FastaReader
+           instance of FastaReader
+
+    Returns
+    -------
+    transcripts: generator of tuple
+                 (tid, ttype, gid, gname, gtype, chrom, strand, ivs, seq)
+                 for each transcript, where ivs are the merged exon intervals
+                 and seq is the spliced sequence in transcript orientation
+    """
+    for tid in gtf.transcript:
+        model = transcript_model(tid, gtf.transcript[tid])
+        yield model + (transcript_seq(fasta, model[-1]),)
+
+
+def build_annotation_cache(gtf, fasta, gtf_checksum, fasta_checksum):
+    """
+    Parameters
+    ----------
+    gtf: GTFReader
+         instance of GTFReader
+    fasta: FastaReader
+           instance of FastaReader
+    gtf_checksum: str
+                  checksum of the GTF file
+    fasta_checksum: str
+                    checksum of the FASTA file
+
+    Returns
+    -------
+    cache: AnnotationCache
+           parsed CDS and transcript models with transcript sequences
+    """
+    cache = AnnotationCache(gtf_checksum, fasta_checksum)
+    for orf in iter_annotated_orfs(gtf, fasta):
+        cache.add_cds(orf)
+    for transcript in tqdm(
+        iter_transcripts(gtf, fasta),
+        total=len(gtf.transcript),
+        unit="transcripts",
+        leave=False,
+    ):
+        cache.add_transcript(*transcript)
+    return cache
+
+
 def check_orf_type(orf, cds_orfs):
     """
     Parameters
@@ -258,8 +415,309 @@ def check_orf_type(orf, cds_orfs):
     return "internal"
 
 
+def search_transcript_orfs(
+    model, seq, cds_orfs, min_orf_length, start_codons, stop_codons, longest
+):
+    """
+    Parameters
+    ----------
+    model: tuple
+           (tid, ttype, gid, gname, gtype, chrom, strand, ivs)
+    seq: str
+         spliced sequence of the transcript in transcript orientation
+    cds_orfs: dict(dict(ORF))
+              annotated ORFs by gene_id and transcript_id
+    min_orf_length, start_codons, stop_codons, longest:
+              see search_orfs
+
+    Returns
+    -------
+    orfs: List[ORF]
+          candidate ORFs of the transcript, excluding annotated and
+          internal ones
+    """
+    tid, ttype, gid, gname, gtype, chrom, strand, ivs = model
+    candidate_orfs = []
+    orfs = search_orfs_in_seq(
+        seq, ivs, min_orf_length, start_codons, stop_codons, longest
+    )
+    for ivs, seq, leader, trailer in orfs:
+        orf = ORF(
+            "unknown",
+            tid,
+            ttype,
+            gid,
+            gname,
+            gtype,
+            chrom,
+            strand,
+            ivs,
+            seq=seq[:3],
+        )
+        orf.category = check_orf_type(orf, cds_orfs)
+        if orf.category != "annotated" and orf.category != "internal":
+            candidate_orfs.append(orf)
+    return candidate_orfs
+
+
+def format_coordinate(intervals):
+    """Format intervals as comma separated start-end pairs"""
+    return ",".join(["{}-{}".format(iv.start, iv.end) for iv in intervals])
+
+
+def format_orf(orf):
+    """
+    Parameters
+    ----------
+    orf: ORF
+         instance of ORF
+
+    Returns
+    -------
+    line: str
+          line for ribotricer index file
+    """
+    fields = [
+        orf.oid,
+        orf.category,
+        orf.tid,
+        orf.ttype,
+        orf.gid,
+        orf.gname,
+        orf.gtype,
+        orf.chrom,
+        orf.strand,
+        str(orf.start_codon),
+        format_coordinate(orf.intervals),
+    ]
+    return "\t".join(fields) + "\n"
+
+
+def orf_signature(orf):
+    """Attributes of an annotated ORF that determine its index line"""
+    return (
+        orf.tid,
+        orf.ttype,
+        orf.gid,
+        orf.gname,
+        orf.gtype,
+        orf.chrom,
+        orf.strand,
+        format_coordinate(orf.intervals),
+    )
+
+
+def model_signature(model):
+    """Attributes of a transcript model that determine its candidate ORFs"""
+    return tuple(model[:-1]) + (format_coordinate(model[-1]),)
+
+
+def transcript_models_path(ribotricer_index):
+    """Path to the transcript models recorded along with an index file"""
+    suffix = "_candidate_orfs.tsv"
+    if not ribotricer_index.endswith(suffix):
+        return None
+    return "{}_transcript_models.tsv".format(ribotricer_index[: -len(suffix)])
+
+
+def index_parameters(
+    fasta_checksum, min_orf_length, start_codons, stop_codons, longest
+):
+    """Parameters of prepare-orfs that the whole index depends on"""
+    return [
+        ("fasta_checksum", fasta_checksum),
+        ("min_orf_length", str(min_orf_length)),
+        ("start_codons", ",".join(sorted(start_codons))),
+        ("stop_codons", ",".join(sorted(stop_codons))),
+        ("longest", str(bool(longest))),
+    ]
+
+
+def write_transcript_models(models, parameters, saveto):
+    """
+    Parameters
+    ----------
+    models: List[tuple]
+            transcript models as returned by transcript_model
+    parameters: List[(str, str)]
+                parameters the index was built with
+    saveto: str
+            Path to output file
+    """
+    with open(saveto, "w") as output:
+        for key, value in parameters:
+            output.write("#{}\t{}\n".format(key, value))
+        output.write(
+            "transcript_id\ttranscript_type\tgene_id\tgene_name\t"
+            "gene_type\tchrom\tstrand\tcoordinate\n"
+        )
+        for model in models:
+            output.write("\t".join(model_signature(model)) + "\n")
+
+
+def read_transcript_models(models_file):
+    """
+    Parameters
+    ----------
+    models_file: str
+                 Path to transcript models written by write_transcript_models
+
+    Returns
+    -------
+    parameters: List[(str, str)]
+                parameters the index was built with
+    models: dict
+            key is transcript_id, value is the model signature
+    """
+    parameters = []
+    models = {}
+    with open(models_file, "r") as fin:
+        for line in fin:
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#"):
+                parameters.append((fields[0][1:], fields[1]))
+            elif fields[0] != "transcript_id":
+                models[fields[0]] = tuple(fields)
+    return parameters, models
+
+
+def read_index_lines(ribotricer_index):
+    """
+    Parameters
+    ----------
+    ribotricer_index: str
+                      Path to the index file generated by ribotricer prepare_orfs
+
+    Returns
+    -------
+    annotated: dict
+               key is (gene_id, transcript_id), value is (signature, line)
+               of the annotated ORF
+    others: defaultdict(list)
+            key is transcript_id, value is the lines of its non-annotated ORFs
+    """
+    annotated = {}
+    others = defaultdict(list)
+    with open(ribotricer_index, "r") as fin:
+        # Skip header
+        fin.readline()
+        for line in fin:
+            orf = ORF.from_string(line)
+            if orf.category == "annotated":
+                annotated[orf.gid, orf.tid] = (orf_signature(orf), line)
+            else:
+                others[orf.tid].append(line)
+    return annotated, others
+
+
+def update_orfs(
+    old_index,
+    old_models,
+    gtf,
+    fasta,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+):
+    """Recompute candidate ORFs only for transcripts that changed.
+
+    A transcript is recomputed if it is new, if its model differs from the
+    one recorded with the old index or if the annotated CDSs of its gene
+    changed, as the ORF types depend on all CDSs of the gene.
+
+    Parameters
+    ----------
+    old_index: str
+               Path to the previously generated index file
+    old_models: dict
+                transcript models recorded with the old index
+    gtf: GTFReader
+         instance of GTFReader
+    fasta: FastaReader
+           instance of FastaReader
+    min_orf_length, start_codons, stop_codons, longest:
+              see search_orfs
+
+    Returns
+    -------
+    lines: List[str]
+           lines of the new index file
+    models: List[tuple]
+            transcript models of the new GTF file
+    """
+    old_annotated, old_others = read_index_lines(old_index)
+    old_gene_cds = defaultdict(set)
+    for (gid, tid), (signature, line) in old_annotated.items():
+        old_gene_cds[gid].add(signature)
+
+    lines = []
+    cds_orfs = defaultdict(lambda: defaultdict(ORF))
+    gene_cds = defaultdict(set)
+    for gid in tqdm(gtf.cds, unit="lines", leave=False):
+        for tid in gtf.cds[gid]:
+            tracks = gtf.cds[gid][tid]
+            orf = ORF.from_tracks(tracks, "annotated")
+            if not orf:
+                continue
+            signature = orf_signature(orf)
+            old = old_annotated.get((gid, tid))
+            if old is not None and old[0] == signature:
+                line = old[1]
+            else:
+                orf.seq = fetch_seq(fasta, tracks)[:3]
+                line = format_orf(orf)
+            cds_orfs[gid][tid] = orf
+            gene_cds[gid].add(signature)
+            lines.append(line)
+    changed_genes = {
+        gid
+        for gid in set(gene_cds) | set(old_gene_cds)
+        if gene_cds.get(gid) != old_gene_cds.get(gid)
+    }
+
+    models = []
+    n_updated = 0
+    for tid in tqdm(gtf.transcript, unit="transcripts", leave=False):
+        model = transcript_model(tid, gtf.transcript[tid])
+        models.append(model)
+        gid = model[2]
+        if old_models.get(tid) == model_signature(model) and gid not in changed_genes:
+            lines.extend(old_others.get(tid, []))
+        else:
+            n_updated += 1
+            seq = transcript_seq(fasta, model[-1])
+            for orf in search_transcript_orfs(
+                model,
+                seq,
+                cds_orfs,
+                min_orf_length,
+                start_codons,
+                stop_codons,
+                longest,
+            ):
+                lines.append(format_orf(orf))
+    now = datetime.datetime.now()
+    print(
+        "{} ... recomputed ORFs for {} of {} transcripts".format(
+            now.strftime("%b %d %H:%M:%S"), n_updated, len(models)
+        )
+    )
+    return lines, models
+
+
 def prepare_orfs(
-    gtf, fasta, prefix, min_orf_length, start_codons, stop_codons, longest
+    gtf,
+    fasta,
+    prefix,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    threads=1,
+    cache_dir=None,
+    update_from=None,
+    dedup=False,
 ):
     """
     Parameters
@@ -279,66 +737,80 @@ def prepare_orfs(
     longest: bool
              whether to choose the most upstream start codon when multiple in
              frame ones exist
+    threads: int
+             number of processes used for parsing the GTF file
+    cache_dir: str
+               directory of the annotation cache; if set, the parsed GTF
+               models and transcript sequences are reused from (or saved to)
+               a cache keyed by the checksums of the GTF and FASTA files
+    update_from: str
+                 Path to an index previously generated with the same FASTA
+                 file and parameters; only transcripts whose models or gene
+                 CDSs changed are searched again
+    dedup: bool
+           whether to also write a deduplicated index where ORFs with
+           identical genomic footprints are stored once
     """
 
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ..... started ribotricer prepare-orfs"))
-    now = datetime.datetime.now()
-    print(now.strftime("%b %d %H:%M:%S ... starting to parse GTF file"))
-    candidate_orfs = []
-    if not isinstance(gtf, GTFReader):
-        gtf = GTFReader(gtf)
-    if not isinstance(fasta, FastaReader):
-        fasta = FastaReader(fasta)
-
-    # process CDS gtf
-    now = datetime.datetime.now()
-    print(now.strftime("%b %d %H:%M:%S ... starting extracting annotated ORFs"))
-    cds_orfs = defaultdict(lambda: defaultdict(ORF))
-    for gid in tqdm(gtf.cds, unit="lines", leave=False):
-        for tid in gtf.cds[gid]:
-            tracks = gtf.cds[gid][tid]
-            seq = fetch_seq(fasta, tracks)
-            orf = ORF.from_tracks(tracks, "annotated", seq=seq[:3])
-            if orf:
-                cds_orfs[gid][tid] = orf
-                candidate_orfs.append(orf)
-
-    now = datetime.datetime.now()
-    print(
-        "{} ... {}".format(
-            now.strftime("%b %d %H:%M:%S"),
-            "starting searching transcriptome-wide ORFs. This may take a long time...",
-        )
+    fasta_checksum = file_checksum(
+        fasta.fasta_location if isinstance(fasta, FastaReader) else fasta
     )
-    for tid in tqdm(gtf.transcript, unit="transcripts", leave=False):
-        tracks = gtf.transcript[tid]
-        ttype = tracks[0].transcript_type
-        gid = tracks[0].gene_id
-        gname = tracks[0].gene_name
-        gtype = tracks[0].gene_type
-        chrom = tracks[0].chrom
-        strand = tracks[0].strand
-        ivs = tracks_to_ivs(tracks)
-        orfs = search_orfs(
-            fasta, ivs, min_orf_length, start_codons, stop_codons, longest
+    parameters = index_parameters(
+        fasta_checksum, min_orf_length, start_codons, stop_codons, longest
+    )
+    if update_from is not None:
+        old_parameters, old_models = read_transcript_models(
+            transcript_models_path(update_from)
         )
-        for ivs, seq, leader, trailer in orfs:
-            orf = ORF(
-                "unknown",
-                tid,
-                ttype,
-                gid,
-                gname,
-                gtype,
-                chrom,
-                strand,
-                ivs,
-                seq=seq[:3],
+        if old_parameters != parameters:
+            now = datetime.datetime.now()
+            print(
+                "{} ... {}".format(
+                    now.strftime("%b %d %H:%M:%S"),
+                    "FASTA or parameters differ from the old index, "
+                    "rebuilding all candidate ORFs",
+                )
             )
-            orf.category = check_orf_type(orf, cds_orfs)
-            if orf.category != "annotated" and orf.category != "internal":
-                candidate_orfs.append(orf)
+            update_from = None
+
+    if update_from is not None:
+        now = datetime.datetime.now()
+        print(now.strftime("%b %d %H:%M:%S ... starting to parse GTF file"))
+        if not isinstance(gtf, GTFReader):
+            gtf = GTFReader(gtf, threads)
+        if not isinstance(fasta, FastaReader):
+            fasta = FastaReader(fasta)
+        now = datetime.datetime.now()
+        print(
+            "{} ... {}".format(
+                now.strftime("%b %d %H:%M:%S"),
+                "starting updating candidate ORFs from {}".format(update_from),
+            )
+        )
+        lines, models = update_orfs(
+            update_from,
+            old_models,
+            gtf,
+            fasta,
+            min_orf_length,
+            start_codons,
+            stop_codons,
+            longest,
+        )
+    else:
+        lines, models = _prepare_orfs(
+            gtf,
+            fasta,
+            fasta_checksum,
+            min_orf_length,
+            start_codons,
+            stop_codons,
+            longest,
+            threads,
+            cache_dir,
+        )
 
     # save to file
     now = datetime.datetime.now()
@@ -357,27 +829,110 @@ def prepare_orfs(
         "coordinate\n",
     ]
 
-    to_write = "\t".join(columns)
-    formatter = "{}\t" * (len(columns) - 1) + "{}\n"
-    for orf in tqdm(candidate_orfs, unit="ORFs"):
-        coordinate = ",".join(
-            ["{}-{}".format(iv.start, iv.end) for iv in orf.intervals]
-        )
-        to_write += formatter.format(
-            orf.oid,
-            orf.category,
-            orf.tid,
-            orf.ttype,
-            orf.gid,
-            orf.gname,
-            orf.gtype,
-            orf.chrom,
-            orf.strand,
-            orf.start_codon,
-            coordinate,
-        )
-
     with open("{}_candidate_orfs.tsv".format(prefix), "w") as output:
-        output.write(to_write)
+        output.write("\t".join(columns))
+        output.write("".join(lines))
+    write_transcript_models(
+        models, parameters, "{}_transcript_models.tsv".format(prefix)
+    )
+    if dedup:
+        now = datetime.datetime.now()
+        print(now.strftime("%b %d %H:%M:%S ... saving deduplicated index into disk"))
+        n_footprints = dedup_index(
+            "{}_candidate_orfs.tsv".format(prefix),
+            "{}_candidate_orfs_dedup.tsv".format(prefix),
+        )
+        print("{} unique footprints for {} ORFs".format(n_footprints, len(lines)))
     now = datetime.datetime.now()
     print(now.strftime("%b %d %H:%M:%S ... finished ribotricer prepare-orfs"))
+
+
+def _prepare_orfs(
+    gtf,
+    fasta,
+    fasta_checksum,
+    min_orf_length,
+    start_codons,
+    stop_codons,
+    longest,
+    threads,
+    cache_dir,
+):
+    """Search candidate ORFs in all transcripts, see prepare_orfs
+
+    Returns
+    -------
+    lines: List[str]
+           lines of the index file
+    models: List[tuple]
+            transcript models of the GTF file
+    """
+    candidate_orfs = []
+    if cache_dir is not None:
+        now = datetime.datetime.now()
+        print(now.strftime("%b %d %H:%M:%S ... checking annotation cache"))
+        gtf_checksum = file_checksum(gtf)
+        cache_path = AnnotationCache.path(cache_dir, gtf_checksum, fasta_checksum)
+        cache = AnnotationCache.load(cache_path, gtf_checksum, fasta_checksum)
+        if cache is None:
+            now = datetime.datetime.now()
+            print(now.strftime("%b %d %H:%M:%S ... starting to parse GTF file"))
+            gtf = GTFReader(gtf, threads)
+            fasta = FastaReader(fasta)
+            now = datetime.datetime.now()
+            print(now.strftime("%b %d %H:%M:%S ... starting to build annotation cache"))
+            cache = build_annotation_cache(gtf, fasta, gtf_checksum, fasta_checksum)
+            cache.save(cache_path)
+        else:
+            now = datetime.datetime.now()
+            print(
+                "{} ... using annotation cache {}".format(
+                    now.strftime("%b %d %H:%M:%S"), cache_path
+                )
+            )
+        annotated_orfs = cache.iter_cds()
+        transcripts = cache.iter_transcripts()
+        n_transcripts = len(cache.transcripts)
+    else:
+        now = datetime.datetime.now()
+        print(now.strftime("%b %d %H:%M:%S ... starting to parse GTF file"))
+        if not isinstance(gtf, GTFReader):
+            gtf = GTFReader(gtf, threads)
+        if not isinstance(fasta, FastaReader):
+            fasta = FastaReader(fasta)
+        annotated_orfs = iter_annotated_orfs(gtf, fasta)
+        transcripts = iter_transcripts(gtf, fasta)
+        n_transcripts = len(gtf.transcript)
+
+    # process CDS gtf
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ... starting extracting annotated ORFs"))
+    cds_orfs = defaultdict(lambda: defaultdict(ORF))
+    for orf in annotated_orfs:
+        cds_orfs[orf.gid][orf.tid] = orf
+        candidate_orfs.append(orf)
+
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "starting searching transcriptome-wide ORFs. This may take a long time...",
+        )
+    )
+    models = []
+    for transcript in tqdm(
+        transcripts, total=n_transcripts, unit="transcripts", leave=False
+    ):
+        model, seq = transcript[:-1], transcript[-1]
+        models.append(model)
+        candidate_orfs += search_transcript_orfs(
+            model,
+            seq,
+            cds_orfs,
+            min_orf_length,
+            start_codons,
+            stop_codons,
+            longest,
+        )
+    lines = [format_orf(orf) for orf in tqdm(candidate_orfs, unit="ORFs")]
+    return lines, models
@@ -0,0 +1,583 @@
+"""Writers and readers of detect-orfs results"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from array import array
+from collections import defaultdict
+from collections import deque
+import gzip
+import queue
+import sys
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from .index import index_orf_ids
+
+# Columns of the detect-orfs output
+OUTPUT_COLUMNS = [
+    "ORF_ID",
+    "ORF_type",
+    "status",
+    "phase_score",
+    "read_count",
+    "length",
+    "valid_codons",
+    "valid_codons_ratio",
+    "read_density",
+    "transcript_id",
+    "transcript_type",
+    "gene_id",
+    "gene_name",
+    "gene_type",
+    "chrom",
+    "strand",
+    "start_codon",
+    "profile\n",
+]
+OUTPUT_FORMATTER = "{}\t" * (len(OUTPUT_COLUMNS) - 1) + "{}\n"
+
+# In the columnar formats the scalar columns are stored one array per
+# column and the profiles as a single concatenated array, the profile of
+# the i-th ORF being values[offsets[i]:offsets[i + 1]]
+SCALAR_COLUMNS = OUTPUT_COLUMNS[:-1]
+FLOAT_COLUMNS = {"phase_score", "valid_codons_ratio", "read_density"}
+INT_COLUMNS = {"read_count", "length", "valid_codons"}
+OUTPUT_FORMATS = ["tsv", "parquet", "npz"]
+# Batches of rows handed to the writer thread, and how many batches may be
+# pending before scoring blocks
+WRITER_BATCH_SIZE = 256
+WRITER_QUEUE_SIZE = 64
+
+
+def result_path(prefix, output_format="tsv", compress=False):
+    """Path of the detect-orfs output
+
+    Parameters
+    ----------
+    prefix: str
+            prefix for output files
+    output_format: str
+                   {'tsv', 'parquet', 'npz'}
+    compress: bool
+              whether the tsv output is gzip compressed
+
+    Returns
+    -------
+    path: str
+    """
+    path = "{}_translating_ORFs.{}".format(prefix, output_format)
+    if compress and output_format == "tsv":
+        path += ".gz"
+    return path
+
+
+def result_format(path):
+    """Format of a detect-orfs output, determined by its extension;
+    gzip compressed files are tsv"""
+    for output_format in OUTPUT_FORMATS[1:]:
+        if path.endswith(".{}".format(output_format)):
+            return output_format
+    return "tsv"
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        sys.exit("Error: pyarrow is required for reading or writing parquet files")
+    return pyarrow
+
+
+def format_result(orf, scores, profile):
+    """
+    Parameters
+    ----------
+    orf: ORF
+         instance of ORF
+    scores: tuple
+            scores as returned by score_coverage
+    profile: list
+             coverage of the ORF
+
+    Returns
+    -------
+    line: str
+          line of the detect-orfs output
+    """
+    status, coh, count, length, valid_codons, valid_codons_ratio, density = scores
+    return OUTPUT_FORMATTER.format(
+        orf.oid,
+        orf.category,
+        status,
+        coh,
+        count,
+        length,
+        valid_codons,
+        valid_codons_ratio,
+        density,
+        orf.tid,
+        orf.ttype,
+        orf.gid,
+        orf.gname,
+        orf.gtype,
+        orf.chrom,
+        orf.strand,
+        orf.start_codon,
+        profile,
+    )
+
+
+def _open_text(path, mode="r"):
+    """Open a text file, gzip compressed if its name ends with .gz"""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+class TsvResultWriter(object):
+    """Write detect-orfs results as tab separated lines"""
+
+    def __init__(self, path):
+        self.output = _open_text(path, "w")
+        self.output.write("\t".join(OUTPUT_COLUMNS))
+
+    def write(self, orf, scores, profile):
+        self.output.write(format_result(orf, scores, profile))
+
+    def close(self):
+        self.output.close()
+
+
+class ColumnarResultWriter(object):
+    """Collect detect-orfs results column by column and write them as a
+    parquet or npz file on close"""
+
+    def __init__(self, path, output_format):
+        self.path = path
+        self.output_format = output_format
+        if output_format == "parquet":
+            _import_pyarrow()
+        self.columns = {column: [] for column in SCALAR_COLUMNS}
+        self.values = array("q")
+        self.offsets = array("q", [0])
+
+    def write(self, orf, scores, profile):
+        status, coh, count, length, valid_codons, valid_codons_ratio, density = scores
+        row = (
+            orf.oid,
+            orf.category,
+            status,
+            float(coh),
+            int(count),
+            int(length),
+            int(valid_codons),
+            float(valid_codons_ratio),
+            float(density),
+            orf.tid,
+            orf.ttype,
+            orf.gid,
+            orf.gname,
+            orf.gtype,
+            orf.chrom,
+            orf.strand,
+            str(orf.start_codon),
+        )
+        for column, value in zip(SCALAR_COLUMNS, row):
+            self.columns[column].append(value)
+        self.values.extend(profile)
+        self.offsets.append(len(self.values))
+
+    def _arrays(self):
+        arrays = {}
+        for column in SCALAR_COLUMNS:
+            if column in FLOAT_COLUMNS:
+                dtype = np.float64
+            elif column in INT_COLUMNS:
+                dtype = np.int64
+            else:
+                dtype = str
+            arrays[column] = np.array(self.columns[column], dtype=dtype)
+        return arrays
+
+    def close(self):
+        offsets = np.frombuffer(self.offsets, dtype=np.int64)
+        values = np.frombuffer(self.values, dtype=np.int64)
+        DetectedOrfs(self._arrays(), offsets, values).save(
+            self.path, self.output_format
+        )
+
+
+def result_writer(path, output_format="tsv"):
+    """
+    Parameters
+    ----------
+    path: str
+          Path to output file
+    output_format: str
+                   {'tsv', 'parquet', 'npz'}
+
+    Returns
+    -------
+    writer: TsvResultWriter or ColumnarResultWriter
+            object with write(orf, scores, profile) and close() methods
+    """
+    if output_format == "tsv":
+        return TsvResultWriter(path)
+    return ColumnarResultWriter(path, output_format)
+
+
+class ThreadedResultWriter(object):
+    """Format and write results in a background thread.
+
+    Rows are handed over in batches through a bounded queue, so scoring
+    and writing overlap and scoring blocks when the writer falls behind.
+    The rows are written in the order they are passed.
+    """
+
+    def __init__(
+        self, writer, queue_size=WRITER_QUEUE_SIZE, batch_size=WRITER_BATCH_SIZE
+    ):
+        """
+        Parameters
+        ----------
+        writer: TsvResultWriter or ColumnarResultWriter
+                writer used in the background thread
+        queue_size: int
+                    maximum number of pending batches
+        batch_size: int
+                    number of rows per batch
+        """
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch = []
+        self.n_rows = 0
+        # seconds the writer thread spent formatting and writing
+        self.write_time = 0.0
+        # seconds the caller spent waiting for room in the queue
+        self.wait_time = 0.0
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                # keep draining so that the caller never blocks
+                continue
+            start = time.time()
+            try:
+                for row in batch:
+                    self.writer.write(*row)
+            except Exception as e:
+                self.error = e
+            self.write_time += time.time() - start
+
+    def _flush(self):
+        start = time.time()
+        self.queue.put(self.batch)
+        self.wait_time += time.time() - start
+        self.batch = []
+
+    def write(self, orf, scores, profile):
+        self.batch.append((orf, scores, profile))
+        self.n_rows += 1
+        if len(self.batch) >= self.batch_size:
+            self._flush()
+
+    def close(self):
+        self._flush()
+        self.queue.put(None)
+        self.thread.join()
+        start = time.time()
+        try:
+            if self.error is not None:
+                raise self.error
+        finally:
+            self.writer.close()
+            self.write_time += time.time() - start
+
+
+class DetectedOrfs(object):
+    """Columnar detect-orfs results.
+
+    Profiles are slices of a single array and are returned without copying.
+    """
+
+    def __init__(self, columns, offsets, values):
+        """
+        Parameters
+        ----------
+        columns: dict
+                 key is the column name, value is an array
+        offsets: array
+                 offsets of the profiles in values, one more than the rows
+        values: array
+                concatenated profiles
+        """
+        self.columns = columns
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def profile(self, i):
+        return self.values[self.offsets[i] : self.offsets[i + 1]]
+
+    def subset(self, rows):
+        """
+        Parameters
+        ----------
+        rows: array
+              indices of the rows to keep, in the order of the copy
+
+        Returns
+        -------
+        detected: DetectedOrfs
+                  a copy restricted to the given rows
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = {column: values[rows] for column, values in self.columns.items()}
+        lengths = self.offsets[rows + 1] - self.offsets[rows]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # position of each kept value in the original array
+        starts = np.repeat(self.offsets[rows] - offsets[:-1], lengths)
+        values = self.values[starts + np.arange(offsets[-1])]
+        return DetectedOrfs(columns, offsets, values)
+
+    @classmethod
+    def concatenate(cls, parts):
+        """
+        Parameters
+        ----------
+        parts: List[DetectedOrfs]
+
+        Returns
+        -------
+        detected: DetectedOrfs
+                  rows of all parts, one after the other
+        """
+        columns = {
+            column: np.concatenate([part.columns[column] for part in parts])
+            for column in SCALAR_COLUMNS
+        }
+        offsets = [np.zeros(1, dtype=np.int64)]
+        shift = 0
+        for part in parts:
+            offsets.append(np.asarray(part.offsets[1:], dtype=np.int64) + shift)
+            shift += int(part.offsets[-1])
+        values = np.concatenate(
+            [np.asarray(part.values, dtype=np.int64) for part in parts]
+        )
+        return cls(columns, np.concatenate(offsets), values)
+
+    def save(self, path, output_format):
+        """
+        Parameters
+        ----------
+        path: str
+              Path to output file
+        output_format: str
+                       {'parquet', 'npz'}
+        """
+        offsets = np.asarray(self.offsets, dtype=np.int64)
+        values = np.asarray(self.values, dtype=np.int64)
+        if output_format == "npz":
+            # strings read from parquet are object arrays, which npz would pickle
+            columns = {
+                column: array.astype(str) if array.dtype == object else array
+                for column, array in self.columns.items()
+            }
+            np.savez_compressed(
+                path, profile_offsets=offsets, profile_values=values, **columns
+            )
+            return
+        pa = _import_pyarrow()
+        table = pa.table(
+            dict(
+                self.columns,
+                profile=pa.LargeListArray.from_arrays(
+                    pa.array(offsets), pa.array(values)
+                ),
+            )
+        )
+        pa.parquet.write_table(table, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Parameters
+        ----------
+        path: str
+              Path to a parquet or npz detect-orfs output
+
+        Returns
+        -------
+        detected: DetectedOrfs
+        """
+        if result_format(path) == "npz":
+            with np.load(path, allow_pickle=False) as data:
+                columns = {column: data[column] for column in SCALAR_COLUMNS}
+                return cls(columns, data["profile_offsets"], data["profile_values"])
+        pa = _import_pyarrow()
+        table = pa.parquet.read_table(path)
+        columns = {
+            column: table.column(column).to_numpy() for column in SCALAR_COLUMNS
+        }
+        profiles = table.column("profile").combine_chunks()
+        offsets = profiles.offsets.to_numpy()
+        values = profiles.values.to_numpy()
+        return cls(columns, offsets, values)
+
+
+def _parse_profile(profile):
+    profile_stripped = profile.strip()[1:-1].split(", ")
+    if profile_stripped[0]:
+        return list(map(int, profile_stripped))
+    return []
+
+
+def _parse_profile_array(profile):
+    return np.fromstring(profile.strip()[1:-1], dtype=np.int64, sep=", ")
+
+
+def iter_detected_orfs(detected_orfs, arrays=False):
+    """Yield the rows of a detect-orfs output of any format.
+
+    Parameters
+    ----------
+    detected_orfs: str
+                   Path to the detected orfs file generated by ribotricer
+                   detect_orfs
+    arrays: bool
+            Whether to yield the profiles as integer arrays instead of lists
+
+    Returns
+    -------
+    rows: generator of (fields, profile)
+          fields are the values of all columns but the profile, in the order
+          of OUTPUT_COLUMNS; profile is the coverage of the ORF
+    """
+    if result_format(detected_orfs) == "tsv":
+        with _open_text(detected_orfs) as fin:
+            # Skip header
+            fin.readline()
+            for line in fin:
+                fields = line.strip().split("\t")
+                if arrays:
+                    yield fields[:-1], _parse_profile_array(fields[-1])
+                else:
+                    yield fields[:-1], _parse_profile(fields[-1])
+        return
+    detected = DetectedOrfs.load(detected_orfs)
+    rows = zip(*[detected.columns[column].tolist() for column in SCALAR_COLUMNS])
+    for i, fields in enumerate(rows):
+        yield list(fields), detected.profile(i)
+
+
+def read_detected_table(detected_orfs, usecols=None):
+    """Read the scalar columns of a detect-orfs output of any format
+
+    Parameters
+    ----------
+    detected_orfs: str
+                   Path to the detected orfs file generated by ribotricer
+                   detect_orfs
+    usecols: List[str]
+             columns to read, all scalar columns if None
+
+    Returns
+    -------
+    df: DataFrame
+    """
+    if result_format(detected_orfs) == "tsv":
+        return pd.read_csv(detected_orfs, sep="\t", usecols=usecols)
+    detected = DetectedOrfs.load(detected_orfs)
+    if usecols is None:
+        usecols = SCALAR_COLUMNS
+    return pd.DataFrame({column: detected.columns[column] for column in usecols})
+
+
+def merge_results(detected_orfs, ribotricer_index, saveto):
+    """Merge detect-orfs outputs of disjoint regions into the output of a
+    run over all of them.
+
+    The rows are put back in the order of the index, so that merging the
+    outputs of regions tiling the genome gives the same file as a single
+    run over the whole genome with the same P-site offsets.
+
+    Parameters
+    ----------
+    detected_orfs: List[str]
+                   Paths to detect-orfs outputs, all in the same format
+    ribotricer_index: str
+                      Path to the index used for generating them
+    saveto: str
+            Path to output file, in the format of the inputs
+
+    Returns
+    -------
+    n_rows: int
+            number of merged rows
+    """
+    output_format = result_format(detected_orfs[0])
+    if any(result_format(path) != output_format for path in detected_orfs):
+        raise ValueError("all detected ORFs must be in the same format")
+    if result_format(saveto) != output_format:
+        raise ValueError("output must be in the {} format".format(output_format))
+
+    # rows of each ORF in the index; the same ID can appear more than once
+    index_rows = defaultdict(deque)
+    for row, oid in enumerate(index_orf_ids(ribotricer_index)):
+        index_rows[oid].append(row)
+
+    def _index_row(oid):
+        try:
+            return index_rows[oid].popleft()
+        except IndexError:
+            raise ValueError(
+                "ORF {} not found in the index or reported twice".format(oid)
+            )
+
+    if output_format == "tsv":
+        header = None
+        records = []
+        for path in detected_orfs:
+            with _open_text(path) as fin:
+                header = fin.readline()
+                for line in fin:
+                    records.append((_index_row(line.split("\t", 1)[0]), line))
+        records.sort(key=lambda x: x[0])
+        with _open_text(saveto, "w") as output:
+            output.write(header)
+            output.writelines(line for _, line in records)
+        return len(records)
+
+    detected = DetectedOrfs.concatenate(
+        [DetectedOrfs.load(path) for path in detected_orfs]
+    )
+    rows = np.array(
+        [_index_row(oid) for oid in detected.columns["ORF_ID"].tolist()],
+        dtype=np.int64,
+    )
+    detected.subset(np.argsort(rows, kind="stable")).save(saveto, output_format)
+    return len(rows)
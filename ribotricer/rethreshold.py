@@ -0,0 +1,277 @@
+"""Recompute the status of detected ORFs for new cutoffs"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from array import array
+import datetime
+
+import numpy as np
+
+from .results import _open_text
+from .results import _parse_profile
+from .results import DetectedOrfs
+from .results import FLOAT_COLUMNS
+from .results import INT_COLUMNS
+from .results import result_format
+from .results import SCALAR_COLUMNS
+
+# Name of the array holding the minimum codon coverage in a scored table,
+# which otherwise holds the arrays of an npz detect-orfs output
+MIN_CODON_COVERAGE = "min_codon_coverage"
+SCORED_TABLE_SUFFIX = "_scored_table.npz"
+CUTOFF_NAMES = [
+    "phase_score_cutoff",
+    "min_valid_codons",
+    "min_reads_per_codon",
+    "min_valid_codons_ratio",
+    "min_read_density",
+]
+
+
+def min_codon_coverage(offsets, values):
+    """Minimum codon coverage of each profile.
+
+    Parameters
+    ----------
+    offsets: array
+             offsets of the profiles in values, one more than the profiles
+    values: array
+            concatenated nucleotide profiles
+
+    Returns
+    -------
+    min_coverage: array
+                  minimum over the codons of each profile, the last codon
+                  possibly being partial; inf for empty profiles
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    values = np.asarray(values, dtype=np.int64)
+    lengths = np.diff(offsets)
+    n_codons = (lengths + 2) // 3
+    min_coverage = np.full(len(lengths), np.inf)
+    if n_codons.sum() == 0:
+        return min_coverage
+    first_codon = np.concatenate([[0], np.cumsum(n_codons)[:-1]])
+    # start of every codon in values
+    codon_starts = np.repeat(offsets[:-1], n_codons) + 3 * (
+        np.arange(n_codons.sum()) - np.repeat(first_codon, n_codons)
+    )
+    codon_coverage = np.add.reduceat(values, codon_starts)
+    nonempty = n_codons > 0
+    min_coverage[nonempty] = np.minimum.reduceat(codon_coverage, first_codon[nonempty])
+    return min_coverage
+
+
+def _read_tsv_table(detected_orfs):
+    columns = {column: [] for column in SCALAR_COLUMNS}
+    values = array("q")
+    offsets = array("q", [0])
+    with _open_text(detected_orfs) as fin:
+        # Skip header
+        fin.readline()
+        for line in fin:
+            fields = line.strip().split("\t")
+            for column, value in zip(SCALAR_COLUMNS, fields[:-1]):
+                columns[column].append(value)
+            values.extend(_parse_profile(fields[-1]))
+            offsets.append(len(values))
+    for column in SCALAR_COLUMNS:
+        if column in FLOAT_COLUMNS:
+            columns[column] = np.array(columns[column], dtype=np.float64)
+        elif column in INT_COLUMNS:
+            columns[column] = np.array(columns[column], dtype=np.int64)
+        else:
+            columns[column] = np.array(columns[column], dtype=str)
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+    values = np.frombuffer(values, dtype=np.int64)
+    return DetectedOrfs(columns, offsets, values)
+
+
+def is_scored_table(path):
+    """Check whether a file is a scored table written by rethreshold"""
+    if not path.endswith(".npz"):
+        return False
+    with np.load(path, allow_pickle=False) as data:
+        return MIN_CODON_COVERAGE in data.files
+
+
+def load_scored_table(detected_orfs):
+    """Columns and profiles of detected ORFs along with the minimum codon
+    coverage.
+
+    Parameters
+    ----------
+    detected_orfs: str
+                   Path to a detect-orfs output of any format, or to a scored
+                   table saved by save_scored_table
+
+    Returns
+    -------
+    table: dict
+           key is the column name, value is an array; the profiles are
+           stored as in an npz detect-orfs output, see DetectedOrfs.save
+    """
+    if is_scored_table(detected_orfs):
+        with np.load(detected_orfs, allow_pickle=False) as data:
+            return {column: data[column] for column in data.files}
+    if result_format(detected_orfs) == "tsv":
+        detected = _read_tsv_table(detected_orfs)
+    else:
+        detected = DetectedOrfs.load(detected_orfs)
+    table = dict(detected.columns)
+    table["profile_offsets"] = np.asarray(detected.offsets, dtype=np.int64)
+    table["profile_values"] = np.asarray(detected.values, dtype=np.int64)
+    table[MIN_CODON_COVERAGE] = min_codon_coverage(detected.offsets, detected.values)
+    return table
+
+
+def save_scored_table(table, path):
+    """
+    Parameters
+    ----------
+    table: dict
+           as returned by load_scored_table
+    path: str
+          Path to output file, ending with .npz
+    """
+    columns = {
+        column: values.astype(str) if values.dtype == object else values
+        for column, values in table.items()
+    }
+    np.savez_compressed(path, **columns)
+
+
+def translating_mask(
+    table,
+    phase_score_cutoff,
+    min_valid_codons,
+    min_reads_per_codon,
+    min_valid_codons_ratio,
+    min_read_density,
+):
+    """Status of each ORF for the given cutoffs, as in detect-orfs.
+
+    Parameters
+    ----------
+    table: dict
+           as returned by load_scored_table
+
+    Returns
+    -------
+    translating: array
+                 True for ORFs passing all the cutoffs
+    """
+    return (
+        (table["phase_score"] >= phase_score_cutoff)
+        & (table["valid_codons"] >= min_valid_codons)
+        & (table[MIN_CODON_COVERAGE] >= min_reads_per_codon)
+        & (table["valid_codons_ratio"] >= min_valid_codons_ratio)
+        & (table["read_density"] >= min_read_density)
+    )
+
+
+def _write_tsv_rows(detected_orfs, translating, saveto, report_all):
+    """Rewrite the lines of a tsv output with the new status"""
+    with _open_text(detected_orfs) as fin, _open_text(saveto, "w") as output:
+        output.write(fin.readline())
+        for line, is_translating in zip(fin, translating):
+            if not is_translating and not report_all:
+                continue
+            oid, otype, _, rest = line.split("\t", 3)
+            status = "translating" if is_translating else "nontranslating"
+            output.write("\t".join([oid, otype, status, rest]))
+
+
+def rethreshold(detected_orfs, prefix, cutoff_sets, report_all=False, save=False):
+    """Recompute the status of detected ORFs for one or more sets of cutoffs.
+
+    Parameters
+    ----------
+    detected_orfs: str
+                   Path to a detect-orfs output generated with --report_all,
+                   or to a scored table saved by a previous run
+    prefix: str
+            prefix for output files
+    cutoff_sets: List[tuple]
+                 (phase_score_cutoff, min_valid_codons, min_reads_per_codon,
+                 min_valid_codons_ratio, min_read_density) for each set
+    report_all: bool
+                Whether to output all ORFs regardless of the new status
+    save: bool
+          Whether to save the scored table for later runs
+
+    Returns
+    -------
+    n_translating: List[int]
+                   number of translating ORFs for each set of cutoffs
+    """
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ... started loading detected ORFs"))
+    table = load_scored_table(detected_orfs)
+    if not (table["status"] == "nontranslating").any():
+        print(
+            "WARNING: no nontranslating ORF found, the input was probably "
+            "generated without --report_all; relaxed cutoffs cannot add ORFs"
+        )
+    if save and not is_scored_table(detected_orfs):
+        save_scored_table(table, "{}{}".format(prefix, SCORED_TABLE_SUFFIX))
+
+    # a scored table holds the arrays of an npz output
+    input_format = result_format(detected_orfs)
+    ext = input_format
+    if detected_orfs.endswith(".gz"):
+        ext += ".gz"
+    if input_format != "tsv":
+        detected = DetectedOrfs(
+            {column: table[column] for column in SCALAR_COLUMNS},
+            table["profile_offsets"],
+            table["profile_values"],
+        )
+
+    now = datetime.datetime.now()
+    print(
+        now.strftime("%b %d %H:%M:%S ... started applying")
+        + " {} set(s) of cutoffs to {} ORFs".format(
+            len(cutoff_sets), len(table["status"])
+        )
+    )
+    n_translating = []
+    summary = "set\t{}\tn_translating\n".format("\t".join(CUTOFF_NAMES))
+    for i, cutoffs in enumerate(cutoff_sets):
+        translating = translating_mask(table, *cutoffs)
+        n_translating.append(int(translating.sum()))
+        summary += "{}\t{}\t{}\n".format(
+            i, "\t".join(map(str, cutoffs)), n_translating[-1]
+        )
+        if len(cutoff_sets) == 1:
+            saveto = "{}_translating_ORFs.{}".format(prefix, ext)
+        else:
+            saveto = "{}_set{}_translating_ORFs.{}".format(prefix, i, ext)
+        if input_format == "tsv":
+            _write_tsv_rows(detected_orfs, translating, saveto, report_all)
+        else:
+            rows = np.arange(len(translating))
+            if not report_all:
+                rows = rows[translating]
+            subset = detected.subset(rows)
+            subset.columns["status"] = np.where(
+                translating[rows], "translating", "nontranslating"
+            )
+            subset.save(saveto, input_format)
+
+    with open("{}_rethreshold_summary.tsv".format(prefix), "w") as output:
+        output.write(summary)
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ... finished ribotricer rethreshold"))
+    return n_translating
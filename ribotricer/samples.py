@@ -0,0 +1,407 @@
+"""Detect translating ORFs in several samples sharing one index"""
+# Part of ribotricer software
+#
+# Copyright (C) 2020 Saket Choudhary, Wenzheng Li, and Andrew D Smith
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+from multiprocessing import Pool
+import datetime
+import os
+import time
+
+import numpy as np
+from tqdm.autonotebook import tqdm
+
+from .const import CUTOFF
+from .const import MINIMUM_DENSITY_OVER_ORF
+from .const import MINIMUM_READS_PER_CODON
+from .const import MINIMUM_VALID_CODONS
+from .const import MINIMUM_VALID_CODONS_RATIO
+from .count_orfs import GeneCounts
+from .detect_orfs import alignment_arrays
+from .detect_orfs import export_coverage
+from .detect_orfs import ingest_bam
+from .detect_orfs import score_coverage
+from .index import CompactIndex
+from .index import STRANDS
+from .results import result_path
+from .results import result_writer
+from .results import ThreadedResultWriter
+
+SAMPLE_SHEET_COLUMNS = ["sample", "bam"]
+# Number of ORFs whose coverage is gathered at once for all samples
+SCORE_BATCH_SIZE = 1024
+
+# Annotated ORFs shared with the ingestion workers
+_annotated = None
+
+
+def sample_names(bams):
+    """Sample names derived from the bam file names.
+
+    Parameters
+    ----------
+    bams: List[str]
+          Paths to bam files
+
+    Returns
+    -------
+    samples: List[(str, str)]
+             (sample, bam) for each bam
+    """
+    names = []
+    for bam in bams:
+        name = os.path.basename(bam)
+        if name.endswith(".bam"):
+            name = name[: -len(".bam")]
+        names.append(name)
+    if len(set(names)) != len(names):
+        raise ValueError("bam file names are not unique, use a sample sheet")
+    return list(zip(names, bams))
+
+
+def parse_sample_sheet(sample_sheet, path_column="bam"):
+    """
+    Parameters
+    ----------
+    sample_sheet: str
+                  Path to a tab separated file with columns sample and bam;
+                  relative bam paths are relative to the sample sheet
+    path_column: str
+                 name of the second column, holding the file of each sample
+
+    Returns
+    -------
+    samples: List[(str, str)]
+             (sample, bam) for each line
+    """
+    columns = [SAMPLE_SHEET_COLUMNS[0], path_column]
+    samples = []
+    sheet_dir = os.path.dirname(os.path.abspath(sample_sheet))
+    with open(sample_sheet, "r") as fin:
+        header = fin.readline().rstrip("\n").split("\t")
+        if header[:2] != columns:
+            raise ValueError(
+                "sample sheet must start with columns {}".format(", ".join(columns))
+            )
+        for line in fin:
+            fields = line.rstrip("\n").split("\t")
+            if not fields[0]:
+                continue
+            if len(fields) < 2:
+                raise ValueError(
+                    "no {} file for sample {}".format(path_column, fields[0])
+                )
+            samples.append((fields[0], os.path.join(sheet_dir, fields[1])))
+    names = [sample for sample, _ in samples]
+    if len(set(names)) != len(names):
+        raise ValueError("sample names are not unique")
+    if not samples:
+        raise ValueError("no sample found in the sample sheet")
+    return samples
+
+
+def sample_prefix(prefix, sample):
+    return "{}_{}".format(prefix, sample)
+
+
+def _position_keys(chrom_codes, strands, positions):
+    """Encode (chrom, strand, position) as one integer, ordered by
+    chromosome and strand first"""
+    groups = chrom_codes.astype(np.int64) * len(STRANDS) + strands
+    return (groups << 32) + positions
+
+
+def coverage_lookup(merged_alignments, chrom_codes):
+    """Merged alignments of a sample as sorted arrays.
+
+    Parameters
+    ----------
+    merged_alignments: dict(Counter)
+                       alignments by merging all lengths
+    chrom_codes: dict
+                 key is the chromosome, value is its code in the index;
+                 alignments on other chromosomes are dropped
+
+    Returns
+    -------
+    keys: array
+          sorted keys of the covered positions, see _position_keys
+    counts: array
+            number of reads at each position
+    """
+    keys, counts = [], []
+    for strand in merged_alignments:
+        for chrom, (pos, cnt) in alignment_arrays(merged_alignments[strand]).items():
+            if chrom not in chrom_codes:
+                continue
+            keys.append(
+                _position_keys(
+                    np.full(len(pos), chrom_codes[chrom]),
+                    STRANDS.index(strand),
+                    pos,
+                )
+            )
+            counts.append(cnt)
+    if not keys:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    keys = np.concatenate(keys)
+    counts = np.concatenate(counts)
+    order = np.argsort(keys, kind="stable")
+    return keys[order], counts[order]
+
+
+def lookup_arrays(keys, counts, chroms):
+    """Inverse of coverage_lookup.
+
+    Parameters
+    ----------
+    keys: array
+          sorted keys of the covered positions, see _position_keys
+    counts: array
+            number of reads at each position
+    chroms: List[str]
+            chromosome of each code
+
+    Returns
+    -------
+    coverage: dict
+              key is (chrom, strand), value is (positions, counts), both
+              arrays sorted by position
+    """
+    groups = keys >> 32
+    positions = keys - (groups << 32)
+    first = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+    last = np.concatenate([first[1:], [len(keys)]])
+    coverage = {}
+    for start, end in zip(first.tolist(), last.tolist()):
+        if start == end:
+            continue
+        code, strand = divmod(int(groups[start]), len(STRANDS))
+        coverage[chroms[code], STRANDS[strand]] = (
+            positions[start:end],
+            counts[start:end],
+        )
+    return coverage
+
+
+def lookup_coverage(keys, counts, query):
+    """Number of reads at the queried keys, 0 for uncovered positions"""
+    if len(keys) == 0:
+        return np.zeros(len(query), dtype=np.int64)
+    idx = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+    return np.where(keys[idx] == query, counts[idx], 0)
+
+
+def _init_worker(annotated):
+    global _annotated
+    _annotated = annotated
+
+
+def _ingest_sample(task):
+    """Run detect-orfs up to the merged alignments for one sample and
+    return them as a coverage lookup"""
+    sample, bam, prefix, chrom_codes, coverage_format, options = task
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "started reading sample {}".format(sample)
+        )
+    )
+    merged_alignments = ingest_bam(bam, annotated=_annotated, **options)
+    if coverage_format != "none":
+        export_coverage(merged_alignments, options["prefix"], coverage_format, bam)
+    return coverage_lookup(merged_alignments, chrom_codes)
+
+
+def detect_orfs_samples(
+    samples,
+    ribotricer_index,
+    prefix,
+    protocol,
+    read_lengths,
+    psite_offsets,
+    phase_score_cutoff=CUTOFF,
+    min_valid_codons=MINIMUM_VALID_CODONS,
+    min_reads_per_codon=MINIMUM_READS_PER_CODON,
+    min_valid_codons_ratio=MINIMUM_VALID_CODONS_RATIO,
+    min_density_over_orf=MINIMUM_DENSITY_OVER_ORF,
+    report_all=False,
+    regions=None,
+    metagene_max_orfs=None,
+    metagene_min_cds_reads=0,
+    coverage_format="wig",
+    output_format="tsv",
+    compress=False,
+    checkpoint=False,
+    resume=False,
+    threads=1,
+    phase_score_matrix=False,
+    features=None,
+    gene_counts=False,
+):
+    """Detect translating ORFs in several samples.
+
+    The index is loaded once as a CompactIndex. Each sample is read and
+    merged in its own worker process, then the ORFs are scored in batches
+    for all samples at once. The outputs of each sample are written with
+    the prefix {prefix}_{sample}, see detect_orfs for the other parameters.
+
+    Parameters
+    ----------
+    samples: List[(str, str)]
+             (sample, bam) for each sample
+    threads: int
+             Number of samples read in parallel
+    phase_score_matrix: bool
+                        Whether to write the phase score of every ORF in
+                        every sample to {prefix}_phase_scores.tsv
+    features: set
+              if given, only ORFs of these types are scored
+    gene_counts: bool
+                 Whether to write the read counts of the genes of the
+                 reported ORFs of each sample to {prefix}_{sample}_gene_counts.tsv
+    """
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ..... started ribotricer detect-orfs"))
+
+    now = datetime.datetime.now()
+    print(now.strftime("%b %d %H:%M:%S ... started loading ribotricer index file"))
+    index = CompactIndex.load(ribotricer_index)
+    annotated = index.annotated()
+    windows = None
+    if regions is not None:
+        windows = index.fetch_windows(regions, features=features)
+
+    tasks = []
+    for sample, bam in samples:
+        options = {
+            "ribotricer_index": ribotricer_index,
+            "prefix": sample_prefix(prefix, sample),
+            "protocol": protocol,
+            "read_lengths": read_lengths,
+            "psite_offsets": psite_offsets,
+            "phase_score_cutoff": phase_score_cutoff,
+            "metagene_max_orfs": metagene_max_orfs,
+            "metagene_min_cds_reads": metagene_min_cds_reads,
+            "checkpoint": checkpoint,
+            "resume": resume,
+            "windows": windows,
+        }
+        tasks.append((sample, bam, prefix, index.chrom_codes, coverage_format, options))
+    if threads > 1:
+        with Pool(
+            min(threads, len(tasks)), initializer=_init_worker, initargs=(annotated,)
+        ) as pool:
+            lookups = pool.map(_ingest_sample, tasks, chunksize=1)
+    else:
+        _init_worker(annotated)
+        lookups = [_ingest_sample(task) for task in tasks]
+        _init_worker(None)
+    del annotated
+
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "started calculating phase scores for each ORF in {} samples".format(
+                len(samples)
+            ),
+        )
+    )
+    thresholds = (
+        phase_score_cutoff,
+        min_valid_codons,
+        min_reads_per_codon,
+        min_valid_codons_ratio,
+        min_density_over_orf,
+    )
+    writers = [
+        ThreadedResultWriter(
+            result_writer(
+                result_path(sample_prefix(prefix, sample), output_format, compress),
+                output_format,
+            )
+        )
+        for sample, _ in samples
+    ]
+    gene_counters = [GeneCounts() for _ in samples] if gene_counts else None
+    matrix = None
+    if phase_score_matrix:
+        matrix = open("{}_phase_scores.tsv".format(prefix), "w")
+        matrix.write("\t".join(["ORF_ID"] + [sample for sample, _ in samples]) + "\n")
+    start = time.time()
+
+    rows = index.select(regions, features)
+    with tqdm(total=len(rows), unit="ORFs") as pbar:
+        for first in range(0, len(rows), SCORE_BATCH_SIZE):
+            batch = rows[first : first + SCORE_BATCH_SIZE]
+            positions, offsets = index.genome_positions(batch)
+            owner = np.repeat(np.arange(len(batch)), np.diff(offsets))
+            query = _position_keys(
+                index.chrom[batch][owner], index.strand[batch][owner], positions
+            )
+            # (samples x positions) coverage of the batch
+            coverage = [
+                lookup_coverage(keys, counts, query).tolist()
+                for keys, counts in lookups
+            ]
+            offsets = offsets.tolist()
+            matrix_lines = []
+            for j, i in enumerate(batch.tolist()):
+                row = index.row(i)
+                orf = None
+                phase_scores = []
+                for k, (writer, sample_coverage) in enumerate(zip(writers, coverage)):
+                    cov = sample_coverage[offsets[j] : offsets[j + 1]]
+                    scores = score_coverage(cov, *thresholds)
+                    phase_scores.append(scores[1])
+                    if report_all or scores[0] == "translating":
+                        writer.write(row, scores, cov)
+                        if gene_counters is not None:
+                            if orf is None:
+                                orf = index.orf(i)
+                            gene_counters[k].add(orf)
+                if matrix is not None:
+                    matrix_lines.append(
+                        "\t".join(map(str, [row.oid] + phase_scores)) + "\n"
+                    )
+            if matrix is not None:
+                matrix.writelines(matrix_lines)
+            pbar.update(len(batch))
+    if matrix is not None:
+        matrix.close()
+    for writer in writers:
+        writer.close()
+    if gene_counters is not None:
+        for (sample, _), counter, (keys, values) in zip(
+            samples, gene_counters, lookups
+        ):
+            counter.count(lookup_arrays(keys, values, index.chroms))
+            counter.write("{}_gene_counts.tsv".format(sample_prefix(prefix, sample)))
+    elapsed = time.time() - start
+
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"),
+            "scored {} ORFs in {} samples in {:.1f}s".format(
+                len(rows), len(samples), elapsed
+            ),
+        )
+    )
+    now = datetime.datetime.now()
+    print(
+        "{} ... {}".format(
+            now.strftime("%b %d %H:%M:%S"), "finished ribotricer detect-orfs"
+        )
+    )
@@ -15,6 +15,8 @@
 
 from collections import defaultdict
 from .statistics import phasescore
+from .results import iter_detected_orfs
+from .results import result_format
 
 import numpy as np
 from tqdm.autonotebook import tqdm
@@ -323,21 +325,27 @@ def theta_rna(rna_file, prefix, cutoff=10):
     rna = {}
 
     print("reading RNA profiles")
-    with open(rna_file, "r") as orf:
-        total_lines = len(["" for line in orf])
-    with open(rna_file, "r") as orf:
-        with tqdm(total=total_lines) as pbar:
-            # Skip header
-            orf.readline()
-            for line in orf:
-                pbar.update()
-                fields = line.split("\t")
-                oid = fields[0]
-                cov = fields[1]
-                cov = cov[1:-1]
-                cov = [int(x) for x in cov.split(", ")]
-                if sum(cov) > cutoff:
-                    rna[oid] = cov
+    if result_format(rna_file) != "tsv":
+        # columnar detect-orfs output
+        for fields, cov in tqdm(iter_detected_orfs(rna_file)):
+            if sum(cov) > cutoff:
+                rna[fields[0]] = cov.tolist()
+    else:
+        with open(rna_file, "r") as orf:
+            total_lines = len(["" for line in orf])
+        with open(rna_file, "r") as orf:
+            with tqdm(total=total_lines) as pbar:
+                # Skip header
+                orf.readline()
+                for line in orf:
+                    pbar.update()
+                    fields = line.split("\t")
+                    oid = fields[0]
+                    cov = fields[1]
+                    cov = cov[1:-1]
+                    cov = [int(x) for x in cov.split(", ")]
+                    if sum(cov) > cutoff:
+                        rna[oid] = cov
 
     rna_angles = []
     for ID in tqdm(list(rna.keys())):
@@ -367,20 +375,11 @@ def summarize_profile_to_codon_level(detected_orfs, saveto):
     """
     with open(saveto, "w") as fout:
         fout.write("ORF_ID\tcodon_profile\n")
-        with open(detected_orfs, "r") as fin:
-            # Skip header
-            fin.readline()
-            for line in fin:
-                fields = line.strip().split("\t")
-                oid, otype, status = fields[:3]
-                gene_id, gene_name, gene_type = fields[9:12]
-                chrom, strand, start_codon, profile = fields[12:]
-
-                profile_stripped = profile.strip()[1:-1].split(", ")
-                if profile_stripped[0]:
-                    profile = np.array(list(map(int, profile_stripped)))
-                codon_profile = np.add.reduceat(profile, range(0, len(profile), 3))
-                fout.write("{}\t{}\n".format(oid, list(codon_profile)))
+        for fields, profile in iter_detected_orfs(detected_orfs):
+            oid = fields[0]
+            profile = np.asarray(profile)
+            codon_profile = np.add.reduceat(profile, range(0, len(profile), 3))
+            fout.write("{}\t{}\n".format(oid, list(codon_profile)))
 
 
 def translate(seq):
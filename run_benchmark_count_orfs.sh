@@ -0,0 +1,19 @@
+#/bin/bash
+# Time count-orfs on the annotated ORFs of a full human index
+# usage: run_benchmark_count_orfs.sh <human_candidate_orfs.tsv> <detected_ORFs> [features]
+# The counts of the tair10 test data are checked against the expected table first
+set -eox pipefail
+INDEX=$1
+DETECTED=$2
+FEATURES=${3:-annotated}
+wget -c https://www.dropbox.com/s/lqku9ur5k1efq06/ribotricer_test_data_tair10.zip
+unzip -n ribotricer_test_data_tair10.zip
+ribotricer count-orfs --detected_orfs ribotricer_test_data_tair10/translating_ORFs/SRX219170_translating_ORFs.tsv --ribotricer_index ribotricer_test_data_tair10/index/ribotricer_v44_annotation_longest_candidate_orfs.tsv --features annotated --out ribotricer_test_data_tair10/SRX219170_benchmark_annotated_counts.tsv
+MD5_expected=$(md5sum ribotricer_test_data_tair10/orfs_count/SRX219170_annotated_counts_cnt.txt | awk '{ print $1 }')
+MD5_observed=$(md5sum ribotricer_test_data_tair10/SRX219170_benchmark_annotated_counts.tsv | awk '{ print $1 }')
+if [ $MD5_expected != $MD5_observed ]; then
+echo "count-orfs MD5 mismatch";
+exit 1;
+fi
+/usr/bin/time -v ribotricer count-orfs --detected_orfs $DETECTED --ribotricer_index $INDEX --features $FEATURES --out benchmark_count_orfs_${FEATURES//,/_}.tsv
+/usr/bin/time -v ribotricer count-orfs --detected_orfs $DETECTED --ribotricer_index $INDEX --features $FEATURES --out benchmark_count_orfs_${FEATURES//,/_}_report_all.tsv --report_all
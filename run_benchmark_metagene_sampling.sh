@@ -0,0 +1,18 @@
+#/bin/bash
+# Compare P-site offsets inferred from all CDSs with those inferred from
+# the best covered CDSs only (--metagene_max_orfs)
+set -eox pipefail
+wget -c https://www.dropbox.com/s/lqku9ur5k1efq06/ribotricer_test_data_tair10.zip
+unzip -n ribotricer_test_data_tair10.zip
+BAM=ribotricer_test_data_tair10/bams_unique/SRX219170.bam
+INDEX=ribotricer_test_data_tair10/index/ribotricer_v44_annotation_longest_candidate_orfs.tsv
+/usr/bin/time -v ribotricer detect-orfs --bam $BAM --ribotricer_index $INDEX --prefix ribotricer_test_data_tair10/SRX219170_metagene_all
+for MAX_ORFS in 500 1000 2000 5000; do
+/usr/bin/time -v ribotricer detect-orfs --bam $BAM --ribotricer_index $INDEX --prefix ribotricer_test_data_tair10/SRX219170_metagene_top$MAX_ORFS --metagene_max_orfs $MAX_ORFS
+LAGS_expected=$(grep "lag" ribotricer_test_data_tair10/SRX219170_metagene_all_psite_offsets.txt)
+LAGS_observed=$(grep "lag" ribotricer_test_data_tair10/SRX219170_metagene_top${MAX_ORFS}_psite_offsets.txt)
+if [ "$LAGS_expected" != "$LAGS_observed" ]; then
+echo "P-site offsets differ with --metagene_max_orfs $MAX_ORFS";
+exit 1;
+fi
+done
@@ -37,6 +37,7 @@ setuptools.setup(
     entry_points={"console_scripts": ["ribotricer=ribotricer.cli:cli"]},
     python_requires=">=3.7",
     install_requires=requirements,
+    extras_require={"bigwig": ["pyBigWig"], "parquet": ["pyarrow"]},
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",